@@ -0,0 +1,180 @@
+"""
+Run several projects in one process.
+
+A manifest is a JSON file:
+
+    {
+        "defaults": {"cutadapt_min_length": 100, "pear_min_overlap": 20, ...},
+        "projects": [
+            {"name": "project_1", "input_dir": "/data/p1", "work_dir": "/work/p1"},
+            {"name": "project_2", "input_dir": "/data/p2", "work_dir": "/work/p2",
+             "previous_otus_fp": "...", "previous_otu_table_fp": "..."}
+        ]
+    }
+
+Keys are the dest names of the pipeline's command line arguments. Each project's
+settings (its own keys over the defaults) are parsed exactly as the command line of
+a separate run would be, so every project gets the same defaults and checks and
+its outputs do not depend on the other projects.
+
+All projects run concurrently on one JobScheduler, so external tool jobs from every
+project share one core budget, and on one ReferenceCache, so an OTU sequence index
+used by several projects is read once.
+
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+
+from cluster_16S.memory import parse_memory_size
+from cluster_16S.pipeline import Pipeline, get_args, run_pipeline
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.scheduler import JobScheduler
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = get_batch_args()
+    results = run_batch(
+        projects=read_manifest(args.manifest_fp, core_count=args.core_count),
+        core_count=args.core_count,
+        max_concurrent_projects=args.max_concurrent_projects,
+        command_timeout=args.command_timeout,
+        memory_limit=args.memory_limit)
+    failed_project_names = [name for name, result in results.items() if isinstance(result, BaseException)]
+    for name in failed_project_names:
+        logging.getLogger(name=__name__).error('project "%s" failed: %s', name, results[name])
+    return 1 if len(failed_project_names) > 0 else 0
+
+
+def get_batch_args():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('manifest_fp',
+                            help='JSON manifest of projects')
+    arg_parser.add_argument('-c', '--core-count', default=1, type=int,
+                            help='number of cores shared by all projects')
+    arg_parser.add_argument('--max-concurrent-projects', default=None, type=int,
+                            help='run at most this many projects at once, by default all of them')
+    arg_parser.add_argument('--command-timeout', default=None, type=float,
+                            help='seconds after which an external command is stopped and its project fails')
+    arg_parser.add_argument('--memory-limit', default=None, type=parse_memory_size,
+                            help='start no more jobs of any project while the batch uses more memory than this, '
+                                 'e.g. 64G')
+    return arg_parser.parse_args()
+
+
+def get_project_argv(settings):
+    # {'core_count': 4, 'fastqc': True} -> ['--core-count', '4', '--fastqc']
+    argv = []
+    for key, value in settings.items():
+        option = '--' + key.replace('_', '-')
+        if value is None or value is False:
+            continue
+        elif value is True:
+            argv.append(option)
+        elif isinstance(value, (list, tuple)):
+            argv.extend([option, *(str(v) for v in value)])
+        else:
+            argv.extend([option, str(value)])
+    return argv
+
+
+def get_project_args(settings, description):
+    # the pipeline arguments of one project, checked as a command line would be
+    for required_key in ('input_dir', 'work_dir'):
+        if required_key not in settings:
+            raise PipelineException('{} has no {}'.format(description, required_key))
+    try:
+        return get_args(get_project_argv(settings))
+    except SystemExit:
+        # argparse has printed the problem
+        raise PipelineException('{} has invalid settings'.format(description))
+
+
+def read_manifest(manifest_fp, core_count=1):
+    """
+    Return a list of (project name, parsed arguments), one for each project. Projects
+    without a core_count setting are given core_count, the size of the shared pool.
+    """
+    with open(manifest_fp, 'rt') as manifest_file:
+        manifest = json.load(manifest_file)
+    defaults = manifest.get('defaults', {})
+    projects = []
+    for i, project in enumerate(manifest['projects']):
+        name = project.get('name', 'project_{}'.format(i + 1))
+        settings = {'core_count': core_count}
+        settings.update(defaults)
+        settings.update({key: value for key, value in project.items() if key != 'name'})
+        projects.append((name, get_project_args(settings, description='project "{}" in "{}"'.format(
+            name, manifest_fp))))
+
+    names = [name for name, _ in projects]
+    work_dirs = [os.path.abspath(args.work_dir) for _, args in projects]
+    if len(set(names)) < len(names):
+        raise PipelineException('project names in "{}" are not unique'.format(manifest_fp))
+    if len(set(work_dirs)) < len(work_dirs):
+        raise PipelineException('projects in "{}" share a work directory'.format(manifest_fp))
+    return projects
+
+
+class ReferenceCache:
+    """
+    Results of loading reference files, kept for the life of a batch and keyed by
+    the load function and the files. A result is loaded again if one of its files
+    has changed.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._references = {}
+
+    def get(self, load, *fps):
+        key = (
+            getattr(load, 'func', load),
+            tuple(None if fp is None else (os.path.abspath(fp), os.path.getmtime(fp)) for fp in fps))
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # other references can be loaded at the same time, the same one is loaded once
+        with key_lock:
+            if key not in self._references:
+                logging.getLogger(name=__name__).info('loading reference %s', [fp for fp in fps if fp is not None])
+                self._references[key] = load()
+            return self._references[key]
+
+
+def run_batch(projects, core_count, max_concurrent_projects=None, command_timeout=None, memory_limit=None):
+    """
+    Run (name, args) projects concurrently on one job scheduler and reference cache.
+    A failed project does not stop the others. Returns {name: output directories or
+    the exception that stopped the project}.
+    """
+    log = logging.getLogger(name=__name__)
+    job_scheduler = JobScheduler(core_count=core_count, command_timeout=command_timeout, memory_limit=memory_limit)
+    reference_cache = ReferenceCache()
+
+    def run_project(name, args):
+        log.info('starting project "%s" in "%s"', name, args.work_dir)
+        os.makedirs(args.work_dir, exist_ok=True)
+        pipeline = Pipeline(**dict(args.__dict__, job_scheduler=job_scheduler, reference_cache=reference_cache))
+        output_dir_list = run_pipeline(pipeline, args)
+        log.info('finished project "%s"', name)
+        return output_dir_list
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrent_projects or max(1, len(projects)), thread_name_prefix='project') as executor:
+        futures = {name: executor.submit(run_project, name, args) for name, args in projects}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except BaseException as e:
+                log.exception('project "%s" failed', name)
+                results[name] = e
+    return results
+
+
+if __name__ == '__main__':
+    main()
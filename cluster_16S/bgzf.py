@@ -0,0 +1,298 @@
+"""
+BGZF block-compressed files.
+
+A BGZF file is a series of gzip members of at most 64 KB of data each, every one
+with its compressed size in a 'BC' extra field, followed by an empty end-of-file
+member. Any gzip reader (including vsearch and the Python gzip module) reads it as
+one stream, but because the blocks are independent they can be compressed and
+decompressed in parallel and a reader can start at any block. The start of every
+block is written to a '.gzi' index next to the file, in the format used by
+htslib's bgzip, so a reader can seek without scanning the block headers.
+
+"""
+import concurrent.futures
+import gzip
+import io
+import logging
+import os
+import shutil
+import struct
+import zlib
+
+import numpy as np
+
+from cluster_16S import trace
+from cluster_16S.pipeline_util import PipelineException
+
+
+# the uncompressed size of a block, chosen by htslib so a block of incompressible
+# data still fits in 64 KB
+BLOCK_DATA_SIZE = 0xff00
+# blocks compressed or decompressed together, per thread
+BLOCKS_PER_THREAD = 16
+
+HEADER = struct.Struct('<4BI2BH2B2H')
+HEADER_SIZE = HEADER.size
+TRAILER = struct.Struct('<2I')
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+INDEX_SUFFIX = '.gzi'
+
+
+def compress_block(data, compresslevel=6):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = HEADER_SIZE + len(deflated) + TRAILER.size
+    # gzip magic, deflate, FEXTRA, no mtime, no extra flags, unknown OS, then one
+    # 2 byte 'BC' subfield holding the block size - 1
+    header = HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1)
+    return header + deflated + TRAILER.pack(zlib.crc32(data), len(data))
+
+
+def decompress_block(block):
+    data = zlib.decompress(block[HEADER_SIZE:-TRAILER.size], -15)
+    crc, data_size = TRAILER.unpack(block[-TRAILER.size:])
+    if data_size != len(data) or crc != zlib.crc32(data):
+        raise PipelineException('BGZF block failed its CRC check')
+    return data
+
+
+def get_block_size(header):
+    if len(header) < HEADER_SIZE:
+        return None
+    id1, id2, method, flags, _, _, _, extra_length, si1, si2, subfield_length, block_size = HEADER.unpack_from(header)
+    if (id1, id2, method, flags, si1, si2, subfield_length) != (0x1f, 0x8b, 8, 4, ord('B'), ord('C'), 2) \
+            or extra_length != 6:
+        return None
+    return block_size + 1
+
+
+def is_bgzf(fp):
+    with open(fp, 'rb') as f:
+        return get_block_size(f.read(HEADER_SIZE)) is not None
+
+
+class BgzfWriter:
+    """
+    Write a BGZF file and its '.gzi' index. Blocks are compressed threads at a time.
+    """
+    def __init__(self, fp, threads=1, compresslevel=6):
+        self.fp = fp
+        self.threads = threads
+        self.compresslevel = compresslevel
+        self.file = open(fp, 'wb')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.pending = bytearray()
+        # start of each block in the file and in the data
+        self.block_offsets = []
+        self.data_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= BLOCK_DATA_SIZE * BLOCKS_PER_THREAD * self.threads:
+            self.flush_blocks(final=False)
+        return len(data)
+
+    def flush_blocks(self, final):
+        block_count = len(self.pending) // BLOCK_DATA_SIZE
+        if final and len(self.pending) % BLOCK_DATA_SIZE > 0:
+            block_count += 1
+        with memoryview(self.pending) as pending:
+            blocks = [
+                bytes(pending[i * BLOCK_DATA_SIZE:(i + 1) * BLOCK_DATA_SIZE])
+                for i in range(block_count)
+            ]
+        if self.executor is None:
+            compressed_blocks = [compress_block(block, self.compresslevel) for block in blocks]
+        else:
+            compressed_blocks = self.executor.map(compress_block, blocks, [self.compresslevel] * len(blocks))
+        for block, compressed_block in zip(blocks, compressed_blocks):
+            self.block_offsets.append((self.file.tell(), self.data_size))
+            self.file.write(compressed_block)
+            self.data_size += len(block)
+        del self.pending[:block_count * BLOCK_DATA_SIZE]
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            self.flush_blocks(final=True)
+            self.file.write(EOF_BLOCK)
+        finally:
+            self.file.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+        write_block_index(self.fp, self.block_offsets)
+
+
+def write_block_index(fp, block_offsets):
+    # htslib leaves out the first block, which always starts at (0, 0)
+    with open(fp + INDEX_SUFFIX, 'wb') as index_file:
+        index_file.write(struct.pack('<Q', max(0, len(block_offsets) - 1)))
+        index_file.write(np.array(block_offsets[1:], dtype='<u8').tobytes())
+
+
+def read_block_index(fp):
+    """
+    Return (compressed offsets, uncompressed offsets) of the start of every block of
+    fp, not counting the end-of-file block, from its '.gzi' index if that is at least
+    as new as fp or else by reading the block headers.
+    """
+    index_fp = fp + INDEX_SUFFIX
+    if os.path.exists(index_fp) and os.path.getmtime(index_fp) >= os.path.getmtime(fp):
+        with open(index_fp, 'rb') as index_file:
+            block_count, = struct.unpack('<Q', index_file.read(8))
+            offsets = np.frombuffer(index_file.read(16 * block_count), dtype='<u8').reshape(-1, 2)
+        offsets = np.concatenate(([[0, 0]], offsets)).astype(np.int64)
+        if os.path.getsize(fp) > len(EOF_BLOCK):
+            return offsets[:, 0], offsets[:, 1]
+        else:
+            return offsets[:0, 0], offsets[:0, 1]
+
+    compressed_offsets = []
+    uncompressed_offsets = []
+    data_size = 0
+    with open(fp, 'rb') as f:
+        while True:
+            offset = f.tell()
+            header = f.read(HEADER_SIZE)
+            if len(header) == 0:
+                break
+            block_size = get_block_size(header)
+            if block_size is None:
+                raise PipelineException('"{}" is not a BGZF file'.format(fp))
+            f.seek(offset + block_size - 4)
+            block_data_size, = struct.unpack('<I', f.read(4))
+            if block_data_size > 0:
+                compressed_offsets.append(offset)
+                uncompressed_offsets.append(data_size)
+                data_size += block_data_size
+    return np.array(compressed_offsets, dtype=np.int64), np.array(uncompressed_offsets, dtype=np.int64)
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Read a BGZF file, decompressing threads blocks at a time. seek() jumps directly
+    to the block holding the requested offset. Wrap in io.BufferedReader for small
+    reads and readline().
+    """
+    def __init__(self, fp, threads=1):
+        super().__init__()
+        self.fp = fp
+        self.threads = threads
+        self.file = open(fp, 'rb')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.compressed_offsets, self.uncompressed_offsets = read_block_index(fp)
+        self.next_block = 0
+        self.data = b''
+        self.data_position = 0
+        # uncompressed offset of self.data
+        self.data_offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.data_offset + self.data_position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.tell()
+        elif whence != io.SEEK_SET:
+            raise PipelineException('BGZF files can only be seeked from the start or the current position')
+        block = max(0, int(np.searchsorted(self.uncompressed_offsets, offset, side='right')) - 1)
+        if block < len(self.uncompressed_offsets):
+            self.data_offset = int(self.uncompressed_offsets[block])
+        self.next_block = block
+        self.data = b''
+        self.data_position = 0
+        self.read_blocks()
+        self.data_position = min(offset - self.data_offset, len(self.data))
+        return self.tell()
+
+    def read_blocks(self):
+        # decompress the next group of blocks into self.data
+        self.data_offset += len(self.data)
+        self.data_position = 0
+        first = self.next_block
+        last = min(first + BLOCKS_PER_THREAD * self.threads, len(self.compressed_offsets))
+        if first >= last:
+            self.data = b''
+            return
+        end = int(self.compressed_offsets[last]) if last < len(self.compressed_offsets) else None
+        self.file.seek(int(self.compressed_offsets[first]))
+        compressed = self.file.read() if end is None else self.file.read(end - int(self.compressed_offsets[first]))
+        block_starts = (self.compressed_offsets[first:last] - self.compressed_offsets[first]).tolist()
+        with memoryview(compressed) as view:
+            # each block is cut to its own size to leave out empty blocks, such as the end-of-file block
+            blocks = [view[s:s + get_block_size(view[s:s + HEADER_SIZE])] for s in block_starts]
+            if self.executor is None:
+                self.data = b''.join(decompress_block(block) for block in blocks)
+            else:
+                self.data = b''.join(self.executor.map(decompress_block, blocks))
+        self.next_block = last
+
+    def readinto(self, buffer):
+        if self.data_position >= len(self.data):
+            self.read_blocks()
+        size = min(len(buffer), len(self.data) - self.data_position)
+        buffer[:size] = self.data[self.data_position:self.data_position + size]
+        self.data_position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+        super().close()
+
+
+def open_bgzf(fp, mode='rb', threads=1, compresslevel=6, buffer_size=io.DEFAULT_BUFFER_SIZE):
+    if mode == 'rb':
+        return io.BufferedReader(BgzfReader(fp, threads=threads), buffer_size=buffer_size)
+    elif mode == 'wb':
+        return BgzfWriter(fp, threads=threads, compresslevel=compresslevel)
+    else:
+        raise PipelineException('BGZF files are opened with mode "rb" or "wb", not "{}"'.format(mode))
+
+
+def compress_files(file_list, threads=1, compresslevel=6):
+    """
+    Like pipeline_util.gzip_files but writes BGZF files.
+    """
+    log = logging.getLogger(name=__name__)
+    for fp in file_list:
+        log.info('compressing file "%s" to BGZF with %d thread(s)', fp, threads)
+        with trace.span('bgzf', 'compression', file=os.path.basename(fp), threads=threads), \
+                open(fp, 'rb') as src, BgzfWriter(fp + '.gz', threads=threads, compresslevel=compresslevel) as dst:
+            shutil.copyfileobj(fsrc=src, fdst=dst, length=BLOCK_DATA_SIZE * BLOCKS_PER_THREAD)
+        os.remove(fp)
+
+
+def decompress_files(*fp_list, target_dir, threads=1):
+    """
+    Like pipeline_util.ungzip_files but decompresses BGZF files in parallel. Other
+    gzip files are decompressed as usual.
+    """
+    uncompressed_fps = []
+    for fp in fp_list:
+        # remove '.gz' from the file path
+        uncompressed_fp = os.path.join(target_dir, os.path.basename(fp)[:-3])
+        uncompressed_fps.append(uncompressed_fp)
+        if is_bgzf(fp):
+            src = BgzfReader(fp, threads=threads)
+        else:
+            src = gzip.open(fp, 'rb')
+        with trace.span('bgzf_decompress', 'compression', file=os.path.basename(fp), threads=threads), \
+                src, open(uncompressed_fp, 'wb') as dst:
+            shutil.copyfileobj(fsrc=src, fdst=dst, length=BLOCK_DATA_SIZE * BLOCKS_PER_THREAD)
+    return uncompressed_fps
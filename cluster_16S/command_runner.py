@@ -0,0 +1,215 @@
+"""
+Asyncio-based execution of external commands.
+
+run_command() starts one child process, streams its combined stdout and stderr into a
+per-command log and raises PipelineException with the exit code and the end of the
+log if the command fails or runs longer than its timeout.
+
+A CommandRunner runs batches of commands concurrently on one event loop in a
+background thread. Each command holds some number of cores while it runs and the
+total never exceeds the runner's core count, so one CommandRunner can be shared by
+every step (and every pipeline) in a process. With a memory limit no command or
+function is started while the memory in use is over it (see memory).
+
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+
+from cluster_16S import trace
+from cluster_16S.memory import MemoryMonitor
+from cluster_16S.pipeline_util import PipelineException
+
+
+LOG_TAIL_LINE_COUNT = 20
+
+_log_append_lock = threading.Lock()
+
+
+class Command:
+    def __init__(self, cmd_line_list, log_file, timeout=None, cores=1, **kwargs):
+        self.cmd_line_list = [str(x) for x in cmd_line_list]
+        self.log_file = log_file
+        self.timeout = timeout
+        self.cores = cores
+        # the process id, once the command has started
+        self.pid = None
+        # passed to asyncio.create_subprocess_exec, e.g. cwd or env
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return ' '.join(self.cmd_line_list)
+
+
+async def run_command(command):
+    log = logging.getLogger(name=__name__)
+    log.info('executing "%s"', command)
+
+    # the child writes to its own log, which is appended to the shared log when it is done
+    log_dir, log_name = os.path.split(command.log_file)
+    command_log_fp = os.path.join(log_dir, '.{}.{}'.format(log_name, uuid.uuid4().hex))
+    log_tail = collections.deque(maxlen=LOG_TAIL_LINE_COUNT)
+    returncode = None
+    start = trace.now()
+    try:
+        with open(command_log_fp, 'wb') as command_log:
+            command_log.write('executing "{}"\n'.format(command).encode())
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command.cmd_line_list,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    **command.kwargs)
+            except OSError as e:
+                raise PipelineException('failed to start "{}": {}'.format(command, e))
+            command.pid = process.pid
+
+            try:
+                returncode = await asyncio.wait_for(
+                    stream_output(process=process, command_log=command_log, log_tail=log_tail),
+                    timeout=command.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise PipelineException(
+                    '"{}" timed out after {} seconds, end of log:\n{}'.format(
+                        command, command.timeout, ''.join(log_tail)))
+    finally:
+        append_log(command_log_fp=command_log_fp, log_file=command.log_file)
+        if command.pid is not None:
+            # each child process gets its own lane
+            executable = os.path.basename(command.cmd_line_list[0])
+            trace.add_span(
+                executable, 'subprocess', start, pid=command.pid, tid=command.pid,
+                lane_name='{} {}'.format(executable, command.pid), command=str(command), returncode=returncode)
+
+    if returncode != 0:
+        raise PipelineException(
+            '"{}" failed with exit code {}, end of log:\n{}'.format(command, returncode, ''.join(log_tail)))
+    log.info('finished "%s"', command)
+    return subprocess.CompletedProcess(args=command.cmd_line_list, returncode=returncode)
+
+
+async def stream_output(process, command_log, log_tail):
+    while True:
+        line = await process.stdout.readline()
+        if len(line) == 0:
+            break
+        command_log.write(line)
+        log_tail.append(line.decode(errors='replace'))
+    return await process.wait()
+
+
+def append_log(command_log_fp, log_file):
+    if os.path.exists(command_log_fp):
+        with _log_append_lock:
+            with open(command_log_fp, 'rb') as src, open(log_file, 'ab') as dst:
+                shutil.copyfileobj(fsrc=src, fdst=dst)
+        os.remove(command_log_fp)
+
+
+def run_cmd(cmd_line_list, log_file, timeout=None, **kwargs):
+    """
+    Run one command in the calling thread and wait for it to finish.
+    """
+    return asyncio.run(run_command(Command(cmd_line_list, log_file=log_file, timeout=timeout, **kwargs)))
+
+
+class CommandRunner:
+    def __init__(self, core_count, default_timeout=None, memory_limit=None):
+        self.core_count = core_count
+        self.default_timeout = default_timeout
+        self.memory_monitor = MemoryMonitor(memory_limit=memory_limit)
+
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self._cores_available = core_count
+        self._cores_condition = None
+        # functions run by run_functions() hold cores so core_count workers are enough
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, core_count), thread_name_prefix='command_runner')
+
+    def get_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                self.memory_monitor.start()
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='command_runner_loop', daemon=True).start()
+            return self._loop
+
+    def run_batch(self, coroutines):
+        """
+        Run coroutines concurrently on the runner's event loop and wait for all of
+        them. The first exception is raised after every coroutine has finished.
+        """
+        return asyncio.run_coroutine_threadsafe(self._gather(coroutines), self.get_loop()).result()
+
+    def run_commands(self, commands):
+        return self.run_batch([self.run_command(command) for command in commands])
+
+    def run_functions(self, functions, cores=1):
+        """
+        Run Python functions in worker threads, each holding cores while it runs.
+        """
+        return self.run_batch([self.run_function(function, cores=cores) for function in functions])
+
+    async def _gather(self, coroutines):
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def run_command(self, command):
+        if command.timeout is None:
+            command.timeout = self.default_timeout
+        async with self.cores(command.cores):
+            return await run_command(command)
+
+    @contextlib.asynccontextmanager
+    async def cores(self, core_count):
+        """
+        Hold core_count cores, waiting until that many are free.
+        """
+        core_count = max(1, min(core_count, self.core_count))
+        await self.wait_for_memory()
+        if self._cores_condition is None:
+            self._cores_condition = asyncio.Condition()
+        async with self._cores_condition:
+            await self._cores_condition.wait_for(lambda: self._cores_available >= core_count)
+            self._cores_available -= core_count
+        try:
+            yield core_count
+        finally:
+            async with self._cores_condition:
+                self._cores_available += core_count
+                self._cores_condition.notify_all()
+
+    async def wait_for_memory(self):
+        # over the memory limit nothing new starts until running work frees memory, unless nothing is running
+        waiting = False
+        while self.memory_monitor.over_limit() and self._cores_available < self.core_count:
+            if not waiting:
+                logging.getLogger(name=__name__).warning(
+                    '%d MB in use, over the memory limit of %d MB, waiting for running work to finish',
+                    self.memory_monitor.rss // 2 ** 20, self.memory_monitor.memory_limit // 2 ** 20)
+                waiting = True
+            await asyncio.sleep(self.memory_monitor.interval)
+
+    async def run_function(self, function, cores=1):
+        async with self.cores(cores):
+            return await self.run_in_thread(function)
+
+    async def run_in_thread(self, function):
+        # in the context of the caller, so the function's spans go to the caller's trace
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(contextvars.copy_context().run, function))
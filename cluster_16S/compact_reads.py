@@ -0,0 +1,216 @@
+"""
+Compact encoding of intermediate FASTQ files.
+
+With compact read ids step 01 replaces each read header with the number of its
+sample and the number of the read in its file, '<sample>_<read>' (1_1, 1_2, ...),
+and writes the original headers, one line per read in read order after a
+'#sample <sample>' line, to a names file in the read_names directory of the step.
+The forward and reverse files of a pair have the same sample number and hold their
+reads in the same order, so both reads of a pair get the same id, as cutadapt and
+pear expect, and the merged reads of step 03 and every later step keep the ids of
+the forward reads. Ids are unique in the run, so the combined reads of step 05 and
+the files made from them can be restored too. restore_read_names() puts the original
+names back into any FASTQ or FASTA file whose labels start with a read id, given the
+read_names directory or, for the reads of one file, its names file.
+
+With quality binning the Phred scores are reduced to the 8 levels of Illumina
+binning before the reads reach the quality filter of step 04.
+
+Either one makes the intermediate files of steps 01 to 05 smaller and faster to
+compress, write and parse.
+
+"""
+import argparse
+import glob
+import logging
+import os
+import re
+
+import numpy as np
+
+from cluster_16S.seqio import NEWLINE, FastqBatch, format_fasta_record, format_fastq_record, get_line_offsets, \
+    open_sequence_file, read_fasta_batches, read_fastq_batches
+from cluster_16S.pipeline_util import PipelineException
+
+
+READ_NAMES_DIR_NAME = 'read_names'
+PHRED_OFFSET = 33
+
+# (lowest score, highest score, binned score)
+ILLUMINA_8_LEVEL_BINS = (
+    (0, 2, 2),
+    (3, 9, 6),
+    (10, 19, 15),
+    (20, 24, 22),
+    (25, 29, 27),
+    (30, 34, 33),
+    (35, 39, 37),
+    (40, 93, 40),
+)
+
+SAMPLE_LINE_PREFIX = b'#sample '
+
+read_id_pattern = re.compile(rb'^(\d+)_(\d+)(.*)$', flags=re.DOTALL)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(
+        description='restore the original read names of a FASTQ or FASTA file written with --compact-read-ids')
+    arg_parser.add_argument('input_fp', help='FASTQ or FASTA file with read ids')
+    arg_parser.add_argument(
+        'read_names_fp',
+        help='read_names directory of step 01, or the names file of the input file the reads are from')
+    arg_parser.add_argument('output_fp', help='FASTQ or FASTA file to write')
+    args = arg_parser.parse_args()
+    restore_read_names(args.input_fp, args.read_names_fp, args.output_fp)
+
+
+def get_quality_bin_table(bins=ILLUMINA_8_LEVEL_BINS, phred_offset=PHRED_OFFSET):
+    # a bytes.translate() table for quality strings
+    table = bytearray(range(256))
+    for low, high, binned in bins:
+        table[phred_offset + low:phred_offset + high + 1] = bytes([phred_offset + binned]) * (high - low + 1)
+    return bytes(table)
+
+
+def get_sample_numbers(fastq_fps):
+    """
+    Return {fastq_fp: sample number}, numbering the pairs of files from 1 in the order
+    of their forward file names. Both files of a pair get the number of the pair.
+    """
+    forward_names = {
+        fastq_fp: re.sub(
+            string=os.path.basename(fastq_fp), pattern=r'_([0R])2', repl=lambda m: '_{}1'.format(m.group(1)))
+        for fastq_fp
+        in fastq_fps
+    }
+    numbers = {forward_name: i for i, forward_name in enumerate(sorted(set(forward_names.values())), start=1)}
+    return {fastq_fp: numbers[forward_name] for fastq_fp, forward_name in forward_names.items()}
+
+
+def get_read_names_fp(fastq_fp):
+    output_dir, fastq_name = os.path.split(fastq_fp)
+    return os.path.join(output_dir, READ_NAMES_DIR_NAME, re.sub(r'\.gz$', '', fastq_name) + '.names.gz')
+
+
+class CompactReadEncoder:
+    """
+    Re-encode the batches of one FASTQ file of sample sample_number, writing the
+    original headers to names_file if it is given and binning qualities with
+    quality_bin_table if it is given.
+    """
+    def __init__(self, names_file=None, quality_bin_table=None, sample_number=1):
+        self.names_file = names_file
+        self.quality_bin_table = quality_bin_table
+        self.sample_number = sample_number
+        self.read_count = 0
+        if self.names_file is not None:
+            self.names_file.write(SAMPLE_LINE_PREFIX + b'%d\n' % sample_number)
+
+    def encode(self, fastq_batch):
+        headers = fastq_batch.headers()
+        qualities = fastq_batch.qualities()
+        if self.quality_bin_table is not None:
+            qualities = [quality.translate(self.quality_bin_table) for quality in qualities]
+        if self.names_file is not None:
+            self.names_file.write(b'\n'.join(headers) + b'\n')
+            headers = [
+                b'%d_%d' % (self.sample_number, read_id)
+                for read_id
+                in range(self.read_count + 1, self.read_count + len(headers) + 1)
+            ]
+        self.read_count += len(headers)
+        buffer = b''.join(map(format_fastq_record, headers, fastq_batch.sequences(), qualities))
+        return FastqBatch(buffer, np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == NEWLINE))
+
+
+def read_sample_number(read_names_file, read_names_fp):
+    # the number of the sample on the first line of a names file
+    sample_line = read_names_file.readline()
+    if not sample_line.startswith(SAMPLE_LINE_PREFIX):
+        raise PipelineException('"{}" is not a read names file'.format(read_names_fp))
+    return int(sample_line[len(SAMPLE_LINE_PREFIX):])
+
+
+class ReadNames:
+    """
+    The original read names of a names file, looked up by read id without making a
+    bytes object per name.
+    """
+    def __init__(self, read_names_fp):
+        with open_sequence_file(read_names_fp, 'rb') as read_names_file:
+            self.sample_number = read_sample_number(read_names_file, read_names_fp)
+            self.buffer = read_names_file.read()
+        self.starts, self.ends = get_line_offsets(
+            self.buffer, np.flatnonzero(np.frombuffer(self.buffer, dtype=np.uint8) == NEWLINE))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def get_name(self, read_number):
+        # None if there is no such read
+        if not 1 <= read_number <= len(self.starts):
+            return None
+        return self.buffer[self.starts[read_number - 1]:self.ends[read_number - 1]]
+
+
+class RunReadNames:
+    """
+    The original read names of every sample of a run, from the forward names files
+    in a read_names directory or from one names file. A names file is read when the
+    first id of its sample is looked up.
+    """
+    def __init__(self, read_names_fp):
+        if os.path.isdir(read_names_fp):
+            read_names_fps = glob.glob(os.path.join(read_names_fp, '*_[R0]1*.names.gz'))
+        else:
+            read_names_fps = [read_names_fp]
+        self.read_names_fps = {}
+        for fp in read_names_fps:
+            with open_sequence_file(fp, 'rb') as read_names_file:
+                self.read_names_fps[read_sample_number(read_names_file, fp)] = fp
+        self.read_names = {}
+        self.unrestored_count = 0
+
+    def restore(self, label):
+        # b'3_12;size=3;' -> b'<name of read 12 of sample 3>;size=3;', labels without a known read id are left alone
+        m = read_id_pattern.match(label)
+        name = None
+        if m is not None:
+            sample_number = int(m.group(1))
+            if sample_number not in self.read_names and sample_number in self.read_names_fps:
+                self.read_names[sample_number] = ReadNames(self.read_names_fps[sample_number])
+            if sample_number in self.read_names:
+                name = self.read_names[sample_number].get_name(int(m.group(2)))
+        if name is None:
+            self.unrestored_count += 1
+            return label
+        return name + m.group(3)
+
+
+def restore_read_names(input_fp, read_names_fp, output_fp):
+    """
+    Copy a FASTQ or FASTA file, replacing the read id at the start of each header
+    with the original read name. read_names_fp is the read_names directory of step
+    01 or one names file; labels that are not read ids of its samples are copied
+    unchanged.
+    """
+    log = logging.getLogger(name=__name__)
+    read_names = RunReadNames(read_names_fp)
+    is_fastq = re.search(r'\.f(ast)?q(\.gz)?$', input_fp) is not None
+    with open_sequence_file(output_fp, 'wb') as output_file:
+        if is_fastq:
+            for fastq_batch in read_fastq_batches(input_fp):
+                output_file.write(b''.join(map(
+                    format_fastq_record,
+                    map(read_names.restore, fastq_batch.headers()), fastq_batch.sequences(), fastq_batch.qualities())))
+        else:
+            for fasta_batch in read_fasta_batches(input_fp):
+                output_file.write(b''.join(map(
+                    format_fasta_record, map(read_names.restore, fasta_batch.headers()), fasta_batch.sequences())))
+    log.info('restored read names of "%s" from "%s" in "%s"', input_fp, read_names_fp, output_fp)
+    if read_names.unrestored_count > 0:
+        log.warning(
+            '%d label(s) of "%s" are not read ids of "%s" and were not restored',
+            read_names.unrestored_count, input_fp, read_names_fp)
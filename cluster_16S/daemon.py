@@ -0,0 +1,388 @@
+"""
+A long-lived pipeline process that runs jobs submitted through a spool directory.
+
+Starting the pipeline for each of many small runs costs interpreter start-up and
+loading the same references again and again. The daemon stays up on a node and runs
+every job it is given in one process, on one JobScheduler and one
+batch.ReferenceCache that live as long as the daemon, so OTU sequence indexes are
+loaded once for all jobs that use them.
+
+The spool directory holds:
+
+    queue/<job id>.json                 jobs waiting to run, written by submit_job()
+    running/<job id>@<host>@<pid>.json  jobs claimed by the daemon with that host and pid
+    status/<job id>.json                the state of each job: queued, running, succeeded or failed
+    daemon.json                         the pid, host and core count of the running daemon
+    stop                                created by request_stop(), the daemon stops when its jobs finish
+
+A job is a name and the settings of a run, keyed like the projects of a batch
+manifest. The daemon claims a job by renaming it from queue to running, so a job is
+run once. One daemon serves a spool directory: a daemon does not start while
+daemon.json names a process that is still running. Jobs left in running by a daemon
+that died are queued again when a daemon starts, and resume from the step ledgers of
+their work directories. Jobs of a daemon on another host are left alone, since the
+daemon can not be seen from here.
+
+    pipeline_daemon serve /spool -c 32
+    pipeline_daemon submit /spool --wait -- -i data -w work --cutadapt-min-length 100 ...
+
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+from cluster_16S.batch import ReferenceCache, get_project_args
+from cluster_16S.memory import parse_memory_size
+from cluster_16S.pipeline import Pipeline, get_args, run_pipeline
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.scheduler import JobScheduler
+
+
+QUEUE_DIR_NAME = 'queue'
+RUNNING_DIR_NAME = 'running'
+STATUS_DIR_NAME = 'status'
+DAEMON_FILE_NAME = 'daemon.json'
+STOP_FILE_NAME = 'stop'
+
+FINISHED_STATES = ('succeeded', 'failed')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args, pipeline_argv = get_daemon_args()
+    if args.command == 'serve':
+        PipelineDaemon(
+            spool_dir=args.spool_dir,
+            core_count=args.core_count,
+            max_concurrent_jobs=args.max_concurrent_jobs,
+            command_timeout=args.command_timeout,
+            memory_limit=args.memory_limit,
+            poll_interval=args.poll_interval).serve()
+        return 0
+    elif args.command == 'stop':
+        request_stop(args.spool_dir)
+        return 0
+    elif args.command == 'submit':
+        job_ids = [submit_job(args.spool_dir, get_job_settings(pipeline_argv), name=args.name)]
+        print(job_ids[0])
+        if not args.wait:
+            return 0
+    else:
+        job_ids = args.job_ids
+    if args.command == 'status':
+        statuses = [read_job_status(args.spool_dir, job_id) for job_id in job_ids or get_job_ids(args.spool_dir)]
+    else:
+        statuses = wait_for_jobs(args.spool_dir, job_ids, poll_interval=args.poll_interval, timeout=args.timeout)
+    for status in statuses:
+        print('\t'.join((status['job_id'], status['name'], status['state'], status.get('error') or '')))
+    return 1 if any(status['state'] == 'failed' for status in statuses) else 0
+
+
+def get_daemon_args(argv=None):
+    """
+    Return (arguments, pipeline arguments of a submitted job).
+    """
+    arg_parser = argparse.ArgumentParser(description='run pipeline jobs from a spool directory')
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser(
+        'serve', allow_abbrev=False, help='run jobs submitted to the spool directory until stopped')
+    serve_parser.add_argument('-c', '--core-count', default=1, type=int,
+                              help='number of cores shared by all jobs, also the core count of jobs without one')
+    serve_parser.add_argument('--max-concurrent-jobs', default=None, type=int,
+                              help='run at most this many jobs at once, by default one per core')
+    serve_parser.add_argument('--command-timeout', default=None, type=float,
+                              help='seconds after which an external command is stopped and its job fails')
+    serve_parser.add_argument('--memory-limit', default=None, type=parse_memory_size,
+                              help='start no more jobs while the daemon and its jobs use more memory than this, '
+                                   'e.g. 64G')
+
+    submit_parser = subparsers.add_parser(
+        'submit', allow_abbrev=False,
+        help='submit a job, the arguments after the spool directory are those of the pipeline')
+    submit_parser.add_argument('--name', default=None,
+                               help='job name, by default the work directory name')
+    submit_parser.add_argument('--wait', action='store_true', default=False,
+                               help='wait for the job to finish, the exit status is 1 if it failed')
+
+    wait_parser = subparsers.add_parser(
+        'wait', allow_abbrev=False, help='wait for jobs to finish, the exit status is 1 if one failed')
+    wait_parser.add_argument('job_ids', nargs='+')
+
+    status_parser = subparsers.add_parser(
+        'status', allow_abbrev=False, help='print the state of jobs, by default of all jobs')
+    status_parser.add_argument('job_ids', nargs='*')
+
+    subparsers.add_parser('stop', allow_abbrev=False, help='stop the daemon when its running jobs are finished')
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('spool_dir', help='spool directory of the daemon')
+        subparser.add_argument('--poll-interval', default=2.0, type=float,
+                               help='seconds between looks at the spool directory')
+        subparser.add_argument('--timeout', default=None, type=float,
+                               help='seconds to wait for jobs before giving up')
+    args, pipeline_argv = arg_parser.parse_known_args(argv)
+    if args.command != 'submit' and len(pipeline_argv) > 0:
+        arg_parser.error('unrecognized arguments: {}'.format(' '.join(pipeline_argv)))
+    return args, [a for a in pipeline_argv if a != '--']
+
+
+def get_job_settings(pipeline_argv):
+    """
+    Return the settings of a job given its pipeline arguments, checked here so a bad
+    command line fails before it is queued. Paths are made absolute since the daemon
+    has its own working directory. A job without a core count gets the daemon's.
+    """
+    settings = dict(get_args(pipeline_argv).__dict__)
+    for key, value in settings.items():
+        if isinstance(value, str) and (key.endswith('_dir') or key.endswith('_fp')):
+            settings[key] = os.path.abspath(value)
+    if not any(a in ('-c', '--core-count') or a.startswith('--core-count=') for a in pipeline_argv):
+        settings.pop('core_count')
+    return settings
+
+
+def get_spool_fp(spool_dir, dir_name, job_id):
+    return os.path.join(spool_dir, dir_name, job_id + '.json')
+
+
+def get_running_fp(spool_dir, job_id, host, pid):
+    # the owner is in the name, so a job is claimed and its owner recorded by one rename
+    return os.path.join(spool_dir, RUNNING_DIR_NAME, '{}@{}@{}.json'.format(job_id, host, pid))
+
+
+def parse_running_name(name):
+    """
+    Return (job id, host, pid) of the owner of a job in the running directory, or
+    None if name is not a running job.
+    """
+    if not name.endswith('.json'):
+        return None
+    fields = name[:-len('.json')].rsplit('@', 2)
+    if len(fields) != 3 or not fields[2].isdigit():
+        return None
+    return fields[0], fields[1], int(fields[2])
+
+
+def process_is_alive(host, pid):
+    # a process on another host can not be seen from here, so it is taken to be alive
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # a process of another user
+        return True
+    return True
+
+
+def write_json(fp, data):
+    # written in full before it appears under its name
+    tmp_fp = '{}.{}.tmp'.format(fp, os.getpid())
+    with open(tmp_fp, 'wt') as tmp_file:
+        json.dump(data, tmp_file, indent=2)
+    os.replace(tmp_fp, fp)
+
+
+def read_json(fp):
+    with open(fp, 'rt') as json_file:
+        return json.load(json_file)
+
+
+def create_spool_dir(spool_dir):
+    for dir_name in (QUEUE_DIR_NAME, RUNNING_DIR_NAME, STATUS_DIR_NAME):
+        os.makedirs(os.path.join(spool_dir, dir_name), exist_ok=True)
+
+
+def submit_job(spool_dir, settings, name=None):
+    """
+    Queue a job with the given settings and return its id. Job ids sort in the order
+    the jobs were submitted.
+    """
+    create_spool_dir(spool_dir)
+    job_id = '{}-{}'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'), uuid.uuid4().hex[:8])
+    if name is None:
+        name = os.path.basename(os.path.normpath(settings.get('work_dir', job_id)))
+    job = {'job_id': job_id, 'name': name, 'settings': settings}
+    write_json(get_spool_fp(spool_dir, STATUS_DIR_NAME, job_id), get_job_status(job, 'queued'))
+    write_json(get_spool_fp(spool_dir, QUEUE_DIR_NAME, job_id), job)
+    logging.getLogger(name=__name__).info('submitted job "%s" (%s) to "%s"', name, job_id, spool_dir)
+    return job_id
+
+
+def get_job_status(job, state, **fields):
+    return dict({'job_id': job['job_id'], 'name': job['name'], 'state': state, 'time': time.time()}, **fields)
+
+
+def get_job_ids(spool_dir):
+    status_dir = os.path.join(spool_dir, STATUS_DIR_NAME)
+    return sorted(name[:-len('.json')] for name in os.listdir(status_dir) if name.endswith('.json'))
+
+
+def read_job_status(spool_dir, job_id):
+    try:
+        return read_json(get_spool_fp(spool_dir, STATUS_DIR_NAME, job_id))
+    except FileNotFoundError:
+        raise PipelineException('there is no job "{}" in "{}"'.format(job_id, spool_dir))
+
+
+def wait_for_jobs(spool_dir, job_ids, poll_interval=2.0, timeout=None):
+    """
+    Return the statuses of the jobs once all of them have succeeded or failed.
+    """
+    start_time = time.time()
+    while True:
+        statuses = [read_job_status(spool_dir, job_id) for job_id in job_ids]
+        if all(status['state'] in FINISHED_STATES for status in statuses):
+            return statuses
+        if timeout is not None and time.time() - start_time > timeout:
+            raise PipelineException('jobs in "{}" did not finish in {} seconds'.format(spool_dir, timeout))
+        time.sleep(poll_interval)
+
+
+def request_stop(spool_dir):
+    with open(os.path.join(spool_dir, STOP_FILE_NAME), 'wt'):
+        pass
+
+
+class PipelineDaemon:
+    def __init__(self, spool_dir, core_count, max_concurrent_jobs=None, command_timeout=None, memory_limit=None,
+                 poll_interval=2.0):
+        self.spool_dir = spool_dir
+        self.core_count = core_count
+        self.max_concurrent_jobs = max_concurrent_jobs or core_count
+        self.poll_interval = poll_interval
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        # warm for the life of the daemon
+        self.job_scheduler = JobScheduler(
+            core_count=core_count, command_timeout=command_timeout, memory_limit=memory_limit)
+        self.reference_cache = ReferenceCache()
+
+    def serve(self):
+        """
+        Run queued jobs until request_stop() is called, then wait for the running
+        jobs and return.
+        """
+        log = logging.getLogger(name=__name__)
+        create_spool_dir(self.spool_dir)
+        self.register()
+        try:
+            stop_fp = os.path.join(self.spool_dir, STOP_FILE_NAME)
+            if os.path.exists(stop_fp):
+                os.remove(stop_fp)
+            self.requeue_running_jobs()
+            log.info('serving jobs from "%s" with %d cores', self.spool_dir, self.core_count)
+
+            futures = set()
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_concurrent_jobs, thread_name_prefix='job') as executor:
+                while not os.path.exists(stop_fp):
+                    futures = {future for future in futures if not future.done()}
+                    # claim only as many jobs as can start, the rest stay queued
+                    for job in self.claim_jobs(self.max_concurrent_jobs - len(futures)):
+                        futures.add(executor.submit(self.run_job, job))
+                    time.sleep(self.poll_interval)
+                log.info('stopping, waiting for %d running job(s)', len(futures))
+            os.remove(stop_fp)
+        finally:
+            os.remove(os.path.join(self.spool_dir, DAEMON_FILE_NAME))
+
+    def register(self):
+        """
+        Write daemon.json, or raise PipelineException if it names a daemon that is
+        still running. daemon.json is linked from a complete file, so of two daemons
+        starting at once one fails.
+        """
+        daemon_fp = os.path.join(self.spool_dir, DAEMON_FILE_NAME)
+        tmp_fp = '{}.{}.tmp'.format(daemon_fp, self.pid)
+        write_json(tmp_fp, {'pid': self.pid, 'host': self.host, 'core_count': self.core_count, 'started': time.time()})
+        try:
+            while True:
+                try:
+                    os.link(tmp_fp, daemon_fp)
+                    return
+                except FileExistsError:
+                    pass
+                try:
+                    other_daemon = read_json(daemon_fp)
+                except FileNotFoundError:
+                    # the other daemon has just stopped
+                    continue
+                if process_is_alive(other_daemon['host'], other_daemon['pid']):
+                    raise PipelineException(
+                        'a daemon (pid {} on host {}) is serving "{}", remove "{}" if it is not running'.format(
+                            other_daemon['pid'], other_daemon['host'], self.spool_dir, daemon_fp))
+                logging.getLogger(name=__name__).warning(
+                    'replacing "%s" of daemon pid %d, which is not running', daemon_fp, other_daemon['pid'])
+                os.remove(daemon_fp)
+        finally:
+            os.remove(tmp_fp)
+
+    def requeue_running_jobs(self):
+        # jobs claimed by a daemon that died before it finished them
+        log = logging.getLogger(name=__name__)
+        for name in os.listdir(os.path.join(self.spool_dir, RUNNING_DIR_NAME)):
+            running_job = parse_running_name(name)
+            if running_job is None:
+                continue
+            job_id, host, pid = running_job
+            if process_is_alive(host, pid):
+                log.info('job "%s" is run by pid %d on host %s, leaving it', job_id, pid, host)
+                continue
+            log.warning('queueing unfinished job "%s" of pid %d on host %s again', job_id, pid, host)
+            os.replace(
+                os.path.join(self.spool_dir, RUNNING_DIR_NAME, name),
+                get_spool_fp(self.spool_dir, QUEUE_DIR_NAME, job_id))
+
+    def claim_jobs(self, max_job_count):
+        jobs = []
+        for name in sorted(os.listdir(os.path.join(self.spool_dir, QUEUE_DIR_NAME))):
+            if len(jobs) >= max_job_count:
+                break
+            if not name.endswith('.json'):
+                continue
+            running_fp = get_running_fp(self.spool_dir, name[:-len('.json')], self.host, self.pid)
+            try:
+                os.rename(os.path.join(self.spool_dir, QUEUE_DIR_NAME, name), running_fp)
+            except FileNotFoundError:
+                # removed from the queue since it was listed
+                continue
+            jobs.append(read_json(running_fp))
+        return jobs
+
+    def run_job(self, job):
+        log = logging.getLogger(name=__name__)
+        status_fp = get_spool_fp(self.spool_dir, STATUS_DIR_NAME, job['job_id'])
+        started = time.time()
+        write_json(status_fp, get_job_status(job, 'running', started=started, host=self.host, pid=self.pid))
+        log.info('starting job "%s" (%s)', job['name'], job['job_id'])
+        try:
+            args = get_project_args(
+                dict({'core_count': self.core_count}, **job['settings']),
+                description='job "{}"'.format(job['job_id']))
+            os.makedirs(args.work_dir, exist_ok=True)
+            pipeline = Pipeline(**dict(
+                args.__dict__, job_scheduler=self.job_scheduler, reference_cache=self.reference_cache))
+            output_dir_list = run_pipeline(pipeline, args)
+        except BaseException as e:
+            log.exception('job "%s" (%s) failed', job['name'], job['job_id'])
+            status = get_job_status(job, 'failed', started=started, error=str(e) or type(e).__name__)
+        else:
+            log.info('finished job "%s" (%s)', job['name'], job['job_id'])
+            status = get_job_status(job, 'succeeded', started=started, output_dirs=output_dir_list)
+        write_json(status_fp, status)
+        os.remove(get_running_fp(self.spool_dir, job['job_id'], self.host, self.pid))
+        return status
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""
+K-mer index of a set of sequences, e.g. a reference database.
+
+For each k-mer the index holds the ids of the sequences containing it, in increasing
+order, as two numpy arrays: postings, one uint32 sequence id for each distinct k-mer
+of each sequence, and offsets, where postings[offsets[kmer]:offsets[kmer + 1]] are
+the sequences containing kmer.
+
+An index of a FASTA file is built once and saved as .npy files in a directory next
+to the file (or anywhere else). Opening it again maps the arrays into memory, so it
+takes no time, only the postings of the k-mers that are looked up are read from disk,
+and all processes on a node share one copy in the page cache. The pipeline opens the
+index of its chimera reference when a run starts, once for all runs that share a
+reference cache.
+
+top_hits() answers "which indexed sequences share the most k-mers with this query"
+for a batch of queries at once.
+
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.seqio import read_fasta_batches
+
+
+KMER_LENGTH = 8
+# the largest (queries x indexed sequences) array of shared k-mer counts made at once
+MAX_COUNT_ARRAY_SIZE = 4 * 1024 * 1024
+INDEX_FILE_NAME = 'kmer_index.json'
+
+# A, C, G, T (and U) as 0 to 3, anything else as 4
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for i, bases in enumerate((b'Aa', b'Cc', b'Gg', b'TtUu')):
+    BASE_CODES[list(bases)] = i
+
+
+def get_kmers(sequence, kmer_length=KMER_LENGTH):
+    """
+    Return the distinct k-mers of a sequence (bytes) as sorted int64 codes. K-mers
+    with a base other than A, C, G or T are left out.
+    """
+    codes = BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    if len(codes) < kmer_length:
+        return np.zeros(0, dtype=np.int64)
+    windows = sliding_window_view(codes, kmer_length)
+    kmers = windows.astype(np.int64) @ (4 ** np.arange(kmer_length - 1, -1, -1, dtype=np.int64))
+    return np.unique(kmers[windows.max(axis=1) < 4])
+
+
+def get_top_hits(shared_counts, n):
+    """
+    Return the ids of at most n sequences with shared_counts[id] > 0, most shared
+    k-mers first and lowest id first among equals.
+    """
+    hits = np.flatnonzero(shared_counts)
+    if len(hits) > n:
+        # only the hits with at least the n-th largest count can be in the top n
+        threshold = np.partition(shared_counts[hits], len(hits) - n)[len(hits) - n]
+        hits = hits[shared_counts[hits] >= threshold]
+    return hits[np.lexsort((hits, -shared_counts[hits]))][:n]
+
+
+def get_concatenated_ranges(starts, lengths):
+    # starts[0]:starts[0] + lengths[0], starts[1]:starts[1] + lengths[1], ... as one array
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+class KmerIndex:
+    def __init__(self, offsets, postings, sequence_count, kmer_length=KMER_LENGTH, labels=None):
+        if len(offsets) != 4 ** kmer_length + 1:
+            raise PipelineException('a k-mer index with k={} needs {} offsets, not {}'.format(
+                kmer_length, 4 ** kmer_length + 1, len(offsets)))
+        self.offsets = offsets
+        self.postings = postings
+        self.sequence_count = sequence_count
+        self.kmer_length = kmer_length
+        self.labels = labels
+
+    @classmethod
+    def from_kmer_arrays(cls, kmer_arrays, kmer_length=KMER_LENGTH, labels=None):
+        """
+        Build an index in memory from the k-mers (see get_kmers) of sequences 0, 1, 2, ...
+        """
+        lengths = np.fromiter((len(k) for k in kmer_arrays), dtype=np.int64, count=len(kmer_arrays))
+        kmers = np.concatenate(kmer_arrays) if len(kmer_arrays) > 0 else np.zeros(0, dtype=np.int64)
+        # a stable sort keeps the sequence ids of each k-mer in increasing order
+        order = np.argsort(kmers, kind='stable')
+        return cls(
+            offsets=np.searchsorted(kmers[order], np.arange(4 ** kmer_length + 1)),
+            postings=np.repeat(np.arange(len(kmer_arrays), dtype=np.uint32), lengths)[order],
+            sequence_count=len(kmer_arrays),
+            kmer_length=kmer_length,
+            labels=labels)
+
+    def get_shared_kmer_counts(self, kmer_arrays, max_postings=None):
+        """
+        Return a (queries x indexed sequences) array of the number of k-mers each query
+        shares with each indexed sequence. K-mers found in more than max_postings
+        indexed sequences, e.g. conserved regions, are not counted.
+        """
+        kmer_counts = np.fromiter((len(k) for k in kmer_arrays), dtype=np.int64, count=len(kmer_arrays))
+        kmers = np.concatenate(kmer_arrays) if len(kmer_arrays) > 0 else np.zeros(0, dtype=np.int64)
+        starts = self.offsets[kmers]
+        lengths = self.offsets[kmers + 1] - starts
+        if max_postings is not None:
+            lengths[lengths > max_postings] = 0
+        hit_ids = self.postings[get_concatenated_ranges(starts, lengths)].astype(np.int64)
+        hit_queries = np.repeat(np.repeat(np.arange(len(kmer_arrays), dtype=np.int64), kmer_counts), lengths)
+        return np.bincount(
+            hit_queries * self.sequence_count + hit_ids,
+            minlength=len(kmer_arrays) * self.sequence_count).reshape(len(kmer_arrays), self.sequence_count)
+
+    def top_hits(self, kmer_arrays, n, max_postings=None, return_counts=False):
+        """
+        Return, for each query given by its k-mers, the ids of at most n indexed sequences
+        sharing at least one k-mer with it, most shared k-mers first. With return_counts
+        each query gets (ids, shared k-mer counts).
+        """
+        hits = []
+        # queries are counted a few at a time to bound the size of the count array
+        chunk_size = max(1, MAX_COUNT_ARRAY_SIZE // max(1, self.sequence_count))
+        for chunk_start in range(0, len(kmer_arrays), chunk_size):
+            shared_counts = self.get_shared_kmer_counts(
+                kmer_arrays[chunk_start:chunk_start + chunk_size], max_postings=max_postings)
+            for query_shared_counts in shared_counts:
+                query_hits = get_top_hits(query_shared_counts, n)
+                hits.append((query_hits, query_shared_counts[query_hits]) if return_counts else query_hits)
+        return hits
+
+    def search(self, sequences, n, max_postings=None):
+        """
+        Return [(label, shared k-mer count), ...] of the top n indexed sequences for each
+        query sequence (bytes).
+        """
+        kmer_arrays = [get_kmers(sequence, self.kmer_length) for sequence in sequences]
+        return [
+            [(self.labels[h], c) for h, c in zip(hits.tolist(), shared_counts.tolist())]
+            for hits, shared_counts in self.top_hits(kmer_arrays, n, max_postings=max_postings, return_counts=True)
+        ]
+
+
+def get_kmer_index_dir(fasta_fp, kmer_length=KMER_LENGTH):
+    return '{}.k{}.kmer_index'.format(fasta_fp, kmer_length)
+
+
+def build_kmer_index(fasta_fp, index_dir, kmer_length=KMER_LENGTH):
+    """
+    Index the sequences of a FASTA file and save the index in index_dir. The postings
+    are written straight to a memory-mapped file, so memory use does not grow with
+    the size of the index. Processes building the same index at once each build their
+    own and one of them is kept.
+    """
+    log = logging.getLogger(name=__name__)
+    # count the sequences of each k-mer, then put each sequence id in place
+    labels = []
+    kmer_sequence_counts = np.zeros(4 ** kmer_length, dtype=np.int64)
+    for batch in read_fasta_batches(fasta_fp):
+        labels.extend(batch.labels())
+        for sequence in batch.sequences():
+            kmer_sequence_counts[get_kmers(sequence, kmer_length)] += 1
+    if len(labels) >= 2 ** 32:
+        raise PipelineException('"{}" has too many sequences for a k-mer index'.format(fasta_fp))
+    offsets = np.zeros(4 ** kmer_length + 1, dtype=np.int64)
+    np.cumsum(kmer_sequence_counts, out=offsets[1:])
+    log.info('indexing %d k-mers of %d sequences in "%s"', offsets[-1], len(labels), fasta_fp)
+
+    # a directory of this build's own, processes building the same index do not touch each other's
+    index_parent_dir = os.path.dirname(os.path.abspath(index_dir))
+    os.makedirs(index_parent_dir, exist_ok=True)
+    tmp_index_dir = tempfile.mkdtemp(prefix=os.path.basename(index_dir) + '.tmp.', dir=index_parent_dir)
+    np.save(os.path.join(tmp_index_dir, 'offsets.npy'), offsets)
+    postings = np.lib.format.open_memmap(
+        os.path.join(tmp_index_dir, 'postings.npy'), mode='w+', dtype=np.uint32, shape=(int(offsets[-1]), ))
+    next_positions = offsets[:-1].copy()
+    sequence_id = 0
+    for batch in read_fasta_batches(fasta_fp):
+        kmer_arrays = [get_kmers(sequence, kmer_length) for sequence in batch.sequences()]
+        lengths = np.fromiter((len(k) for k in kmer_arrays), dtype=np.int64, count=len(kmer_arrays))
+        kmers = np.concatenate(kmer_arrays)
+        sequence_ids = np.repeat(np.arange(sequence_id, sequence_id + len(kmer_arrays), dtype=np.uint32), lengths)
+        sequence_id += len(kmer_arrays)
+        order = np.argsort(kmers, kind='stable')
+        kmers = kmers[order]
+        # the position of each sequence id among the ids of its k-mer in this batch
+        ranks = np.arange(len(kmers)) - np.searchsorted(kmers, kmers)
+        postings[next_positions[kmers] + ranks] = sequence_ids[order]
+        next_positions += np.bincount(kmers, minlength=4 ** kmer_length)
+    postings.flush()
+    del postings
+
+    with open(os.path.join(tmp_index_dir, 'labels.txt'), 'wt') as labels_file:
+        labels_file.writelines(label + '\n' for label in labels)
+    with open(os.path.join(tmp_index_dir, INDEX_FILE_NAME), 'wt') as index_file:
+        json.dump({
+            'fasta_fp': os.path.abspath(fasta_fp),
+            'fasta_size': os.path.getsize(fasta_fp),
+            'fasta_mtime': os.path.getmtime(fasta_fp),
+            'kmer_length': kmer_length,
+            'sequence_count': len(labels)}, index_file)
+    while True:
+        if kmer_index_is_current(fasta_fp, index_dir, kmer_length=kmer_length):
+            # another process has put the same index in place
+            shutil.rmtree(tmp_index_dir)
+            return
+        try:
+            os.rename(tmp_index_dir, index_dir)
+            return
+        except OSError:
+            if not os.path.exists(index_dir):
+                shutil.rmtree(tmp_index_dir, ignore_errors=True)
+                raise
+        # an index of an older reference is in the way, it is moved aside in one rename and removed
+        old_index_parent_dir = tempfile.mkdtemp(prefix=os.path.basename(index_dir) + '.old.', dir=index_parent_dir)
+        try:
+            os.rename(index_dir, os.path.join(old_index_parent_dir, 'index'))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(old_index_parent_dir)
+
+
+def load_kmer_index(index_dir):
+    with open(os.path.join(index_dir, INDEX_FILE_NAME), 'rt') as index_file:
+        index_description = json.load(index_file)
+    with open(os.path.join(index_dir, 'labels.txt'), 'rt') as labels_file:
+        labels = labels_file.read().splitlines()
+    return KmerIndex(
+        offsets=np.load(os.path.join(index_dir, 'offsets.npy'), mmap_mode='r'),
+        postings=np.load(os.path.join(index_dir, 'postings.npy'), mmap_mode='r'),
+        sequence_count=len(labels),
+        kmer_length=index_description['kmer_length'],
+        labels=labels)
+
+
+def kmer_index_is_current(fasta_fp, index_dir, kmer_length=KMER_LENGTH):
+    try:
+        with open(os.path.join(index_dir, INDEX_FILE_NAME), 'rt') as index_file:
+            index_description = json.load(index_file)
+    except (OSError, ValueError):
+        return False
+    return (
+        index_description['kmer_length'] == kmer_length
+        and index_description['fasta_size'] == os.path.getsize(fasta_fp)
+        and index_description['fasta_mtime'] == os.path.getmtime(fasta_fp))
+
+
+def open_kmer_index(fasta_fp, index_dir=None, kmer_length=KMER_LENGTH):
+    """
+    Return the k-mer index of a FASTA file, building it first if there is no index
+    or the file has changed since it was built. By default the index is kept in a
+    directory next to the FASTA file.
+    """
+    if index_dir is None:
+        index_dir = get_kmer_index_dir(fasta_fp, kmer_length=kmer_length)
+    if not kmer_index_is_current(fasta_fp, index_dir, kmer_length=kmer_length):
+        build_kmer_index(fasta_fp, index_dir, kmer_length=kmer_length)
+    else:
+        logging.getLogger(name=__name__).info('using k-mer index "%s"', index_dir)
+    return load_kmer_index(index_dir)
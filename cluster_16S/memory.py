@@ -0,0 +1,205 @@
+"""
+Memory accounting and a memory limit for the pipeline and its child processes.
+
+A MemoryMonitor reads the resident memory (RSS) of the pipeline process and of every
+process below it from /proc every interval seconds, in a background thread. It keeps
+the peak of each open Measurement, one for each running step, and the peak of each
+child process with its own children. So the log and the step records in
+<work_dir>/.ledger/metrics.jsonl tell how much memory each step took, and the log
+tells how much the external command of each sample took. Without /proc only the
+pipeline process is measured, by its peak RSS from resource.getrusage.
+
+With a memory limit a CommandRunner starts no more commands or Python functions
+while the last sample is over the limit, unless nothing is running, so work waits
+for running jobs to free memory instead of the node running out of it. Running work
+is never stopped.
+
+With tracemalloc_top a Measurement also records the peak of the memory allocated by
+Python during the step and the lines that allocated the most memory still held when
+the step ended, for steps that work in the pipeline process such as step 05 or
+fasta_qual_to_fastq. tracemalloc makes Python code slower, so it is off by default.
+
+"""
+import collections
+import os
+import re
+import resource
+import threading
+import tracemalloc
+
+
+DEFAULT_INTERVAL = 1.0
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_memory_size(size):
+    # '512M', '64G', '1.5T' or a number of bytes; a ValueError like int() so argparse can report it
+    match = re.fullmatch(r'([0-9]+(?:\.[0-9]*)?)([KMGT]?)B?', size.strip().upper())
+    if match is None:
+        raise ValueError('can not read memory size "{}", expected e.g. "64G"'.format(size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def read_process_table(proc_dir='/proc'):
+    """
+    Return {pid: (parent pid, RSS in bytes)} of every process in proc_dir.
+    """
+    processes = {}
+    for entry in os.scandir(proc_dir):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, 'stat'), 'rb') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            # the process has ended
+            continue
+        # the fields after the command name, which is in parentheses and may contain anything
+        fields = stat[stat.rindex(b')') + 2:].split()
+        processes[int(entry.name)] = (int(fields[1]), int(fields[21]) * PAGE_SIZE)
+    return processes
+
+
+def get_tree_rss(processes, pid):
+    """
+    Return (RSS of pid and all processes below it, {child pid: RSS of the child and
+    all processes below it}) for the direct children of pid.
+    """
+    children = collections.defaultdict(list)
+    for child_pid, (parent_pid, _) in processes.items():
+        children[parent_pid].append(child_pid)
+
+    def get_subtree_rss(subtree_pid):
+        rss = 0
+        pids = [subtree_pid]
+        while len(pids) > 0:
+            next_pid = pids.pop()
+            rss += processes.get(next_pid, (None, 0))[1]
+            pids.extend(children[next_pid])
+        return rss
+
+    child_rss = {child_pid: get_subtree_rss(child_pid) for child_pid in children[pid]}
+    return processes.get(pid, (None, 0))[1] + sum(child_rss.values()), child_rss
+
+
+class Measurement:
+    def __init__(self, name, rss, tracemalloc_top=0):
+        self.name = name
+        self.peak_rss = rss
+        self.tracemalloc_top = tracemalloc_top
+        self.start_snapshot = None
+
+
+class MemoryMonitor:
+    def __init__(self, memory_limit=None, interval=DEFAULT_INTERVAL, proc_dir='/proc'):
+        self.memory_limit = memory_limit
+        self.interval = interval
+        self.proc_dir = proc_dir
+        self.pid = os.getpid()
+        # RSS of the pipeline and its child processes at the last sample
+        self.rss = 0
+        # peak RSS of each child process and the processes below it, by pid
+        self.child_peaks = {}
+        self._measurements = set()
+        # Measurements tracing Python allocations, tracemalloc is stopped after the last if it was started for them
+        self._tracing_measurements = set()
+        self._started_tracemalloc = False
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='memory_monitor', daemon=True)
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        if os.path.isdir(self.proc_dir):
+            rss, child_rss = get_tree_rss(read_process_table(self.proc_dir), self.pid)
+        else:
+            # no /proc, e.g. on macOS: the peak RSS of the pipeline process, which is in bytes there
+            rss, child_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, {}
+        with self._lock:
+            self.rss = rss
+            for pid, subtree_rss in child_rss.items():
+                self.child_peaks[pid] = max(self.child_peaks.get(pid, 0), subtree_rss)
+            for measurement in self._measurements:
+                measurement.peak_rss = max(measurement.peak_rss, self.rss)
+        return self.rss
+
+    def over_limit(self):
+        return self.memory_limit is not None and self.rss > self.memory_limit
+
+    def pop_child_peak(self, pid):
+        # None if the child ended before it was sampled
+        with self._lock:
+            return self.child_peaks.pop(pid, None)
+
+    def begin(self, name, tracemalloc_top=0):
+        """
+        Start measuring the memory of a step. With tracemalloc_top Python allocations
+        are traced until end() is called.
+        """
+        self.start()
+        measurement = Measurement(name, rss=self.sample(), tracemalloc_top=tracemalloc_top)
+        if tracemalloc_top > 0:
+            with self._lock:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._started_tracemalloc = True
+                self._tracing_measurements.add(measurement)
+            tracemalloc.reset_peak()
+            measurement.start_snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            self._measurements.add(measurement)
+        return measurement
+
+    def end(self, measurement):
+        """
+        Stop measuring and return a record of the step's memory: its peak RSS and,
+        with tracemalloc_top, the peak of Python allocations and the top allocating
+        lines.
+        """
+        self.sample()
+        with self._lock:
+            self._measurements.discard(measurement)
+        record = {'step_peak_rss_bytes': measurement.peak_rss}
+        if measurement.start_snapshot is not None:
+            record['python_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            record['top_allocations'] = get_top_allocations(
+                measurement.start_snapshot, tracemalloc.take_snapshot(), measurement.tracemalloc_top)
+            with self._lock:
+                self._tracing_measurements.discard(measurement)
+                if self._started_tracemalloc and len(self._tracing_measurements) == 0:
+                    tracemalloc.stop()
+                    self._started_tracemalloc = False
+        return record
+
+
+def get_top_allocations(start_snapshot, end_snapshot, top):
+    # the lines that allocated the most memory between the snapshots that is still held
+    tracemalloc_filter = (tracemalloc.Filter(False, tracemalloc.__file__), )
+    statistics = end_snapshot.filter_traces(tracemalloc_filter).compare_to(
+        start_snapshot.filter_traces(tracemalloc_filter), 'lineno')
+    return [
+        {
+            'location': '{}:{}'.format(statistic.traceback[0].filename, statistic.traceback[0].lineno),
+            'size_bytes': statistic.size_diff,
+            'count': statistic.count_diff,
+        }
+        for statistic
+        in statistics[:top]
+        if statistic.size_diff > 0
+    ]
+
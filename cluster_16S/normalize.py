@@ -0,0 +1,187 @@
+"""
+Rarefaction, normalization and filtering of sparse OTU tables.
+
+Every operation works on the CSR arrays of an OtuTable as a whole, with no loop over
+samples, and makes no array larger than the number of non-zero counts, so tables of
+thousands of samples are processed in about the time it takes to read them.
+
+rarefy() draws depth reads without replacement from each sample, as a multivariate
+hypergeometric draw per sample. The draw is made one OTU at a time as a chain of
+hypergeometric draws: the count of the k-th OTU of a sample is drawn from the reads
+not yet drawn, given the reads of that OTU and of the OTUs after it. Step k draws
+for all samples at once, so there are as many numpy calls as OTUs in the richest
+sample. A seed gives the same table on every run.
+
+clr() is the robust centered log-ratio transform: the log of each non-zero count
+less the mean log of the non-zero counts of its sample. Zero counts stay zero, so
+the table stays sparse, unlike the CLR with a pseudocount.
+
+    normalize_otu_table -o rarefied.biom.json --rarefy-depth 10000 --seed 1 *.otutab.merged.npz
+
+"""
+import argparse
+import logging
+
+import numpy as np
+
+from cluster_16S.otu_table import OtuTable, merge_otu_tables, read_otu_table, write_otu_table
+from cluster_16S.pipeline_util import PipelineException
+
+
+NORMALIZATIONS = ('none', 'relative', 'clr')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = get_args()
+    table = merge_otu_tables([read_otu_table(fp) for fp in args.input_fps])
+    table = normalize_otu_table(
+        table,
+        min_otu_count=args.min_otu_count,
+        min_otu_samples=args.min_otu_samples,
+        min_otu_fraction=args.min_otu_fraction,
+        rarefy_depth=args.rarefy_depth,
+        seed=args.seed,
+        normalization=args.normalization)
+    write_otu_table(table, args.output_fp)
+    logging.getLogger(name=__name__).info(
+        'wrote %d x %d table with %d non-zero entries to "%s"', *table.shape, table.nnz, args.output_fp)
+    return 0
+
+
+def get_args(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description='filter, rarefy and normalize OTU tables (.npz, .biom.json or otutab.txt), '
+                    'in that order; several tables are merged first')
+    arg_parser.add_argument('input_fps', nargs='+', help='OTU tables, e.g. the per-sample or merged tables of step 09')
+    arg_parser.add_argument('-o', '--output-fp', required=True,
+                            help='output table, the format is chosen by the file name like the input tables')
+    arg_parser.add_argument('--min-otu-count', default=0, type=int,
+                            help='remove OTUs with fewer reads in all samples together')
+    arg_parser.add_argument('--min-otu-samples', default=0, type=int,
+                            help='remove OTUs found in fewer samples')
+    arg_parser.add_argument('--min-otu-fraction', default=0.0, type=float,
+                            help='remove OTUs with less than this fraction of the reads of all samples')
+    arg_parser.add_argument('--rarefy-depth', default=None, type=int,
+                            help='draw this many reads from each sample, samples with fewer reads are removed')
+    arg_parser.add_argument('--seed', default=None, type=int,
+                            help='seed of the random rarefaction draws')
+    arg_parser.add_argument('--normalization', default='none', choices=NORMALIZATIONS,
+                            help='relative abundances or robust centered log-ratios of the counts')
+    return arg_parser.parse_args(argv)
+
+
+def normalize_otu_table(
+        table, min_otu_count=0, min_otu_samples=0, min_otu_fraction=0.0, rarefy_depth=None, seed=None,
+        normalization='none'):
+    if normalization not in NORMALIZATIONS:
+        raise PipelineException('unknown normalization "{}"'.format(normalization))
+    table = filter_otus(
+        table, min_count=min_otu_count, min_sample_count=min_otu_samples, min_fraction=min_otu_fraction)
+    if rarefy_depth is not None:
+        table = rarefy(table, rarefy_depth, seed=seed)
+    if normalization == 'relative':
+        table = relative_abundance(table)
+    elif normalization == 'clr':
+        table = clr(table)
+    return table
+
+
+def get_columns_order(table):
+    # the entries of the table sorted by sample, then OTU, and the start of each sample's entries
+    rows, cols, _ = table.to_coo()
+    order = np.lexsort((rows, cols))
+    column_starts = np.zeros(len(table.sample_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cols, minlength=len(table.sample_ids)), out=column_starts[1:])
+    return order, column_starts
+
+
+def select_otus(table, keep):
+    # the rows of the OTUs where keep is True
+    rows, cols, data = table.to_coo()
+    kept_entries = keep[rows]
+    new_rows = np.cumsum(keep) - 1
+    return OtuTable.from_coo(
+        otu_ids=[otu_id for otu_id, k in zip(table.otu_ids, keep.tolist()) if k],
+        sample_ids=table.sample_ids,
+        rows=new_rows[rows[kept_entries]], cols=cols[kept_entries], data=data[kept_entries])
+
+
+def filter_otus(table, min_count=0, min_sample_count=0, min_fraction=0.0):
+    """
+    Remove the OTUs with fewer than min_count reads, found in fewer than
+    min_sample_count samples or with less than min_fraction of all reads.
+    """
+    otu_totals = table.otu_totals()
+    otu_sample_counts = np.diff(table.indptr)
+    keep = (
+        (otu_totals >= min_count)
+        & (otu_sample_counts >= min_sample_count)
+        & (otu_totals >= min_fraction * otu_totals.sum()))
+    if np.all(keep):
+        return table
+    logging.getLogger(name=__name__).info(
+        'removing %d of %d OTUs with %d of %d reads', np.sum(~keep), len(keep),
+        otu_totals[~keep].sum(), otu_totals.sum())
+    return select_otus(table, keep)
+
+
+def rarefy(table, depth, seed=None):
+    """
+    Return a table of depth reads drawn without replacement from each sample with at
+    least depth reads. Samples with fewer reads are left out.
+    """
+    if not np.issubdtype(table.data.dtype, np.integer) and not np.all(table.data == np.round(table.data)):
+        raise PipelineException('only tables of counts can be rarefied')
+    sample_totals = table.sample_totals().astype(np.int64)
+    kept_samples = np.flatnonzero(sample_totals >= depth)
+    if len(kept_samples) < len(table.sample_ids):
+        logging.getLogger(name=__name__).info(
+            'removing %d of %d samples with fewer than %d reads',
+            len(table.sample_ids) - len(kept_samples), len(table.sample_ids), depth)
+        table = table.select_samples([table.sample_ids[c] for c in kept_samples.tolist()])
+        sample_totals = sample_totals[kept_samples]
+
+    rng = np.random.default_rng(seed)
+    order, column_starts = get_columns_order(table)
+    counts = table.data.astype(np.int64)[order]
+    column_lengths = np.diff(column_starts)
+    drawn = np.zeros(len(counts), dtype=np.int64)
+    # reads not yet considered and reads still to draw, per sample
+    reads_left = sample_totals.copy()
+    draws_left = np.full(len(sample_totals), depth, dtype=np.int64)
+    active = np.flatnonzero(column_lengths > 0)
+    for k in range(int(column_lengths.max()) if len(column_lengths) > 0 else 0):
+        active = active[column_lengths[active] > k]
+        entries = column_starts[active] + k
+        otu_counts = counts[entries]
+        reads_left[active] -= otu_counts
+        entry_draws = rng.hypergeometric(otu_counts, reads_left[active], draws_left[active])
+        drawn[entries] = entry_draws
+        draws_left[active] -= entry_draws
+
+    rows, cols, _ = table.to_coo()
+    return OtuTable.from_coo(
+        otu_ids=table.otu_ids, sample_ids=table.sample_ids, rows=rows[order], cols=cols[order], data=drawn)
+
+
+def relative_abundance(table):
+    # each count as a fraction of the reads of its sample
+    rows, cols, data = table.to_coo()
+    sample_totals = table.sample_totals()
+    return OtuTable(
+        otu_ids=table.otu_ids, sample_ids=table.sample_ids, indptr=table.indptr, indices=table.indices,
+        data=data / sample_totals[cols])
+
+
+def clr(table):
+    """
+    Robust centered log-ratio transform of the non-zero counts, see above.
+    """
+    _, cols, data = table.to_coo()
+    log_data = np.log(data.astype(np.float64))
+    nonzero_counts = np.bincount(cols, minlength=len(table.sample_ids))
+    mean_logs = np.bincount(cols, weights=log_data, minlength=len(table.sample_ids)) / np.maximum(nonzero_counts, 1)
+    return OtuTable(
+        otu_ids=table.otu_ids, sample_ids=table.sample_ids, indptr=table.indptr, indices=table.indices,
+        data=log_data - mean_logs[cols])
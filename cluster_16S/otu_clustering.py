@@ -0,0 +1,266 @@
+"""
+Abundance-ordered greedy OTU clustering, a built-in alternative to usearch -cluster_otus.
+
+Sequences are taken in order of decreasing ;size= abundance. Each sequence joins the
+first centroid it is at least `identity` similar to, or becomes a new centroid. The
+centroids to try are shortlisted by the number of k-mers they share with the sequence,
+most first, and each one is checked with a banded global alignment.
+
+Identity is 1 - (edit distance / length of the longer sequence). A sequence pair can
+only reach the identity if its alignment stays within max_edits diagonals of the main
+diagonal, so an alignment banded that narrowly decides a match exactly.
+
+Sequences are clustered in batches of fixed sizes. Every sequence of a batch is compared
+to the centroids found before the batch, in parallel, then the sequences that matched
+none of them are compared, in order, to the centroids found earlier in the same batch.
+The result does not depend on the number of threads.
+
+Unlike usearch -cluster_otus there is no de novo chimera filtering.
+
+"""
+import concurrent.futures
+import functools
+import logging
+
+import numpy as np
+
+from cluster_16S.kmer_index import KMER_LENGTH, KmerIndex, get_kmers, get_top_hits
+from cluster_16S.otu_table import get_label_size
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.seqio import format_fasta_record, open_sequence_file, read_fasta_records
+
+
+# centroids aligned to a sequence before it is made a new centroid
+MAX_REJECTS = 16
+BATCH_SIZE = 1024
+# sequences per task given to a thread
+CHUNK_SIZE = 64
+
+INFINITE_DISTANCE = 1 << 20
+
+
+def get_shared_kmer_counts(kmers, kmer_arrays):
+    # for a few sequences, where building a KmerIndex would take longer
+    lengths = np.fromiter((len(k) for k in kmer_arrays), dtype=np.int64, count=len(kmer_arrays))
+    sequence_ids = np.repeat(np.arange(len(kmer_arrays), dtype=np.int64), lengths)
+    return np.bincount(
+        sequence_ids[np.isin(np.concatenate(kmer_arrays), kmers)], minlength=len(kmer_arrays))
+
+
+def get_max_edits(identity, query_lengths, target_lengths):
+    return np.floor((1.0 - identity) * np.maximum(query_lengths, target_lengths) + 1e-9).astype(np.int64)
+
+
+def get_edit_distances(queries, targets, max_edits):
+    """
+    Return the edit distance of each (query, target) pair of bytes, or max_edits + 1
+    for pairs more than max_edits apart. All pairs are aligned together, one row of a
+    band of diagonals at a time.
+    """
+    max_edits = np.asarray(max_edits, dtype=np.int64)
+    pair_count = len(queries)
+    if pair_count == 0:
+        return np.zeros(0, dtype=np.int64)
+    query_lengths = np.fromiter(map(len, queries), dtype=np.int64, count=pair_count)
+    target_lengths = np.fromiter(map(len, targets), dtype=np.int64, count=pair_count)
+    band_radius = int(max_edits.max())
+    band_width = 2 * band_radius + 1
+    row_count = int(query_lengths.max())
+
+    # distinct padding so padding never matches
+    query_array = np.zeros((pair_count, row_count), dtype=np.uint8)
+    # target base j - 1 of band column b in row i is at target_array[:, i + b]
+    target_array = np.ones(
+        (pair_count, max(row_count + band_width, band_radius + 1 + int(target_lengths.max()))), dtype=np.uint8)
+    for p, (query, target) in enumerate(zip(queries, targets)):
+        query_array[p, :len(query)] = np.frombuffer(query, dtype=np.uint8)
+        target_array[p, band_radius + 1:band_radius + 1 + len(target)] = np.frombuffer(target, dtype=np.uint8)
+
+    # column b of a row is the cell in target column j = row + b - band_radius
+    band_offsets = np.arange(band_width, dtype=np.int64) - band_radius
+    band_positions = np.arange(band_width, dtype=np.int64)
+    distances = np.full(pair_count, INFINITE_DISTANCE, dtype=np.int64)
+    # the band column of the last cell of each alignment, or -1 if it is outside the band
+    final_columns = target_lengths - query_lengths + band_radius
+    final_columns[(final_columns < 0) | (final_columns >= band_width)] = -1
+
+    row = np.where(band_offsets >= 0, band_offsets, INFINITE_DISTANCE)
+    previous_row = np.tile(row, (pair_count, 1))
+    up = np.empty_like(previous_row)
+    for i in range(1, row_count + 1):
+        mismatches = query_array[:, i - 1:i] != target_array[:, i:i + band_width]
+        current_row = previous_row + mismatches
+        up[:, :-1] = previous_row[:, 1:] + 1
+        up[:, -1] = INFINITE_DISTANCE
+        np.minimum(current_row, up, out=current_row)
+        target_columns = i + band_offsets
+        current_row[:, target_columns < 0] = INFINITE_DISTANCE
+        current_row[:, target_columns == 0] = i
+        # gaps in the query: the smallest of current_row[:, c] + (b - c) over c <= b
+        current_row = np.minimum.accumulate(current_row - band_positions, axis=1) + band_positions
+        np.minimum(current_row, INFINITE_DISTANCE, out=current_row)
+
+        finished = (query_lengths == i) & (final_columns >= 0)
+        if finished.any():
+            distances[finished] = current_row[finished, final_columns[finished]]
+        previous_row = current_row
+        # distances never decrease along an alignment
+        if i % 16 == 0 and (
+                (current_row.min(axis=1) > max_edits) | (query_lengths <= i)).all():
+            break
+
+    return np.minimum(distances, max_edits + 1)
+
+
+def get_batches(sequence_count, batch_size):
+    # the first sequences mostly become centroids and are compared to each other in
+    # order, so batches start small and double in size
+    batch_start = 0
+    current_batch_size = min(CHUNK_SIZE, batch_size)
+    while batch_start < sequence_count:
+        yield batch_start, min(batch_start + current_batch_size, sequence_count)
+        batch_start += current_batch_size
+        current_batch_size = min(2 * current_batch_size, batch_size)
+
+
+class GreedyClusterer:
+    def __init__(self, identity=0.97, threads=1, kmer_length=KMER_LENGTH, max_rejects=MAX_REJECTS,
+                 batch_size=BATCH_SIZE):
+        if not 0.0 < identity <= 1.0:
+            raise PipelineException('clustering identity must be greater than 0 and at most 1, not {}'.format(identity))
+        self.identity = identity
+        self.threads = threads
+        self.kmer_length = kmer_length
+        self.max_rejects = max_rejects
+        self.batch_size = batch_size
+
+    def search(self, sequences, candidate_lists, centroid_sequences):
+        """
+        Return (index of the first matching centroid or -1, identity) for each sequence,
+        trying its list of candidate centroids in order.
+        """
+        hits = np.full(len(sequences), -1, dtype=np.int64)
+        identities = np.zeros(len(sequences))
+        # most sequences match their first candidate, the others are tried only if it does not
+        for first_rank, end_rank in ((0, 1), (1, None)):
+            pair_queries = []
+            pair_centroids = []
+            for query_index, candidates in enumerate(candidate_lists):
+                if hits[query_index] < 0:
+                    pair_queries.extend([query_index] * len(candidates[first_rank:end_rank]))
+                    pair_centroids.extend(candidates[first_rank:end_rank])
+            if len(pair_queries) == 0:
+                continue
+
+            queries = [sequences[q] for q in pair_queries]
+            targets = [centroid_sequences[c] for c in pair_centroids]
+            query_lengths = np.fromiter(map(len, queries), dtype=np.int64, count=len(queries))
+            target_lengths = np.fromiter(map(len, targets), dtype=np.int64, count=len(targets))
+            max_edits = get_max_edits(self.identity, query_lengths, target_lengths)
+            # pairs whose lengths differ by more than max_edits can not match
+            aligned = np.abs(query_lengths - target_lengths) <= max_edits
+            distances = max_edits + 1
+            distances[aligned] = get_edit_distances(
+                [queries[p] for p in np.flatnonzero(aligned)],
+                [targets[p] for p in np.flatnonzero(aligned)],
+                max_edits[aligned])
+
+            # pairs are in order of shared k-mers for each query, take the first match
+            for p in reversed(np.flatnonzero(distances <= max_edits)):
+                hits[pair_queries[p]] = pair_centroids[p]
+                identities[pair_queries[p]] = 1.0 - distances[p] / max(query_lengths[p], target_lengths[p])
+        return hits, identities
+
+    def search_chunk(self, chunk_sequences, kmer_index, centroid_sequences):
+        kmer_arrays = [get_kmers(sequence, self.kmer_length) for sequence in chunk_sequences]
+        hits, identities = self.search(
+            chunk_sequences, kmer_index.top_hits(kmer_arrays, self.max_rejects), centroid_sequences)
+        return kmer_arrays, hits, identities
+
+    def cluster(self, sequences):
+        """
+        Cluster sequences (bytes) given in order of decreasing abundance. Returns
+        (indices of the centroid sequences, the centroid number of each sequence, the
+        identity of each sequence with its centroid).
+        """
+        log = logging.getLogger(name=__name__)
+        centroid_indices = []
+        centroid_kmer_arrays = []
+        assignment = np.zeros(len(sequences), dtype=np.int64)
+        identities = np.ones(len(sequences))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for batch_start, batch_end in get_batches(len(sequences), self.batch_size):
+                batch_sequences = sequences[batch_start:batch_end]
+
+                # compare the batch to the centroids found before it
+                kmer_index = KmerIndex.from_kmer_arrays(centroid_kmer_arrays, kmer_length=self.kmer_length)
+                centroid_sequences = [sequences[c] for c in centroid_indices]
+                results = list(executor.map(
+                    functools.partial(self.search_chunk, kmer_index=kmer_index, centroid_sequences=centroid_sequences),
+                    (batch_sequences[s:s + CHUNK_SIZE] for s in range(0, len(batch_sequences), CHUNK_SIZE))))
+                batch_kmer_arrays = [kmers for chunk_kmer_arrays, _, _ in results for kmers in chunk_kmer_arrays]
+                batch_hits = np.concatenate([hits for _, hits, _ in results])
+                batch_identities = np.concatenate([chunk_identities for _, _, chunk_identities in results])
+
+                # then compare the rest to the centroids found in this batch
+                batch_centroid_count = len(centroid_indices)
+                for i, (sequence, kmers) in enumerate(zip(batch_sequences, batch_kmer_arrays)):
+                    hit, hit_identity = batch_hits[i], batch_identities[i]
+                    if hit < 0 and len(centroid_indices) > batch_centroid_count:
+                        shared_counts = get_shared_kmer_counts(kmers, centroid_kmer_arrays[batch_centroid_count:])
+                        (new_hit, ), (hit_identity, ) = self.search(
+                            [sequence], [get_top_hits(shared_counts, self.max_rejects)],
+                            [sequences[c] for c in centroid_indices[batch_centroid_count:]])
+                        if new_hit >= 0:
+                            hit = batch_centroid_count + new_hit
+                    if hit < 0:
+                        hit, hit_identity = len(centroid_indices), 1.0
+                        centroid_indices.append(batch_start + i)
+                        centroid_kmer_arrays.append(kmers)
+                    assignment[batch_start + i] = hit
+                    identities[batch_start + i] = hit_identity
+                log.debug('%d sequences, %d centroids', batch_start + len(batch_sequences), len(centroid_indices))
+
+        return centroid_indices, assignment, identities
+
+
+def cluster_otus(input_fp, otus_fp, uparse_fp, identity=0.97, threads=1, otu_label_prefix='OTU_'):
+    """
+    Cluster the ;size= annotated FASTA input_fp, e.g. the output of vsearch
+    -derep_fulllength -sizeout. Writes the centroids relabeled OTU_1, OTU_2, ... to
+    otus_fp and one uparseout-style record for each input sequence to uparse_fp:
+
+        label  OTU    100.0  *  label
+        label  match  98.8   *  centroid label
+
+    Returns the number of OTUs.
+    """
+    log = logging.getLogger(name=__name__)
+    labels = []
+    sequences = []
+    for label, sequence in read_fasta_records(input_fp):
+        labels.append(label)
+        sequences.append(sequence)
+    # sorted() is stable so sequences of equal abundance keep their input order
+    order = sorted(range(len(labels)), key=lambda i: -get_label_size(labels[i]))
+    labels = [labels[i] for i in order]
+    sequences = [sequences[i] for i in order]
+
+    log.info('clustering %d sequences at %.1f%% identity on %d thread(s)', len(sequences), 100 * identity, threads)
+    centroid_indices, assignment, identities = GreedyClusterer(identity=identity, threads=threads).cluster(sequences)
+    log.info('%d sequences in %d OTUs', len(sequences), len(centroid_indices))
+
+    with open_sequence_file(otus_fp, 'wb') as otus_file:
+        for otu_number, centroid_index in enumerate(centroid_indices, start=1):
+            otus_file.write(format_fasta_record(
+                '{}{}'.format(otu_label_prefix, otu_number).encode(), sequences[centroid_index]))
+    with open(uparse_fp, 'wt') as uparse_file:
+        for i, label in enumerate(labels):
+            centroid_label = labels[centroid_indices[assignment[i]]]
+            uparse_file.write('\t'.join((
+                label,
+                'OTU' if centroid_label is label else 'match',
+                '{:.1f}'.format(100.0 * identities[i]),
+                '*',
+                centroid_label)) + '\n')
+    return len(centroid_indices)
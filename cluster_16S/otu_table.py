@@ -0,0 +1,452 @@
+"""
+Sparse OTU x sample tables.
+
+An OtuTable holds counts in compressed sparse row (CSR) form with one row per OTU
+and one column per sample, the same orientation as BIOM. Tables are built in a
+single streaming pass over .uc, uparseout or userout mapping records and are never
+densified, so memory is proportional to the number of non-zero counts.
+
+"""
+from array import array
+import datetime
+import gzip
+import json
+import logging
+import re
+
+import numpy as np
+
+from cluster_16S.pipeline_util import PipelineException
+
+
+class OtuTable:
+    def __init__(self, otu_ids, sample_ids, indptr, indices, data):
+        self.otu_ids = list(otu_ids)
+        self.sample_ids = list(sample_ids)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data)
+
+        if len(self.indptr) != len(self.otu_ids) + 1:
+            raise PipelineException(
+                'OTU table has {} OTU ids but {} row pointers'.format(len(self.otu_ids), len(self.indptr)))
+
+    @classmethod
+    def from_coo(cls, otu_ids, sample_ids, rows, cols, data):
+        rows, cols, data = sum_duplicates(
+            np.asarray(rows, dtype=np.int64),
+            np.asarray(cols, dtype=np.int64),
+            np.asarray(data))
+        nonzero = data != 0
+        rows, cols, data = rows[nonzero], cols[nonzero], data[nonzero]
+        indptr = np.zeros(len(otu_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(otu_ids)), out=indptr[1:])
+        return cls(otu_ids=otu_ids, sample_ids=sample_ids, indptr=indptr, indices=cols, data=data)
+
+    @property
+    def shape(self):
+        return len(self.otu_ids), len(self.sample_ids)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def to_coo(self):
+        rows = np.repeat(np.arange(len(self.otu_ids), dtype=np.int64), np.diff(self.indptr))
+        return rows, self.indices, self.data
+
+    def sample_totals(self):
+        return np.bincount(self.indices, weights=self.data, minlength=len(self.sample_ids))
+
+    def otu_totals(self):
+        rows, _, data = self.to_coo()
+        return np.bincount(rows, weights=data, minlength=len(self.otu_ids))
+
+    def get_sample_counts(self, sample_id):
+        # returns {otu id: count} for one sample without building a dense column
+        column = self.sample_ids.index(sample_id)
+        rows, cols, data = self.to_coo()
+        in_column = cols == column
+        return {self.otu_ids[r]: v for r, v in zip(rows[in_column].tolist(), data[in_column].tolist())}
+
+    def select_samples(self, sample_ids):
+        column_lookup = {sample_id: c for c, sample_id in enumerate(self.sample_ids)}
+        new_column = np.full(len(self.sample_ids), -1, dtype=np.int64)
+        for new_c, sample_id in enumerate(sample_ids):
+            new_column[column_lookup[sample_id]] = new_c
+        rows, cols, data = self.to_coo()
+        kept = new_column[cols] >= 0
+        return OtuTable.from_coo(
+            otu_ids=self.otu_ids, sample_ids=sample_ids,
+            rows=rows[kept], cols=new_column[cols[kept]], data=data[kept])
+
+    def split_samples(self):
+        """
+        Yield a one-sample table for each sample with only the OTUs seen in that
+        sample. The entries are sorted by sample once instead of once per sample.
+        """
+        rows, cols, data = self.to_coo()
+        order = np.argsort(cols, kind='stable')
+        starts = np.searchsorted(cols[order], np.arange(len(self.sample_ids) + 1))
+        for c, sample_id in enumerate(self.sample_ids):
+            selected = order[starts[c]:starts[c+1]]
+            yield OtuTable(
+                otu_ids=[self.otu_ids[r] for r in rows[selected].tolist()], sample_ids=[sample_id],
+                indptr=np.arange(len(selected) + 1), indices=np.zeros(len(selected)), data=data[selected])
+
+
+def sum_duplicates(rows, cols, data):
+    """
+    Sort COO entries by (row, column) and add up the values of repeated coordinates.
+    """
+    if len(rows) == 0:
+        return rows, cols, data
+    order = np.lexsort((cols, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+    boundary = np.empty(len(rows), dtype=bool)
+    boundary[0] = True
+    boundary[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    starts = np.flatnonzero(boundary)
+    return rows[starts], cols[starts], np.add.reduceat(data, starts)
+
+
+class OtuTableBuilder:
+    """
+    Accumulate (OTU, sample, count) records and build an OtuTable.
+
+    Records are buffered in compact arrays and coalesced every chunk_size records
+    so a long stream of mapping records is never held in memory one-per-read.
+    """
+    def __init__(self, otu_ids=(), sample_ids=(), chunk_size=1000000):
+        self.otu_ids = []
+        self.sample_ids = []
+        self._otu_index = {}
+        self._sample_index = {}
+        for otu_id in otu_ids:
+            self._get_otu_index(otu_id)
+        for sample_id in sample_ids:
+            self._get_sample_index(sample_id)
+
+        self.chunk_size = chunk_size
+        self._rows = array('q')
+        self._cols = array('q')
+        self._counts = array('q')
+        self._coalesced = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    def _get_otu_index(self, otu_id):
+        if otu_id not in self._otu_index:
+            self._otu_index[otu_id] = len(self.otu_ids)
+            self.otu_ids.append(otu_id)
+        return self._otu_index[otu_id]
+
+    def _get_sample_index(self, sample_id):
+        if sample_id not in self._sample_index:
+            self._sample_index[sample_id] = len(self.sample_ids)
+            self.sample_ids.append(sample_id)
+        return self._sample_index[sample_id]
+
+    def add(self, otu_id, sample_id, count=1):
+        self._rows.append(self._get_otu_index(otu_id))
+        self._cols.append(self._get_sample_index(sample_id))
+        self._counts.append(count)
+        if len(self._rows) >= self.chunk_size:
+            self._coalesce()
+
+    def add_sample(self, sample_id):
+        # a sample with no hits still gets a (zero) column
+        self._get_sample_index(sample_id)
+
+    def add_mapping_file(self, fp, fmt='uc', sample_id=None):
+        """
+        Count every mapped query in a .uc, uparseout or userout file. Queries are
+        weighted by their ';size=' annotation. If sample_id is None the sample is
+        taken from the query label the same way vsearch --otutabout does.
+        Returns (mapped, unmapped) read counts.
+        """
+        mapped = 0
+        unmapped = 0
+        if sample_id is not None:
+            self.add_sample(sample_id)
+        for query_label, target_label in read_mapping_records(fp, fmt=fmt):
+            size = get_label_size(query_label)
+            if target_label is None:
+                unmapped += size
+            else:
+                mapped += size
+                self.add(
+                    otu_id=strip_label_annotations(target_label),
+                    sample_id=get_label_sample(query_label) if sample_id is None else sample_id,
+                    count=size)
+        return mapped, unmapped
+
+    def _coalesce(self):
+        rows, cols, counts = self._coalesced
+        self._coalesced = sum_duplicates(
+            np.concatenate((rows, np.frombuffer(self._rows, dtype=np.int64))),
+            np.concatenate((cols, np.frombuffer(self._cols, dtype=np.int64))),
+            np.concatenate((counts, np.frombuffer(self._counts, dtype=np.int64))))
+        self._rows = array('q')
+        self._cols = array('q')
+        self._counts = array('q')
+
+    def build(self):
+        self._coalesce()
+        rows, cols, counts = self._coalesced
+        return OtuTable.from_coo(
+            otu_ids=self.otu_ids, sample_ids=self.sample_ids, rows=rows, cols=cols, data=counts)
+
+
+def merge_otu_tables(tables):
+    """
+    Combine tables column-wise. OTUs are the union of all OTU ids. Columns for a
+    sample id that appears in more than one table are added together.
+    """
+    if len(tables) == 0:
+        raise PipelineException('merge_otu_tables called with no tables')
+
+    otu_index = {}
+    sample_index = {}
+    row_parts = []
+    col_parts = []
+    data_parts = []
+    for table in tables:
+        otu_map = np.array(
+            [otu_index.setdefault(otu_id, len(otu_index)) for otu_id in table.otu_ids], dtype=np.int64)
+        sample_map = np.array(
+            [sample_index.setdefault(sample_id, len(sample_index)) for sample_id in table.sample_ids],
+            dtype=np.int64)
+        rows, cols, data = table.to_coo()
+        row_parts.append(otu_map[rows] if len(rows) else rows)
+        col_parts.append(sample_map[cols] if len(cols) else cols)
+        data_parts.append(data)
+
+    return OtuTable.from_coo(
+        otu_ids=list(otu_index),
+        sample_ids=list(sample_index),
+        rows=np.concatenate(row_parts),
+        cols=np.concatenate(col_parts),
+        data=np.concatenate(data_parts))
+
+
+def open_text(fp, mode='rt'):
+    if fp.endswith('.gz'):
+        return gzip.open(fp, mode)
+    else:
+        return open(fp, mode)
+
+
+def read_mapping_records(fp, fmt='uc'):
+    """
+    Yield (query label, target label) for each record of a mapping file. The target
+    label is None for queries without a hit.
+
+      uc       vsearch/usearch --uc; H records are hits, N records are misses
+      uparse   usearch -uparseout; OTU records map to themselves, match records to
+               the top hit in column 5
+      userout  vsearch --userout with the default query+target fields
+    """
+    with open_text(fp) as mapping_file:
+        for line in mapping_file:
+            line = line.rstrip('\n')
+            # blank lines, e.g. at the end of a file, are skipped
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if fmt == 'uc':
+                if fields[0] == 'H':
+                    yield fields[8], fields[9]
+                elif fields[0] == 'N':
+                    yield fields[8], None
+            elif fmt == 'uparse':
+                classification = fields[1]
+                if classification == 'OTU':
+                    yield fields[0], fields[0]
+                elif classification == 'match':
+                    yield fields[0], fields[4] if len(fields) > 4 else fields[3]
+                else:
+                    yield fields[0], None
+            elif fmt == 'userout':
+                target = fields[1] if len(fields) > 1 else '*'
+                yield fields[0], None if target == '*' else target
+            else:
+                raise PipelineException('unknown mapping format "{}"'.format(fmt))
+
+
+size_pattern = re.compile(r';size=(\d+)')
+sample_pattern = re.compile(r';(?:sample|barcodelabel)=([^;]+)')
+sample_prefix_pattern = re.compile(r'^[A-Za-z0-9]+')
+
+
+def get_label_size(label):
+    m = size_pattern.search(label)
+    return 1 if m is None else int(m.group(1))
+
+
+def get_label_sample(label):
+    m = sample_pattern.search(label)
+    if m is not None:
+        return m.group(1)
+    m = sample_prefix_pattern.match(label)
+    if m is not None:
+        return m.group(0)
+    raise PipelineException('unable to find a sample name in label "{}"'.format(label))
+
+
+def strip_label_annotations(label):
+    # 'OTU_1;size=20;' -> 'OTU_1'
+    return label.split(';', 1)[0]
+
+
+def write_biom_json(table, fp, table_id=None, generated_by='cluster_16S', chunk_size=100000):
+    """
+    Write a sparse BIOM 1.0 JSON table. The data triplets are written in chunks so
+    no per-entry Python structure for the whole table is created.
+    """
+    log = logging.getLogger(name=__name__)
+    log.info('writing %d x %d BIOM table with %d non-zero entries to "%s"', *table.shape, table.nnz, fp)
+    integer_data = np.issubdtype(table.data.dtype, np.integer)
+    header = [
+        ('id', table_id),
+        ('format', 'Biological Observation Matrix 1.0.0'),
+        ('format_url', 'http://biom-format.org'),
+        ('type', 'OTU table'),
+        ('generated_by', generated_by),
+        ('date', datetime.datetime.now().isoformat()),
+        ('rows', [{'id': otu_id, 'metadata': None} for otu_id in table.otu_ids]),
+        ('columns', [{'id': sample_id, 'metadata': None} for sample_id in table.sample_ids]),
+        ('matrix_type', 'sparse'),
+        ('matrix_element_type', 'int' if integer_data else 'float'),
+        ('shape', list(table.shape)),
+    ]
+    rows, cols, data = table.to_coo()
+    with open_text(fp, 'wt') as biom_file:
+        biom_file.write('{')
+        for key, value in header:
+            biom_file.write('{}: {},'.format(json.dumps(key), json.dumps(value)))
+        biom_file.write('"data": [')
+        for i in range(0, len(data), chunk_size):
+            if i > 0:
+                biom_file.write(',')
+            biom_file.write(','.join(map(
+                '[{},{},{}]'.format,
+                rows[i:i+chunk_size].tolist(),
+                cols[i:i+chunk_size].tolist(),
+                (data[i:i+chunk_size] if integer_data else data[i:i+chunk_size].astype(float)).tolist())))
+        biom_file.write(']}')
+
+
+def read_biom_json(fp):
+    with open_text(fp) as biom_file:
+        biom = json.load(biom_file)
+    otu_ids = [row['id'] for row in biom['rows']]
+    sample_ids = [column['id'] for column in biom['columns']]
+    dtype = np.int64 if biom.get('matrix_element_type', 'int') == 'int' else np.float64
+    if biom['matrix_type'] == 'sparse':
+        entries = np.array(biom['data'], dtype=np.float64).reshape(-1, 3)
+        return OtuTable.from_coo(
+            otu_ids=otu_ids, sample_ids=sample_ids,
+            rows=entries[:, 0].astype(np.int64),
+            cols=entries[:, 1].astype(np.int64),
+            data=entries[:, 2].astype(dtype))
+    else:
+        dense = np.array(biom['data'], dtype=dtype).reshape(len(otu_ids), len(sample_ids))
+        rows, cols = np.nonzero(dense)
+        return OtuTable.from_coo(
+            otu_ids=otu_ids, sample_ids=sample_ids, rows=rows, cols=cols, data=dense[rows, cols])
+
+
+def write_otu_table_npz(table, fp):
+    """
+    Write the CSR arrays to an uncompressed .npz file, which loads without parsing.
+    """
+    np.savez(
+        fp,
+        otu_ids=np.array(table.otu_ids, dtype=str),
+        sample_ids=np.array(table.sample_ids, dtype=str),
+        indptr=table.indptr,
+        indices=table.indices,
+        data=table.data)
+
+
+def read_otu_table_npz(fp):
+    with np.load(fp) as npz:
+        return OtuTable(
+            otu_ids=npz['otu_ids'].tolist(),
+            sample_ids=npz['sample_ids'].tolist(),
+            indptr=npz['indptr'],
+            indices=npz['indices'],
+            data=npz['data'])
+
+
+def write_otutab_txt(table, fp):
+    """
+    Write the tab-separated format of vsearch --otutabout. The text format is dense
+    so only one row at a time is expanded.
+    """
+    integer_data = np.issubdtype(table.data.dtype, np.integer)
+    row_values = np.zeros(len(table.sample_ids), dtype=table.data.dtype)
+    with open_text(fp, 'wt') as otutab_file:
+        otutab_file.write('\t'.join(['#OTU ID', *table.sample_ids]) + '\n')
+        for r, otu_id in enumerate(table.otu_ids):
+            start, end = table.indptr[r], table.indptr[r+1]
+            row_values[:] = 0
+            row_values[table.indices[start:end]] = table.data[start:end]
+            if integer_data:
+                values = map(str, row_values.tolist())
+            else:
+                values = map('{:.6g}'.format, row_values.tolist())
+            otutab_file.write('\t'.join([otu_id, *values]) + '\n')
+
+
+def read_otutab_txt(fp):
+    with open_text(fp) as otutab_file:
+        header = otutab_file.readline().rstrip('\n').split('\t')
+        sample_ids = header[1:]
+        otu_ids = []
+        row_parts = []
+        col_parts = []
+        data_parts = []
+        for line in otutab_file:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 2:
+                continue
+            values = np.array(fields[1:], dtype=np.float64)
+            cols = np.flatnonzero(values)
+            row_parts.append(np.full(len(cols), len(otu_ids), dtype=np.int64))
+            col_parts.append(cols)
+            data_parts.append(values[cols])
+            otu_ids.append(fields[0])
+
+    data = np.concatenate(data_parts) if data_parts else np.zeros(0)
+    if np.all(data == np.round(data)):
+        data = data.astype(np.int64)
+    return OtuTable.from_coo(
+        otu_ids=otu_ids, sample_ids=sample_ids,
+        rows=np.concatenate(row_parts) if row_parts else np.zeros(0, dtype=np.int64),
+        cols=np.concatenate(col_parts) if col_parts else np.zeros(0, dtype=np.int64),
+        data=data)
+
+
+def read_otu_table(fp):
+    # choose a reader by file name
+    if fp.endswith('.npz'):
+        return read_otu_table_npz(fp)
+    elif re.search(r'\.(json|biom)(\.gz)?$', fp):
+        return read_biom_json(fp)
+    else:
+        return read_otutab_txt(fp)
+
+
+def write_otu_table(table, fp):
+    if fp.endswith('.npz'):
+        write_otu_table_npz(table, fp)
+    elif re.search(r'\.(json|biom)(\.gz)?$', fp):
+        write_biom_json(table, fp)
+    else:
+        write_otutab_txt(table, fp)
+
+
+def get_fasta_labels(fp):
+    # OTU ids in file order, e.g. 'OTU_1;size=20;' -> 'OTU_1'
+    with open_text(fp) as fasta_file:
+        return [strip_label_annotations(line[1:].strip()) for line in fasta_file if line.startswith('>')]
@@ -0,0 +1,135 @@
+"""
+Checks that the forward and reverse read files of each pair belong together.
+
+Step 01 reads every record of every input file while it copies the file, so a
+truncated or corrupt gzip file or FASTQ record fails there. A PairCheckCollector
+also keeps a summary of each file: the record count, a digest of the read names in
+file order and the range of read lengths. Read names are compared without the parts
+that differ between the two reads of a pair, the comment after the first space and a
+trailing /1 or /2.
+
+When all files are copied check_pairs() compares the summaries of the forward and
+reverse file of each pair and fails the step if any pair has a missing file, a
+different number of records or read names out of step, before any external tool
+runs on the files.
+
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+from cluster_16S.pipeline_util import PipelineException, get_associated_reverse_fastq_fp
+
+
+PAIR_CHECK_DIR_NAME = 'pair_check'
+
+# the comment after the first space or tab and a trailing /1 or /2 of each name
+pair_name_suffix_pattern = re.compile(rb'(?:/[12])?(?:[ \t][^\n]*)?$', flags=re.MULTILINE)
+forward_fastq_pattern = re.compile(r'_[R0]1.*\.fastq')
+
+
+def get_pair_names(headers):
+    # the names of a batch of reads, without the parts that differ within a pair, as one block
+    return pair_name_suffix_pattern.sub(b'', b'\n'.join(headers)) + b'\n'
+
+
+class PairCheckCollector:
+    def __init__(self):
+        self.read_count = 0
+        self.name_digest = hashlib.sha1()
+        self.first_read_name = None
+        self.min_length = None
+        self.max_length = 0
+        self.base_count = 0
+
+    def add_fastq_batch(self, fastq_batch):
+        if len(fastq_batch) == 0:
+            return
+        headers = fastq_batch.headers()
+        pair_names = get_pair_names(headers)
+        self.name_digest.update(pair_names)
+        if self.first_read_name is None:
+            self.first_read_name = pair_names[:pair_names.index(b'\n')].decode(errors='replace')
+        lengths = fastq_batch.sequence_lengths()
+        self.read_count += len(headers)
+        self.min_length = int(lengths.min()) if self.min_length is None else min(self.min_length, int(lengths.min()))
+        self.max_length = max(self.max_length, int(lengths.max()))
+        self.base_count += int(np.sum(lengths))
+
+    def summary(self):
+        return {
+            'read_count': self.read_count,
+            'name_digest': self.name_digest.hexdigest(),
+            'first_read_name': self.first_read_name,
+            'min_length': self.min_length or 0,
+            'max_length': self.max_length,
+            'mean_length': round(self.base_count / self.read_count, 2) if self.read_count > 0 else 0,
+        }
+
+
+def get_pair_check_fp(output_dir, fastq_fp):
+    return os.path.join(output_dir, PAIR_CHECK_DIR_NAME, os.path.basename(fastq_fp) + '.json')
+
+
+def write_pair_check(pair_check_collector, output_dir, fastq_fp):
+    pair_check_fp = get_pair_check_fp(output_dir, fastq_fp)
+    os.makedirs(os.path.dirname(pair_check_fp), exist_ok=True)
+    with open(pair_check_fp, 'wt') as pair_check_file:
+        json.dump(dict(pair_check_collector.summary(), file=os.path.basename(fastq_fp)), pair_check_file)
+    return pair_check_fp
+
+
+def read_pair_checks(output_dir):
+    # {fastq file name: summary} of the files checked in a step
+    pair_checks = {}
+    for pair_check_fp in glob.glob(os.path.join(output_dir, PAIR_CHECK_DIR_NAME, '*.json')):
+        with open(pair_check_fp, 'rt') as pair_check_file:
+            pair_check = json.load(pair_check_file)
+        pair_checks[pair_check['file']] = pair_check
+    return pair_checks
+
+
+def get_pair_problems(forward_name, forward_check, reverse_name, reverse_check):
+    if reverse_check is None:
+        return ['"{}" has no reverse read file "{}"'.format(forward_name, reverse_name)]
+    problems = []
+    if forward_check['read_count'] != reverse_check['read_count']:
+        problems.append('"{}" has {} reads but "{}" has {}, one of them may be truncated'.format(
+            forward_name, forward_check['read_count'], reverse_name, reverse_check['read_count']))
+    elif forward_check['name_digest'] != reverse_check['name_digest']:
+        problems.append('the read names of "{}" and "{}" are out of step (first reads "{}" and "{}")'.format(
+            forward_name, reverse_name, forward_check['first_read_name'], reverse_check['first_read_name']))
+    return problems
+
+
+def check_pairs(output_dir):
+    """
+    Compare the summaries written by write_pair_check() for each forward read file
+    in output_dir with those of its reverse read file. Raises PipelineException
+    listing every problem found.
+    """
+    log = logging.getLogger(name=__name__)
+    pair_checks = read_pair_checks(output_dir)
+    problems = []
+    pair_count = 0
+    for name, pair_check in sorted(pair_checks.items()):
+        if forward_fastq_pattern.search(name) is None:
+            continue
+        pair_count += 1
+        reverse_name = os.path.basename(get_associated_reverse_fastq_fp(name))
+        problems.extend(get_pair_problems(name, pair_check, reverse_name, pair_checks.get(reverse_name)))
+        if pair_check['read_count'] == 0:
+            log.warning('"%s" has no reads', name)
+        else:
+            log.info(
+                '"%s": %d read pairs, forward read lengths %d to %d (mean %.1f)', name, pair_check['read_count'],
+                pair_check['min_length'], pair_check['max_length'], pair_check['mean_length'])
+    if len(problems) > 0:
+        raise PipelineException('read pairs do not match:\n\t{}'.format('\n\t'.join(problems)))
+    log.info('checked %d read pairs in "%s"', pair_count, output_dir)
+    return pair_count
@@ -7,35 +7,89 @@ Design principles:
 
 """
 import argparse
+import collections
+import contextlib
+import functools
 import glob
-import gzip
 import itertools
 import logging
 import os
 import re
 import shutil
 import sys
+import zlib
+
+import numpy as np
 
 from cluster_16S.pipeline_util import create_output_dir, get_forward_fastq_files, get_associated_reverse_fastq_fp, \
-    gzip_files, ungzip_files, run_cmd, PipelineException
+    gzip_files, ungzip_files, PipelineException, concatenate_files, count_fasta_records, split_fasta_file
 from cluster_16S.fasta_qual_to_fastq import fasta_qual_to_fastq
-
+from cluster_16S import trace
+from cluster_16S.bgzf import compress_files, decompress_files, is_bgzf
+from cluster_16S.compact_reads import CompactReadEncoder, get_quality_bin_table, get_read_names_fp, \
+    get_sample_numbers
+from cluster_16S.memory import parse_memory_size
+from cluster_16S.prefetch import DEFAULT_PREFETCH_DEPTH, stage_files
+from cluster_16S.planner import StepMeter, describe_inputs, format_plan, format_size, parse_duration, plan_run, \
+    record_step_metrics
+from cluster_16S.read_qc import ReadQcCollector, collect_read_qc, write_read_qc
+from cluster_16S.scratch import get_local_scratch_dir, remove_local_scratch_dir, sync_dir, sync_file
+from cluster_16S.scheduler import TOOL_THREAD_PROFILES, Job, JobScheduler, call_after_all
+from cluster_16S.step_archive import STAGED_DIR_NAME, StepArchive, find_step_outputs, get_archive_fp, \
+    get_staged_fps, get_step_output_size, stage_step_outputs
+from cluster_16S.sequence_index import SequenceIndex, get_sequence_digest
+from cluster_16S.step_ledger import StepLedger, commit_sample_dir, create_sample_dir, get_step_ledger_fp
+from cluster_16S.kmer_index import open_kmer_index
+from cluster_16S.otu_clustering import cluster_otus
+from cluster_16S.pair_check import PairCheckCollector, check_pairs, write_pair_check
+from cluster_16S.otu_table import OtuTableBuilder, get_fasta_labels, merge_otu_tables, read_mapping_records, \
+    read_otu_table, read_otu_table_npz, strip_label_annotations, write_biom_json, write_otu_table, \
+    write_otu_table_npz
+from cluster_16S.seqio import format_fasta_record, open_sequence_file, read_fasta_records, read_fastq_batches
+from cluster_16S.uniques import UniqueSequenceCounter, assign_unique_counts, get_unique_index
+
+
+# the per-sample read steps, whose outputs are packed with --packed-outputs
+PACKED_STEP_PREFIXES = ('step_01_', 'step_02_', 'step_03_', 'step_04_')
 
 def main():
     logging.basicConfig(level=logging.INFO)
     args = get_args()
 
-    Pipeline(**args.__dict__).run(input_dir=args.input_dir)
+    if args.plan:
+        print(format_plan(plan_run(
+            input_dir=args.input_dir,
+            core_count=args.core_count,
+            history=args.plan_history or [args.work_dir],
+            node_core_count=args.plan_node_core_count,
+            max_run_seconds=parse_duration(args.plan_max_run_time))))
+        return 0
+
+    run_pipeline(Pipeline(**args.__dict__), args)
     return 0
 
 
-def get_args():
+def run_pipeline(pipeline, args):
+    if args.previous_otus_fp is None:
+        return pipeline.run(input_dir=args.input_dir)
+    else:
+        return pipeline.run_incremental(
+            input_dir=args.input_dir,
+            previous_otus_fp=args.previous_otus_fp,
+            previous_otu_table_fp=args.previous_otu_table_fp)
+
+
+def get_args(argv=None):
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-i', '--input-dir', default='.',
                             help='path to the input directory')
     arg_parser.add_argument('-w', '--work-dir', default='.',
                             help='path to the output directory')
 
+    arg_parser.add_argument('--local-scratch', default=None,
+                            help='node-local directory (e.g. $TMPDIR or /dev/shm) in which to run each step, '
+                                 'step outputs are copied to the work directory when the step is complete')
+
     arg_parser.add_argument('-c', '--core-count', default=1, type=int,
                             help='number of cores to use')
 
@@ -65,7 +119,82 @@ def get_args():
     arg_parser.add_argument('--vsearch-derep-minuniquesize', required=True, type=int,
                             help='minimum unique size for vsearch -derep_fulllength')
 
-    args = arg_parser.parse_args()
+    arg_parser.add_argument('--otu-clustering-engine', default='usearch', choices=('usearch', 'native'),
+                            help='cluster OTUs in step 07 with usearch -cluster_otus or with the built-in greedy '
+                                 'clustering, which uses all cores, reads gzipped input and has no de novo chimera '
+                                 'filtering')
+    arg_parser.add_argument('--otu-identity', default=0.97, type=float,
+                            help='minimum identity of a sequence with its OTU centroid, in the native engine '
+                                 'and when step 09 maps reads to the OTUs')
+
+    arg_parser.add_argument('--chimera-shard-count', default=None, type=int,
+                            help='split each OTU file into this many shards for vsearch -uchime_ref, '
+                                 'by default enough shards to use all cores')
+
+    arg_parser.add_argument('--bgzf', action='store_true', default=False,
+                            help='write compressed intermediate files as BGZF, compressed and decompressed '
+                                 'in parallel by the pipeline and readable by any gzip reader')
+    arg_parser.add_argument('--compact-read-ids', action='store_true', default=False,
+                            help='replace read names with ids <sample>_<read> in step 01 and keep the original names '
+                                 'in step_01_copy_and_compress/read_names (see restore_read_names)')
+    arg_parser.add_argument('--bin-qualities', action='store_true', default=False,
+                            help='reduce quality scores to the 8 levels of Illumina binning in step 01, '
+                                 'before the quality filter of step 04')
+    arg_parser.add_argument('--packed-outputs', action='store_true', default=False,
+                            help='write the per-sample outputs of steps 01 to 04 into one archive per step, '
+                                 'outputs.pack, instead of one file per output (see unpack_step_outputs)')
+
+    arg_parser.add_argument('--plan', action='store_true', default=False,
+                            help='predict the run time, memory and scratch space of each step from the metrics '
+                                 'of earlier runs, recommend a core count and node count, and exit')
+    arg_parser.add_argument('--plan-history', nargs='+', default=None,
+                            help='work directories (or globs) of earlier runs for --plan, by default --work-dir')
+    arg_parser.add_argument('--plan-node-core-count', default=48, type=int,
+                            help='cores per node for --plan')
+    arg_parser.add_argument('--plan-max-run-time', default='12:00:00',
+                            help='maximum wall time (hh:mm:ss) of one job for --plan')
+
+    arg_parser.add_argument('--trace-fp', default=None,
+                            help='write a timeline of steps, samples, commands, compression and read QC to this '
+                                 'file in Chrome trace event format (open with https://ui.perfetto.dev)')
+
+    arg_parser.add_argument('--command-timeout', default=None, type=float,
+                            help='seconds after which an external command is stopped and the pipeline fails')
+
+    arg_parser.add_argument('--memory-limit', default=None, type=parse_memory_size,
+                            help='start no more jobs while the pipeline and its child processes use more memory '
+                                 'than this, e.g. 64G')
+    arg_parser.add_argument('--tracemalloc-top', default=0, type=int,
+                            help='trace Python allocations and log this many of the lines that allocated the most '
+                                 'memory in each step (slows down Python code)')
+    arg_parser.add_argument('--prefetch-depth', default=DEFAULT_PREFETCH_DEPTH, type=int,
+                            help='samples whose inputs are staged, or whose outputs are compressed, while the '
+                                 'tools run on other samples (default: %(default)s)')
+
+    arg_parser.add_argument('--otu-table-from-uniques', action='store_true', default=False,
+                            help='count unique sequences per sample in step 05 and build the OTU table from '
+                                 'their OTU assignments instead of searching every read in step 09')
+
+    arg_parser.add_argument('--fastqc', action='store_true', default=False,
+                            help='run FastQC on the .fastq files of every step in addition to the built-in read QC')
+    arg_parser.add_argument('--read-qc-html', action='store_true', default=False,
+                            help='write an HTML summary next to each read QC .json file')
+
+    arg_parser.add_argument('--previous-otus-fp', default=None,
+                            help='chimera-free OTU FASTA (*rad3.uchime.fasta) of a previous run, '
+                                 'map new samples to these OTUs instead of clustering')
+    arg_parser.add_argument('--previous-otu-table-fp', default=None,
+                            help='OTU table (.npz, .biom.json or otutab.txt) of a previous run, '
+                                 'new samples are appended to it')
+    arg_parser.add_argument('--sequence-index-fp', default=None,
+                            help='sequence index (.sequence_index.npz) saved by the run that made --previous-otus-fp, '
+                                 'reads already assigned by that run are not searched again')
+    arg_parser.add_argument('--recluster-unmapped-fraction', default=0.1, type=float,
+                            help='warn when more than this fraction of new reads do not map to existing OTUs')
+
+    args = arg_parser.parse_args(argv)
+    if (args.previous_otus_fp is None) != (args.previous_otu_table_fp is None):
+        arg_parser.error('--previous-otus-fp and --previous-otu-table-fp must be given together')
     return args
 
 
@@ -79,11 +208,79 @@ class Pipeline:
             vsearch_filter_maxee, vsearch_filter_trunclen,
             vsearch_derep_minuniquesize,
             uchime_ref_db_fp,
+            chimera_shard_count=None,
+            otu_clustering_engine='usearch',
+            otu_identity=0.97,
+            recluster_unmapped_fraction=0.1,
+            sequence_index_fp=None,
+            command_timeout=None,
+            otu_table_from_uniques=False,
+            fastqc=False,
+            read_qc_html=False,
+            job_scheduler=None,
+            local_scratch=None,
+            bgzf=False,
+            compact_read_ids=False,
+            bin_qualities=False,
+            trace_fp=None,
+            reference_cache=None,
+            prefetch_depth=None,
+            packed_outputs=False,
+            memory_limit=None,
+            tracemalloc_top=0,
             **kwargs  # allows some command line arguments to be ignored
     ):
 
         self.work_dir = work_dir
         self.core_count = core_count
+        self.command_timeout = command_timeout
+        # a JobScheduler may be shared by several pipelines to share one core budget
+        if job_scheduler is None:
+            self.job_scheduler = JobScheduler(
+                core_count=core_count, command_timeout=command_timeout, prefetch_depth=prefetch_depth,
+                memory_limit=memory_limit)
+        else:
+            self.job_scheduler = job_scheduler
+        # the memory limit is that of the job scheduler's command runner, which may be shared
+        self.memory_monitor = self.job_scheduler.command_runner.memory_monitor
+        self.tracemalloc_top = tracemalloc_top
+        # memory Measurements of the steps started by this pipeline, by step name
+        self.memory_measurements = {}
+        self.step_ledgers = {}
+        self.packed_outputs = packed_outputs
+        # StepArchives of the steps writing packed outputs, by output directory
+        self.step_archives = {}
+        # a batch.ReferenceCache may be shared by several pipelines to load references once
+        self.reference_cache = reference_cache
+        # StepMeters of the steps started by this pipeline, by step name
+        self.step_meters = {}
+        # set by run() and run_incremental() for the step metrics
+        self.input_description = None
+        if local_scratch is None:
+            self.local_scratch_dir = None
+        else:
+            self.local_scratch_dir = get_local_scratch_dir(local_scratch=local_scratch, work_dir=work_dir)
+
+        self.trace_fp = trace_fp
+        # each run has its own tracer, so the runs of a batch or a daemon do not trace one another
+        self.tracer = None if trace_fp is None else trace.Tracer()
+
+        self.bgzf = bgzf
+        if bgzf:
+            # used by the prepare() and finish() of jobs, which run outside the core budget and
+            # several at a time, so each (de)compresses with one thread
+            self.gzip_files = functools.partial(compress_files, threads=1)
+            self.ungzip_files = functools.partial(decompress_files, threads=1)
+        else:
+            self.gzip_files = gzip_files
+            self.ungzip_files = ungzip_files
+        self.compact_read_ids = compact_read_ids
+        self.bin_qualities = bin_qualities
+
+        self.fastqc = fastqc
+        self.read_qc_html = read_qc_html
+        # ReadQcCollectors filled by steps while writing .fastq files, keyed by output file path
+        self.read_qc_collectors = {}
 
         self.cutadapt_min_length = cutadapt_min_length
         self.forward_primer = forward_primer
@@ -99,6 +296,19 @@ class Pipeline:
         self.vsearch_derep_minuniquesize = vsearch_derep_minuniquesize
 
         self.uchime_ref_db_fp = uchime_ref_db_fp
+        if chimera_shard_count is None:
+            # enough shards that each gets as many threads as vsearch -uchime_ref uses well
+            self.chimera_shard_count = max(
+                1, self.core_count // TOOL_THREAD_PROFILES['vsearch_uchime_ref'].max_threads)
+        else:
+            self.chimera_shard_count = chimera_shard_count
+
+        self.otu_clustering_engine = otu_clustering_engine
+        self.otu_identity = otu_identity
+
+        self.recluster_unmapped_fraction = recluster_unmapped_fraction
+        self.sequence_index_fp = sequence_index_fp
+        self.otu_table_from_uniques = otu_table_from_uniques
 
         self.cutadapt_executable_fp = os.environ.get('CUTADAPT', default='cutadapt')
         self.pear_executable_fp = os.environ.get('PEAR', default='pear')
@@ -106,58 +316,249 @@ class Pipeline:
         self.vsearch_executable_fp = os.environ.get('VSEARCH', default='vsearch')
 
     def run(self, input_dir):
+        with self.tracing('run'):
+            self.input_description = describe_inputs(input_dir)
+            output_dir_list = list()
+            output_dir_list.append(self.step_01_copy_and_compress(input_dir=input_dir))
+            output_dir_list.append(self.step_02_remove_primers(input_dir=output_dir_list[-1]))
+            output_dir_list.append(self.step_03_merge_forward_reverse_reads_with_pear(input_dir=output_dir_list[-1]))
+            output_dir_list.append(self.step_04_qc_reads_with_vsearch(input_dir=output_dir_list[-1]))
+            output_dir_list.append(self.step_05_combine_runs(input_dir=output_dir_list[-1]))
+            output_dir_list.append(
+                self.step_06_dereplicate_sort_remove_low_abundance_reads(input_dir=output_dir_list[-1]))
+            output_dir_list.append(self.step_07_cluster_97_percent(input_dir=output_dir_list[-1]))
+            output_dir_list.append(self.step_08_reference_based_chimera_detection(input_dir=output_dir_list[-1]))
+            output_dir_list.append(self.step_09_create_otu_table(input_dir=output_dir_list[-1]))
+
+            return self.complete_run(output_dir_list)
+
+    def run_incremental(self, input_dir, previous_otus_fp, previous_otu_table_fp):
+        with self.tracing('run_incremental'):
+            self.input_description = describe_inputs(input_dir)
+            return self.complete_run(self.run_incremental_steps(input_dir, previous_otus_fp, previous_otu_table_fp))
+
+    @contextlib.contextmanager
+    def tracing(self, name):
+        # the trace is written even if a step fails
+        try:
+            with trace.use_tracer(self.tracer), \
+                    trace.span(name, 'pipeline', work_dir=self.work_dir, core_count=self.core_count):
+                yield
+        finally:
+            if self.tracer is not None:
+                trace.write_trace(self.trace_fp, self.tracer)
+
+    def run_incremental_steps(self, input_dir, previous_otus_fp, previous_otu_table_fp):
         output_dir_list = list()
         output_dir_list.append(self.step_01_copy_and_compress(input_dir=input_dir))
         output_dir_list.append(self.step_02_remove_primers(input_dir=output_dir_list[-1]))
         output_dir_list.append(self.step_03_merge_forward_reverse_reads_with_pear(input_dir=output_dir_list[-1]))
         output_dir_list.append(self.step_04_qc_reads_with_vsearch(input_dir=output_dir_list[-1]))
-        output_dir_list.append(self.step_05_combine_runs(input_dir=output_dir_list[-1]))
-        output_dir_list.append(self.step_06_dereplicate_sort_remove_low_abundance_reads(input_dir=output_dir_list[-1]))
-        output_dir_list.append(self.step_07_cluster_97_percent(input_dir=output_dir_list[-1]))
-        output_dir_list.append(self.step_08_reference_based_chimera_detection(input_dir=output_dir_list[-1]))
-        output_dir_list.append(self.step_09_create_otu_table(input_dir=output_dir_list[-1]))
-
+        output_dir_list.append(
+            self.step_09_map_new_samples_to_existing_otus(
+                input_dir=output_dir_list[2],
+                previous_otus_fp=previous_otus_fp,
+                previous_otu_table_fp=previous_otu_table_fp))
         return output_dir_list
 
-    def initialize_step(self):
+    def complete_run(self, output_dir_list):
+        # return the output directories in work_dir, all steps have been copied there
+        if self.local_scratch_dir is None:
+            return output_dir_list
+        remove_local_scratch_dir(self.local_scratch_dir)
+        return [self.get_durable_output_dir(output_dir) for output_dir in output_dir_list]
+
+    def initialize_step(self, input_dir=None):
         function_name = sys._getframe(1).f_code.co_name
         log = logging.getLogger(name=function_name)
+        self.step_meters[function_name] = StepMeter(function_name, input_dir=input_dir)
+        self.memory_measurements[function_name] = self.memory_monitor.begin(
+            function_name, tracemalloc_top=self.tracemalloc_top)
         output_dir = create_output_dir(output_dir_name=function_name, parent_dir=self.work_dir)
+        if self.local_scratch_dir is not None and not self.step_output_is_complete(output_dir):
+            # the outputs are copied to work_dir by complete_step
+            output_dir = create_output_dir(output_dir_name=function_name, parent_dir=self.local_scratch_dir)
+            log.info('running step in local scratch directory "%s"', output_dir)
         return log, output_dir
 
+    def get_durable_output_dir(self, output_dir):
+        return os.path.join(self.work_dir, os.path.basename(output_dir))
+
+    def step_output_is_complete(self, output_dir):
+        step_ledger = self.get_step_ledger(output_dir)
+        # a directory with outputs but no ledger is from a run that did not keep a ledger
+        return step_ledger.step_complete or (not step_ledger.exists() and len(get_output_names(output_dir)) > 0)
+
+    def step_is_complete(self, log, output_dir):
+        step_ledger = self.get_step_ledger(output_dir)
+        if self.step_output_is_complete(output_dir):
+            if not step_ledger.step_complete:
+                log.info('output directory "%s" is not empty and has no ledger', output_dir)
+            return True
+        else:
+            step_ledger.record_step_started()
+            if len(step_ledger.completed_samples) > 0:
+                log.info(
+                    'resuming step "%s", %d sample(s) already complete',
+                    os.path.basename(output_dir), len(step_ledger.completed_samples))
+            return False
+
+    def get_step_ledger(self, output_dir):
+        # the ledger is kept next to the output directory, in work_dir or in local scratch
+        if output_dir not in self.step_ledgers:
+            step_ledger = StepLedger(
+                get_step_ledger_fp(work_dir=os.path.dirname(output_dir), step_name=os.path.basename(output_dir)))
+            if step_ledger.exists() and len(get_output_names(output_dir)) == 0:
+                # the output directory was removed, so the ledger is no longer true
+                logging.getLogger(name=__name__).warning(
+                    'output directory "%s" is empty, discarding ledger "%s"', output_dir, step_ledger.ledger_fp)
+                step_ledger.reset()
+            self.step_ledgers[output_dir] = step_ledger
+        return self.step_ledgers[output_dir]
+
+    def initialize_sample(self, log, output_dir, sample_name):
+        # returns None if the sample was completed by an earlier run
+        if self.get_step_ledger(output_dir).sample_is_complete(sample_name):
+            log.info('sample "%s" is complete, it will be skipped', sample_name)
+            return None
+        else:
+            return create_sample_dir(output_dir=output_dir, sample_name=sample_name)
+
+    def outputs_are_packed(self, output_dir):
+        return self.packed_outputs and os.path.basename(output_dir).startswith(PACKED_STEP_PREFIXES)
+
+    def get_step_archive(self, output_dir):
+        if output_dir not in self.step_archives:
+            self.step_archives[output_dir] = StepArchive(get_archive_fp(output_dir))
+        return self.step_archives[output_dir]
+
+    def stage_inputs(self, input_fps, sample_dir):
+        """
+        The prepare() of a job reading outputs of an earlier step: packed outputs are
+        copied to the sample's staging directory, which complete_sample() removes.
+        Returns the paths the job reads its inputs from, see get_staged_fps().
+        """
+        staged_fps = stage_step_outputs(input_fps, staging_dir=os.path.join(sample_dir, STAGED_DIR_NAME))
+        stage_files(*staged_fps)
+        return staged_fps
+
+    def get_staged_fps(self, input_fps, sample_dir):
+        return get_staged_fps(input_fps, staging_dir=os.path.join(sample_dir, STAGED_DIR_NAME))
+
+    def stage_and_ungzip_inputs(self, input_fps, sample_dir):
+        return self.ungzip_files(*self.stage_inputs(input_fps, sample_dir), target_dir=sample_dir)
+
+    def complete_sample(self, output_dir, sample_dir, sample_name, finish=None):
+        if finish is not None:
+            finish()
+        shutil.rmtree(os.path.join(sample_dir, STAGED_DIR_NAME), ignore_errors=True)
+        output_names = []
+        if self.outputs_are_packed(output_dir):
+            # files are packed, subdirectories like pair_check are committed as usual
+            output_names.extend(self.get_step_archive(output_dir).add_sample_dir(sample_name, sample_dir))
+        output_names.extend(commit_sample_dir(sample_dir=sample_dir, output_dir=output_dir))
+        self.get_step_ledger(output_dir).record_sample_complete(sample_name=sample_name, outputs=output_names)
+
     def complete_step(self, log, output_dir):
         output_dir_list = sorted(os.listdir(output_dir))
+        step_ledger = self.get_step_ledger(output_dir)
+        # a step is skipped if its ledger says it is complete or it has outputs but no ledger
+        step_ran = step_ledger.exists() and not step_ledger.step_complete
         if len(output_dir_list) == 0:
             raise PipelineException('ERROR: no output files in directory "{}"'.format(output_dir))
+        elif step_ledger.step_complete:
+            log.info('read QC for "%s" is complete', output_dir)
         else:
             log.info('output files:\n\t%s', '\n\t'.join(os.listdir(output_dir)))
-            # apply FastQC to all .fastq files
             fastq_file_list = [
-                os.path.join(output_dir, output_file)
-                for output_file
-                in output_dir_list
-                if re.search(pattern=r'\.fastq(\.gz)?$', string=output_file)
+                output_fp
+                for output_fp
+                in find_step_outputs(output_dir, '*')
+                if re.search(pattern=r'\.fastq(\.gz)?$', string=output_fp)
             ]
 
             if len(fastq_file_list) == 0:
                 log.info('no .fastq files found in "{}"'.format(output_dir))
             else:
-                fastqc_output_dir = os.path.join(output_dir, 'fastqc_results')
-                os.makedirs(fastqc_output_dir, exist_ok=True)
-                run_cmd(
-                    [
+                self.run_read_qc(log, fastq_file_list=fastq_file_list, output_dir=output_dir)
+                if self.fastqc:
+                    self.run_fastqc(fastq_file_list=fastq_file_list, output_dir=output_dir)
+
+        step_ledger.record_step_complete()
+        durable_output_dir = self.get_durable_output_dir(output_dir)
+        if output_dir != durable_output_dir:
+            # copy the ledger last so the step is complete in work_dir only when all outputs are there
+            log.info('copying outputs from "%s" to "%s"', output_dir, durable_output_dir)
+            with trace.span('sync_dir', 'io', output_dir=output_dir):
+                copied_count = sync_dir(output_dir, durable_output_dir)
+            durable_step_ledger = self.get_step_ledger(durable_output_dir)
+            sync_file(step_ledger.ledger_fp, durable_step_ledger.ledger_fp)
+            self.step_ledgers.pop(durable_output_dir)
+            log.info('copied %d file(s)', copied_count)
+
+        memory_measurement = self.memory_measurements.pop(os.path.basename(output_dir), None)
+        memory_record = {} if memory_measurement is None else self.memory_monitor.end(memory_measurement)
+        if step_ran and len(memory_record) > 0:
+            log_memory_record(log, memory_record)
+
+        step_meter = self.step_meters.pop(os.path.basename(output_dir), None)
+        if step_ran and step_meter is not None and self.input_description is not None:
+            step_record = step_meter.get_record(
+                output_dir=durable_output_dir, core_count=self.core_count, input_description=self.input_description)
+            step_record.update(memory_record)
+            record_step_metrics(self.work_dir, step_record)
+
+    def run_read_qc(self, log, fastq_file_list, output_dir):
+        # files written by a step with a read QC tap are not read again
+        read_qc_output_dir = os.path.join(output_dir, 'read_qc')
+        os.makedirs(read_qc_output_dir, exist_ok=True)
+
+        def read_qc(fastq_fp):
+            read_qc_collector = self.read_qc_collectors.pop(fastq_fp, None)
+            with trace.span('read_qc', 'qc', file=os.path.basename(fastq_fp), tapped=read_qc_collector is not None):
+                if read_qc_collector is None:
+                    read_qc_collector = collect_read_qc(fastq_fp)
+                else:
+                    log.info('using read QC collected while writing "%s"', fastq_fp)
+                write_read_qc(
+                    read_qc_collector, fastq_fp=fastq_fp, qc_output_dir=read_qc_output_dir,
+                    write_html=self.read_qc_html)
+
+        self.job_scheduler.command_runner.run_functions([
+            functools.partial(read_qc, fastq_fp)
+            for fastq_fp
+            in fastq_file_list
+        ])
+
+    def run_fastqc(self, fastq_file_list, output_dir):
+        fastqc_output_dir = os.path.join(output_dir, 'fastqc_results')
+        os.makedirs(fastqc_output_dir, exist_ok=True)
+        # FastQC reads packed outputs from copies
+        staging_dir = os.path.join(output_dir, STAGED_DIR_NAME)
+        try:
+            self.job_scheduler.run([
+                Job(
+                    name='fastqc',
+                    tool='fastqc',
+                    cmd_line_list=[
                         'fastqc',
-                        '--threads', str(self.core_count),
                         '--outdir', fastqc_output_dir,
-                        *fastq_file_list
+                        *get_staged_fps(fastq_file_list, staging_dir=staging_dir)
                     ],
+                    threads_option='--threads',
+                    max_threads=len(fastq_file_list),
+                    prepare=functools.partial(stage_step_outputs, fastq_file_list, staging_dir=staging_dir),
                     log_file=os.path.join(fastqc_output_dir, 'log')
                 )
+            ])
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
+    @trace.traced('step')
     def step_01_copy_and_compress(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len(os.listdir(output_dir)) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             log.debug('output_dir: %s', output_dir)
             # Check for fasta and qual files
@@ -182,84 +583,161 @@ class Pipeline:
                         break
             input_file_glob = os.path.join(input_dir, '*.fastq*')
             log.debug('input_file_glob: %s', input_file_glob)
-            input_fp_list = sorted(glob.glob(input_file_glob))
+            # leave out BGZF indices of the input files
+            input_fp_list = sorted(fp for fp in glob.glob(input_file_glob) if not fp.endswith('.gzi'))
             log.info('input files: %s', input_fp_list)
 
             if len(input_fp_list) == 0:
                 raise PipelineException('found no fastq files in directory "{}"'.format(input_dir))
 
+            # read ids are numbered by sample, over all input files so a resumed step numbers them the same way
+            sample_numbers = get_sample_numbers(input_fp_list)
+            sample_dirs = {}
             for input_fp in input_fp_list:
-                destination_fp = os.path.join(output_dir, os.path.basename(input_fp))
-                if input_fp.endswith('.gz'):
-                    with open(input_fp, 'rb') as f, open(destination_fp, 'wb') as g:
-                        shutil.copyfileobj(fsrc=f, fdst=g)
-                else:
-                    destination_fp = destination_fp + '.gz'
-                    with open(input_fp, 'rt') as f, gzip.open(destination_fp, 'wt') as g:
-                        shutil.copyfileobj(fsrc=f, fdst=g)
+                sample_dir = self.initialize_sample(log, output_dir, sample_name=os.path.basename(input_fp))
+                if sample_dir is not None:
+                    sample_dirs[input_fp] = sample_dir
+            # each file is copied, checked and read QC'd in one pass, several files at a time
+            self.job_scheduler.command_runner.run_functions([
+                functools.partial(self.copy_and_check_fastq, output_dir, input_fp, sample_dir, sample_numbers[input_fp])
+                for input_fp, sample_dir in sample_dirs.items()
+            ])
+            # before any tool runs on the files
+            check_pairs(output_dir)
 
         self.complete_step(log, output_dir)
         return output_dir
 
+    def copy_and_check_fastq(self, output_dir, input_fp, sample_dir, sample_number):
+        """
+        Copy one input file of step 01, compressing or re-encoding it if needed, and
+        collect its read QC and pair check while it is read.
+        """
+        sample_name = os.path.basename(input_fp)
+        with trace.span(sample_name, 'sample'):
+            destination_fp = os.path.join(sample_dir, sample_name)
+            reencode = self.compact_read_ids or self.bin_qualities
+            read_qc_collector = ReadQcCollector()
+            pair_check_collector = PairCheckCollector()
+            encoder = None
+            with contextlib.ExitStack() as exit_stack:
+                if input_fp.endswith('.gz') and (not self.bgzf or is_bgzf(input_fp)) and not reencode:
+                    # the compressed file is copied unchanged
+                    g = None
+                    fastq_batches = read_fastq_batches(
+                        input_fp, copy_file=exit_stack.enter_context(open(destination_fp, 'wb')))
+                else:
+                    if not destination_fp.endswith('.gz'):
+                        destination_fp = destination_fp + '.gz'
+                    g = exit_stack.enter_context(
+                        open_sequence_file(destination_fp, 'wb', bgzf=self.bgzf, threads=self.core_count))
+                    if reencode:
+                        names_file = None
+                        if self.compact_read_ids:
+                            read_names_fp = get_read_names_fp(destination_fp)
+                            os.makedirs(os.path.dirname(read_names_fp), exist_ok=True)
+                            names_file = exit_stack.enter_context(open_sequence_file(
+                                read_names_fp, 'wb', bgzf=self.bgzf, threads=self.core_count))
+                        encoder = CompactReadEncoder(
+                            names_file=names_file,
+                            sample_number=sample_number,
+                            quality_bin_table=get_quality_bin_table() if self.bin_qualities else None)
+                    fastq_batches = read_fastq_batches(input_fp, threads=self.core_count)
+                try:
+                    for fastq_batch in fastq_batches:
+                        pair_check_collector.add_fastq_batch(fastq_batch)
+                        if encoder is not None:
+                            fastq_batch = encoder.encode(fastq_batch)
+                        if g is not None:
+                            g.write(fastq_batch.raw())
+                        read_qc_collector.add_fastq_batch(fastq_batch)
+                except (EOFError, OSError, zlib.error) as e:
+                    raise PipelineException('"{}" is truncated or corrupt: {}'.format(input_fp, e)) from e
+            write_pair_check(pair_check_collector, output_dir=sample_dir, fastq_fp=input_fp)
+            self.read_qc_collectors[os.path.join(output_dir, os.path.basename(destination_fp))] = read_qc_collector
+        self.complete_sample(output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name)
+
+    @trace.traced('step')
     def step_02_remove_primers(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len(os.listdir(output_dir)) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             log.info('using cutadapt "%s"', self.cutadapt_executable_fp)
 
+            jobs = []
             for forward_fastq_fp in get_forward_fastq_files(input_dir=input_dir):
-                log.info('removing forward primers from file "%s"', forward_fastq_fp)
                 forward_fastq_basename = os.path.basename(forward_fastq_fp)
+                sample_dir = self.initialize_sample(log, output_dir, sample_name=forward_fastq_basename)
+                if sample_dir is None:
+                    continue
+                log.info('removing forward primers from file "%s"', forward_fastq_fp)
 
                 reverse_fastq_fp = get_associated_reverse_fastq_fp(forward_fp=forward_fastq_fp)
                 log.info('removing reverse primers from file "%s"', reverse_fastq_fp)
 
                 trimmed_forward_fastq_fp = os.path.join(
-                    output_dir,
+                    sample_dir,
                     re.sub(
                         string=forward_fastq_basename,
                         pattern='_([0R])1',
                         repl=lambda m: '_trimmed_{}1'.format(m.group(1))))
                 trimmed_reverse_fastq_fp = os.path.join(
-                    output_dir,
+                    sample_dir,
                     re.sub(
                         string=forward_fastq_basename,
                         pattern='_([0R])1',
                         repl=lambda m: '_trimmed_{}2'.format(m.group(1))))
 
-                run_cmd([
+                jobs.append(Job(
+                    name=forward_fastq_basename,
+                    tool='cutadapt',
+                    cmd_line_list=[
                         self.cutadapt_executable_fp,
                         '-a', self.forward_primer,
                         '-A', self.reverse_primer,
                         '-o', trimmed_forward_fastq_fp,
                         '-p', trimmed_reverse_fastq_fp,
                         '-m', str(self.cutadapt_min_length),
-                        forward_fastq_fp,
-                        reverse_fastq_fp
+                        *self.get_staged_fps([forward_fastq_fp, reverse_fastq_fp], sample_dir)
                     ],
+                    input_size=get_file_size(forward_fastq_fp, reverse_fastq_fp),
+                    prepare=functools.partial(self.stage_inputs, [forward_fastq_fp, reverse_fastq_fp], sample_dir),
+                    finish=functools.partial(
+                        self.complete_sample,
+                        output_dir=output_dir, sample_dir=sample_dir, sample_name=forward_fastq_basename),
                     log_file = os.path.join(output_dir, 'log')
-                )
+                ))
+
+            self.job_scheduler.run(jobs)
 
-                self.complete_step(log, output_dir)
+        self.complete_step(log, output_dir)
         return output_dir
 
+    @trace.traced('step')
     def step_03_merge_forward_reverse_reads_with_vsearch(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len(os.listdir(output_dir)) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             log.info('vsearch executable: "%s"', self.vsearch_executable_fp)
 
+            jobs = []
             for forward_fastq_fp in get_forward_fastq_files(input_dir=input_dir):
+                sample_name = os.path.basename(forward_fastq_fp)
+                sample_dir = self.initialize_sample(log, output_dir, sample_name=sample_name)
+                if sample_dir is None:
+                    continue
                 reverse_fastq_fp = get_associated_reverse_fastq_fp(forward_fp=forward_fastq_fp)
+                staged_forward_fastq_fp, staged_reverse_fastq_fp = self.get_staged_fps(
+                    [forward_fastq_fp, reverse_fastq_fp], sample_dir)
 
                 joined_fastq_basename = re.sub(
                     string=os.path.basename(forward_fastq_fp),
                     pattern=r'_([0R]1)',
                     repl=lambda m: '_merged'.format(m.group(1))
                 )
-                joined_fastq_fp = os.path.join(output_dir, joined_fastq_basename)[:-3]
+                joined_fastq_fp = os.path.join(sample_dir, joined_fastq_basename)[:-3]
                 log.info('writing joined paired-end reads to "%s"', joined_fastq_fp)
 
                 notmerged_fwd_fastq_basename = re.sub(
@@ -267,49 +745,66 @@ class Pipeline:
                     pattern=r'_([0R]1)',
                     repl=lambda m: '_notmerged_fwd'.format(m.group(1))
                 )
-                notmerged_fwd_fastq_fp = os.path.join(output_dir, notmerged_fwd_fastq_basename)[:-3]
+                notmerged_fwd_fastq_fp = os.path.join(sample_dir, notmerged_fwd_fastq_basename)[:-3]
 
                 notmerged_rev_fastq_basename = re.sub(
                     string=os.path.basename(forward_fastq_fp),
                     pattern=r'_([0R]1)',
                     repl=lambda m: '_notmerged_rev'.format(m.group(1))
                 )
-                notmerged_rev_fastq_fp = os.path.join(output_dir, notmerged_rev_fastq_basename)[:-3]
+                notmerged_rev_fastq_fp = os.path.join(sample_dir, notmerged_rev_fastq_basename)[:-3]
 
-                run_cmd([
+                jobs.append(Job(
+                    name=sample_name,
+                    tool='vsearch_mergepairs',
+                    cmd_line_list=[
                         self.vsearch_executable_fp,
-                        '--fastq_mergepairs', forward_fastq_fp,
-                        '--reverse', reverse_fastq_fp,
+                        '--fastq_mergepairs', staged_forward_fastq_fp,
+                        '--reverse', staged_reverse_fastq_fp,
                         '--fastqout', joined_fastq_fp,
                         '--fastqout_notmerged_fwd', notmerged_fwd_fastq_fp,
                         '--fastqout_notmerged_rev', notmerged_rev_fastq_fp,
                         '--fastq_minovlen', str(self.pear_min_overlap),
                         '--fastq_maxlen', str(self.pear_max_assembly_length),
                         '--fastq_minlen', str(self.pear_min_assembly_length),
-                        '--threads', str(self.core_count)
                     ],
+                    threads_option='--threads',
+                    input_size=get_file_size(forward_fastq_fp, reverse_fastq_fp),
+                    prepare=functools.partial(self.stage_inputs, [forward_fastq_fp, reverse_fastq_fp], sample_dir),
+                    finish=functools.partial(
+                        self.complete_sample,
+                        output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name,
+                        finish=functools.partial(
+                            self.gzip_files, [joined_fastq_fp, notmerged_fwd_fastq_fp, notmerged_rev_fastq_fp])),
                     log_file = os.path.join(output_dir, 'log')
-                )
+                ))
 
-                gzip_files(glob.glob(os.path.join(output_dir, '*.fastq')))
+            self.job_scheduler.run(jobs)
 
         self.complete_step(log, output_dir)
         return output_dir
 
+    @trace.traced('step')
     def step_03_merge_forward_reverse_reads_with_pear(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len(os.listdir(output_dir)) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             log.info('PEAR executable: "%s"', self.pear_executable_fp)
 
+            jobs = []
             for compressed_forward_fastq_fp in get_forward_fastq_files(input_dir=input_dir):
+                sample_name = os.path.basename(compressed_forward_fastq_fp)
+                sample_dir = self.initialize_sample(log, output_dir, sample_name=sample_name)
+                if sample_dir is None:
+                    continue
                 compressed_reverse_fastq_fp = get_associated_reverse_fastq_fp(forward_fp=compressed_forward_fastq_fp)
 
-                forward_fastq_fp, reverse_fastq_fp = ungzip_files(
+                # the inputs are decompressed to sample_dir just before PEAR runs
+                forward_fastq_fp, reverse_fastq_fp = get_ungzipped_file_paths(
                     compressed_forward_fastq_fp,
                     compressed_reverse_fastq_fp,
-                    target_dir=output_dir
+                    target_dir=sample_dir
                 )
 
                 joined_fastq_basename = re.sub(
@@ -317,10 +812,13 @@ class Pipeline:
                     pattern=r'_([0R]1)',
                     repl=lambda m: '_merged'.format(m.group(1)))[:-6]
 
-                joined_fastq_fp_prefix = os.path.join(output_dir, joined_fastq_basename)
+                joined_fastq_fp_prefix = os.path.join(sample_dir, joined_fastq_basename)
                 log.info('joining paired ends from "%s" and "%s"', forward_fastq_fp, reverse_fastq_fp)
                 log.info('writing joined paired-end reads to "%s"', joined_fastq_fp_prefix)
-                run_cmd([
+                jobs.append(Job(
+                    name=sample_name,
+                    tool='pear',
+                    cmd_line_list=[
                         self.pear_executable_fp,
                         '-f', forward_fastq_fp,
                         '-r', reverse_fastq_fp,
@@ -328,134 +826,200 @@ class Pipeline:
                         '--min-overlap', str(self.pear_min_overlap),
                         '--max-assembly-length', str(self.pear_max_assembly_length),
                         '--min-assembly-length', str(self.pear_min_assembly_length),
-                        '-j', str(self.core_count)
                     ],
+                    threads_option='-j',
+                    input_size=get_file_size(compressed_forward_fastq_fp, compressed_reverse_fastq_fp),
+                    prepare=functools.partial(
+                        self.stage_and_ungzip_inputs, [compressed_forward_fastq_fp, compressed_reverse_fastq_fp],
+                        sample_dir),
+                    finish=functools.partial(
+                        self.complete_sample,
+                        output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name,
+                        finish=functools.partial(
+                            finish_pear,
+                            forward_fastq_fp=forward_fastq_fp,
+                            reverse_fastq_fp=reverse_fastq_fp,
+                            joined_fastq_fp_prefix=joined_fastq_fp_prefix,
+                            compress_files=self.gzip_files)),
                     log_file = os.path.join(output_dir, 'log')
-                )
+                ))
 
-                # delete the uncompressed input files
-                os.remove(forward_fastq_fp)
-                os.remove(reverse_fastq_fp)
-
-                gzip_files(glob.glob(joined_fastq_fp_prefix + '.*.fastq'))
+            self.job_scheduler.run(jobs)
 
         self.complete_step(log, output_dir)
         return output_dir
 
+    @trace.traced('step')
     def step_04_qc_reads_with_vsearch(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len(os.listdir(output_dir)) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             input_files_glob = os.path.join(input_dir, '*.assembled.fastq.gz')
             log.info('input file glob: "%s"', input_files_glob)
-            for assembled_fastq_fp in glob.glob(input_files_glob):
+            jobs = []
+            for assembled_fastq_fp in find_step_outputs(input_dir, '*.assembled.fastq.gz'):
                 input_file_basename = os.path.basename(assembled_fastq_fp)
+                sample_dir = self.initialize_sample(log, output_dir, sample_name=input_file_basename)
+                if sample_dir is None:
+                    continue
                 output_file_basename = re.sub(
                     string=input_file_basename,
                     pattern='\.fastq\.gz',
                     repl='.ee{}trunc{}.fastq.gz'.format(self.vsearch_filter_maxee, self.vsearch_filter_trunclen)[:-3]
                 )
-                output_fastq_fp = os.path.join(output_dir, output_file_basename)
+                output_fastq_fp = os.path.join(sample_dir, output_file_basename)
 
                 log.info('vsearch executable: "%s"', self.vsearch_executable_fp)
                 log.info('filtering "%s"', assembled_fastq_fp)
-                run_cmd([
+                jobs.append(Job(
+                    name=input_file_basename,
+                    tool='vsearch_filter',
+                    cmd_line_list=[
                         self.vsearch_executable_fp,
-                        '-fastq_filter', assembled_fastq_fp,
+                        '-fastq_filter', *self.get_staged_fps([assembled_fastq_fp], sample_dir),
                         '-fastqout', output_fastq_fp,
                         '-fastq_maxee', str(self.vsearch_filter_maxee),
                         '-fastq_trunclen', str(self.vsearch_filter_trunclen),
-                        '-threads', str(self.core_count)
                     ],
+                    threads_option='-threads',
+                    input_size=get_file_size(assembled_fastq_fp),
+                    prepare=functools.partial(self.stage_inputs, [assembled_fastq_fp], sample_dir),
+                    finish=functools.partial(
+                        self.complete_sample,
+                        output_dir=output_dir, sample_dir=sample_dir, sample_name=input_file_basename,
+                        finish=functools.partial(self.gzip_files, [output_fastq_fp])),
                     log_file = os.path.join(output_dir, 'log')
-                )
+                ))
 
-            gzip_files(glob.glob(os.path.join(output_dir, '*.assembled.*.fastq')))
+            self.job_scheduler.run(jobs)
 
         self.complete_step(log, output_dir)
         return output_dir
 
+    @trace.traced('step')
     def step_05_combine_runs(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len(os.listdir(output_dir)) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             log.info('input directory listing:\n\t%s', '\n\t'.join(os.listdir(input_dir)))
             input_files_glob = os.path.join(input_dir, '*.assembled.*.fastq.gz')
             log.info('input file glob: "%s"', input_files_glob)
-            input_fp_list = sorted(glob.glob(input_files_glob))
+            input_fp_list = find_step_outputs(input_dir, '*.assembled.*.fastq.gz')
             log.info('combining files:\n\t%s', '\n\t'.join(input_fp_list))
 
             output_file_name = get_combined_file_name(input_fp_list=input_fp_list)
 
             log.info('combined file: "%s"', output_file_name)
-            output_fp = os.path.join(output_dir, output_file_name)
-            with gzip.open(output_fp, 'wt') as output_file:
-                for input_fp in input_fp_list:
-                    with gzip.open(input_fp, 'rt') as input_file:
-                        shutil.copyfileobj(fsrc=input_file, fdst=output_file)
+            sample_dir = self.initialize_sample(log, output_dir, sample_name=output_file_name)
+            if sample_dir is not None:
+                output_fp = os.path.join(sample_dir, output_file_name)
+                read_qc_collector = ReadQcCollector()
+                unique_sequence_counter = UniqueSequenceCounter()
+                with open_sequence_file(output_fp, 'wb', bgzf=self.bgzf, threads=self.core_count) as output_file:
+                    for input_fp in input_fp_list:
+                        sequence_counts = collections.Counter()
+                        for fastq_batch in read_fastq_batches(input_fp, threads=self.core_count):
+                            output_file.write(fastq_batch.raw())
+                            read_qc_collector.add_fastq_batch(fastq_batch)
+                            if self.otu_table_from_uniques:
+                                sequence_counts.update(map(bytes.upper, fastq_batch.sequences()))
+                        if self.otu_table_from_uniques:
+                            unique_sequence_counter.add_sample(get_sample_name(input_fp), sequence_counts)
+                self.read_qc_collectors[os.path.join(output_dir, output_file_name)] = read_qc_collector
+
+                if self.otu_table_from_uniques:
+                    uniques_fp_prefix = os.path.join(
+                        sample_dir, re.sub(string=output_file_name, pattern='\.fastq\.gz$', repl='.uniques'))
+                    log.info(
+                        '%d unique sequences in %d samples',
+                        len(unique_sequence_counter.unique_index), len(unique_sequence_counter.sample_ids))
+                    unique_sequence_counter.write_fasta(
+                        uniques_fp_prefix + '.fasta.gz', bgzf=self.bgzf, threads=self.core_count)
+                    write_otu_table_npz(unique_sequence_counter.get_table(), uniques_fp_prefix + '.npz')
+                self.complete_sample(output_dir=output_dir, sample_dir=sample_dir, sample_name=output_file_name)
 
         self.complete_step(log, output_dir)
         return output_dir
 
+    @trace.traced('step')
     def step_06_dereplicate_sort_remove_low_abundance_reads(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len(os.listdir(output_dir)) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             log.info('input directory listing:\n\t%s', '\n\t'.join(os.listdir(input_dir)))
             input_files_glob = os.path.join(input_dir, '*.assembled.*.fastq.gz')
             log.info('input file glob: "%s"', input_files_glob)
             input_fp_list = sorted(glob.glob(input_files_glob))
 
+            jobs = []
             for input_fp in input_fp_list:
+                sample_name = os.path.basename(input_fp)
+                sample_dir = self.initialize_sample(log, output_dir, sample_name=sample_name)
+                if sample_dir is None:
+                    continue
                 output_fp = os.path.join(
-                    output_dir,
+                    sample_dir,
                     re.sub(
                         string=os.path.basename(input_fp),
                         pattern='\.fastq\.gz$',
                         repl='.derepmin{}.fasta'.format(self.vsearch_derep_minuniquesize)))
 
                 uc_fp = os.path.join(
-                    output_dir,
+                    sample_dir,
                     re.sub(
                         string=os.path.basename(input_fp),
                         pattern='\.fastq\.gz$',
                         repl='.derepmin{}.txt'.format(self.vsearch_derep_minuniquesize)))
 
-                run_cmd([
+                jobs.append(Job(
+                    name=sample_name,
+                    tool='vsearch_derep',
+                    cmd_line_list=[
                         self.vsearch_executable_fp,
                         '-derep_fulllength', input_fp,
                         '-output', output_fp,
                         '-uc', uc_fp,
                         '-sizeout',
                         '-minuniquesize', str(self.vsearch_derep_minuniquesize),
-                        '-threads', str(self.core_count)
                     ],
+                    threads_option='-threads',
+                    input_size=get_file_size(input_fp),
+                    finish=functools.partial(
+                        self.complete_sample,
+                        output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name,
+                        finish=functools.partial(self.gzip_files, [output_fp])),
                     log_file = os.path.join(output_dir, 'log')
-                )
+                ))
 
-            gzip_files(glob.glob(os.path.join(output_dir, '*.fasta')))
+            self.job_scheduler.run(jobs)
 
         self.complete_step(log, output_dir)
         return output_dir
 
+    @trace.traced('step')
     def step_07_cluster_97_percent(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len(os.listdir(output_dir)) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             # can usearch read gzipped files? no
             input_files_glob = os.path.join(input_dir, '*.fasta.gz')
             input_fp_list = sorted(glob.glob(input_files_glob))
 
+            jobs = []
             for compressed_input_fp in input_fp_list:
+                sample_name = os.path.basename(compressed_input_fp)
+                sample_dir = self.initialize_sample(log, output_dir, sample_name=sample_name)
+                if sample_dir is None:
+                    continue
 
-                input_fp, *_ = ungzip_files(compressed_input_fp, target_dir=output_dir)
+                input_fp, *_ = get_ungzipped_file_paths(compressed_input_fp, target_dir=sample_dir)
                 log.debug('input_fp: "%s"', input_fp)
                 otu_output_fp = os.path.join(
-                    output_dir,
+                    sample_dir,
                     re.sub(
                         string=os.path.basename(input_fp),
                         pattern='\.fasta$',
@@ -464,7 +1028,7 @@ class Pipeline:
                 )
 
                 uparse_output_fp = os.path.join(
-                    output_dir,
+                    sample_dir,
                     re.sub(
                         string=os.path.basename(input_fp),
                         pattern='\.fasta$',
@@ -472,38 +1036,65 @@ class Pipeline:
                     )
                 )
 
-                run_cmd([
-                        self.usearch_executable_fp,
-                        '-cluster_otus', input_fp,
-                        '-otus', otu_output_fp,
-                        '-relabel', 'OTU_',
-                        # '-sizeout',
-                        '-uparseout', uparse_output_fp
-                    ],
-                    log_file = os.path.join(output_dir, 'log')
-                )
-
-                os.remove(input_fp)
+                if self.otu_clustering_engine == 'native':
+                    # the native engine reads the gzipped input directly and holds all cores of the run,
+                    # taken from the shared core budget like any job
+                    with trace.span('cluster_otus', 'clustering', sample=sample_name):
+                        self.job_scheduler.command_runner.run_functions([
+                            functools.partial(
+                                cluster_otus, compressed_input_fp, otu_output_fp, uparse_output_fp,
+                                identity=self.otu_identity, threads=self.core_count)
+                        ], cores=self.core_count)
+                    self.complete_sample(output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name)
+                else:
+                    # usearch -cluster_otus is single-threaded and has no threads option
+                    jobs.append(Job(
+                        name=sample_name,
+                        tool='usearch_cluster_otus',
+                        cmd_line_list=[
+                            self.usearch_executable_fp,
+                            '-cluster_otus', input_fp,
+                            '-otus', otu_output_fp,
+                            '-relabel', 'OTU_',
+                            # '-sizeout',
+                            '-uparseout', uparse_output_fp
+                        ],
+                        input_size=get_file_size(compressed_input_fp),
+                        prepare=functools.partial(self.ungzip_files, compressed_input_fp, target_dir=sample_dir),
+                        finish=functools.partial(
+                            self.complete_sample,
+                            output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name,
+                            finish=functools.partial(os.remove, input_fp)),
+                        log_file = os.path.join(output_dir, 'log')
+                    ))
+
+            self.job_scheduler.run(jobs)
 
         self.complete_step(log, output_dir)
         return output_dir
 
+    @trace.traced('step')
     def step_08_reference_based_chimera_detection(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len([entry for entry in os.scandir(output_dir) if not entry.name.startswith('.')]) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             input_fps = glob.glob(os.path.join(input_dir, '*.fasta'))
+            jobs = []
             for input_fp in input_fps:
+                sample_name = os.path.basename(input_fp)
+                sample_dir = self.initialize_sample(log, output_dir, sample_name=sample_name)
+                if sample_dir is None:
+                    continue
                 uchimeout_fp = os.path.join(
-                    output_dir,
+                    sample_dir,
                     re.sub(
                         string=os.path.basename(input_fp),
                         pattern='\.fasta$',
                         repl='.uchime.txt'))
 
                 notmatched_fp = os.path.join(
-                    output_dir,
+                    sample_dir,
                     re.sub(
                         string=os.path.basename(input_fp),
                         pattern='\.fasta$',
@@ -526,77 +1117,526 @@ class Pipeline:
                 )
                 '''
 
-                run_cmd([
+                shard_count = min(self.chimera_shard_count, count_fasta_records(input_fp))
+                if shard_count > 1:
+                    jobs.extend(
+                        self.get_chimera_shard_jobs(
+                            input_fp=input_fp, shard_count=shard_count,
+                            uchimeout_fp=uchimeout_fp, notmatched_fp=notmatched_fp,
+                            output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name))
+                    continue
+
+                jobs.append(Job(
+                    name=sample_name,
+                    tool='vsearch_uchime_ref',
+                    cmd_line_list=[
                         self.vsearch_executable_fp,
                         '-uchime_ref', input_fp,
                         '-db', self.uchime_ref_db_fp,
                         '-uchimeout', uchimeout_fp,
                         '-nonchimeras', notmatched_fp,
-                        '-threads', str(self.core_count)
                     ],
+                    threads_option='-threads',
+                    input_size=get_file_size(input_fp),
+                    finish=functools.partial(
+                        self.complete_sample,
+                        output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name),
                     log_file = os.path.join(output_dir, 'log')
-                )
+                ))
+
+            self.job_scheduler.run(jobs)
 
         self.complete_step(log, output_dir)
         return output_dir
 
+    def get_chimera_shard_jobs(
+            self, input_fp, shard_count, uchimeout_fp, notmatched_fp, output_dir, sample_dir, sample_name):
+        """
+        Split input_fp into consecutive shards and return one vsearch -uchime_ref job
+        per shard. Each query is classified against the reference alone, so joining
+        the shard outputs in shard order gives the output of a single run. The last
+        shard job to finish joins the outputs and completes the sample.
+        """
+        shard_dir = os.path.join(sample_dir, 'shards')
+        os.mkdir(shard_dir)
+        shard_fps = [
+            os.path.join(shard_dir, 'shard_{:04d}.fasta'.format(i))
+            for i
+            in range(shard_count)
+        ]
+        split_fasta_file(input_fp, shard_fps)
+
+        def join_shard_outputs():
+            concatenate_files([fp + '.uchime.txt' for fp in shard_fps], uchimeout_fp)
+            concatenate_files([fp + '.uchime.fasta' for fp in shard_fps], notmatched_fp)
+            shutil.rmtree(shard_dir)
+
+        finish = call_after_all(
+            shard_count,
+            functools.partial(
+                self.complete_sample,
+                output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name,
+                finish=join_shard_outputs))
+
+        return [
+            Job(
+                name='{} shard {}'.format(sample_name, i),
+                tool='vsearch_uchime_ref',
+                cmd_line_list=[
+                    self.vsearch_executable_fp,
+                    '-uchime_ref', shard_fp,
+                    '-db', self.uchime_ref_db_fp,
+                    '-uchimeout', shard_fp + '.uchime.txt',
+                    '-nonchimeras', shard_fp + '.uchime.fasta',
+                ],
+                threads_option='-threads',
+                input_size=get_file_size(shard_fp),
+                finish=finish,
+                log_file=os.path.join(output_dir, 'log')
+            )
+            for i, shard_fp
+            in enumerate(shard_fps)
+        ]
+
+    @trace.traced('step')
     def step_09_create_otu_table(self, input_dir):
-        log, output_dir = self.initialize_step()
-        if len([entry for entry in os.scandir(output_dir) if not entry.name.startswith('.')]) > 0:
-            log.info('output directory "%s" is not empty, this step will be skipped', output_dir)
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
         else:
             otus_fp, *_ = glob.glob(os.path.join(input_dir, '*rad3.uchime.fasta'))
-            input_fps = glob.glob(os.path.join(self.work_dir, 'step_03*', '*.assembled.fastq.gz'))
-            for input_fp in input_fps:
-                fasta_fp = os.path.join(
+            sequence_index = SequenceIndex.from_fasta_records(read_fasta_records(otus_fp))
+            if self.otu_table_from_uniques:
+                uniques_fasta_fp = self.get_uniques_fasta_fp()
+                otu_table, _ = self.build_otu_table_from_uniques(
+                    log=log, otus_fp=otus_fp, uniques_fasta_fp=uniques_fasta_fp, output_dir=output_dir,
+                    sequence_index=sequence_index)
+                merged_otu_table_fp_prefix = os.path.join(
                     output_dir,
                     re.sub(
-                        string=os.path.basename(input_fp),
-                        pattern='\.fastq\.gz',
-                        repl='.fasta'))
-
-                log.info('convert fastq file\n\t%s\nto fasta file\n\t%s', input_fp, fasta_fp)
-                run_cmd([
-                    self.vsearch_executable_fp,
-                    '--fastq_filter', input_fp,
-                    '--fastaout', fasta_fp
-                    ],
-                    log_file=os.path.join(output_dir, 'log')
-                )
-
-                otu_table_fp = os.path.join(
-                    output_dir,
-                    re.sub(
-                        string=os.path.basename(input_fp),
-                        pattern='\.assembled\.fastq\.gz$',
-                        repl='.uchime.otutab.txt'
+                        string=os.path.basename(uniques_fasta_fp),
+                        pattern='\.assembled\..*uniques\.fasta\.gz$',
+                        repl='.uchime.otutab.merged'
                     )
                 )
-                otu_table_biom_fp = os.path.join(
+            else:
+                input_fps = self.glob_step_outputs('step_03*', '*.assembled.fastq.gz')
+                self.map_reads_to_otus(
+                    log=log, otus_fp=otus_fp, input_fps=input_fps, output_dir=output_dir,
+                    sequence_index=sequence_index)
+
+                otu_table, _ = self.build_otu_table(
+                    log=log, otus_fp=otus_fp, input_fps=input_fps, output_dir=output_dir)
+                merged_otu_table_fp_prefix = os.path.join(
                     output_dir,
                     re.sub(
-                        string=os.path.basename(input_fp),
+                        string=get_combined_file_name(input_fp_list=sorted(input_fps)),
                         pattern='\.assembled\.fastq\.gz$',
-                        repl='.uchime.otutab.json'
+                        repl='.uchime.otutab.merged'
                     )
                 )
+            write_otu_tables(otu_table, merged_otu_table_fp_prefix)
+            write_sample_otu_tables(otu_table, output_dir)
+            sequence_index.save(merged_otu_table_fp_prefix + '.sequence_index.npz')
 
-                run_cmd([
-                        self.vsearch_executable_fp,
-                        '--usearch_global', fasta_fp,
-                        '--db', otus_fp,
-                        '--id', '0.97',
-                        '--biomout', otu_table_biom_fp,
-                        '--otutabout', otu_table_fp
-                    ],
-                    log_file = os.path.join(output_dir, 'log')
+        self.complete_step(log, output_dir)
+        return output_dir
+
+    @trace.traced('step')
+    def step_09_map_new_samples_to_existing_otus(self, input_dir, previous_otus_fp, previous_otu_table_fp):
+        """
+        Incremental alternative to steps 05 - 09: map the assembled reads in input_dir
+        to the OTUs of a previous run and append the new samples as columns of the
+        previous run's OTU table. Clustering and chimera detection are not repeated.
+        """
+        log, output_dir = self.initialize_step(input_dir=input_dir)
+        if self.step_is_complete(log, output_dir):
+            log.info('output directory "%s" is complete, this step will be skipped', output_dir)
+        else:
+            input_fps = find_step_outputs(input_dir, '*.assembled.fastq.gz')
+            if len(input_fps) == 0:
+                raise PipelineException('found no assembled reads in directory "{}"'.format(input_dir))
+            sequence_index = self.load_reference(
+                functools.partial(
+                    load_sequence_index, otus_fp=previous_otus_fp, sequence_index_fp=self.sequence_index_fp),
+                previous_otus_fp, self.sequence_index_fp)
+            self.map_reads_to_otus(
+                log=log, otus_fp=previous_otus_fp, input_fps=input_fps, output_dir=output_dir,
+                sequence_index=sequence_index)
+            new_otu_table, read_counts = self.build_otu_table(
+                log=log, otus_fp=previous_otus_fp, input_fps=input_fps, output_dir=output_dir)
+
+            log.info('reading previous OTU table "%s"', previous_otu_table_fp)
+            previous_otu_table = read_otu_table(previous_otu_table_fp)
+            repeated_sample_ids = set(previous_otu_table.sample_ids).intersection(new_otu_table.sample_ids)
+            if len(repeated_sample_ids) > 0:
+                raise PipelineException(
+                    'samples already in OTU table "{}": {}'.format(
+                        previous_otu_table_fp, ', '.join(sorted(repeated_sample_ids))))
+            otu_table = merge_otu_tables([previous_otu_table, new_otu_table])
+
+            otu_table_fp_prefix = os.path.join(
+                output_dir,
+                re.sub(
+                    string=os.path.basename(previous_otu_table_fp),
+                    pattern='(\.npz|\.biom|\.json|\.biom\.json|\.txt)(\.gz)?$',
+                    repl='.incremental'
                 )
+            )
+            write_otu_tables(otu_table, otu_table_fp_prefix)
+            write_sample_otu_tables(new_otu_table, output_dir)
+            sequence_index.save(otu_table_fp_prefix + '.sequence_index.npz')
 
-                # os.remove(fasta_fp)
+            self.write_unmapped_read_report(
+                log=log, read_counts=read_counts, report_fp=os.path.join(output_dir, 'unmapped_reads.tsv'))
 
         self.complete_step(log, output_dir)
         return output_dir
 
+    def load_reference(self, load, *fps):
+        """
+        Return load(), or a copy of the result of an earlier load() of the same files
+        if this pipeline shares a reference cache.
+        """
+        if self.reference_cache is None:
+            return load()
+        else:
+            return self.reference_cache.get(load, *fps).copy()
+
+    def open_reference_kmer_index(self):
+        """
+        Return the k-mer index of the chimera reference, built next to the reference
+        the first time it is used and opened once for all runs sharing a reference
+        cache, or None if there is no reference or it can not be indexed there.
+        """
+        if not self.uchime_ref_db_fp:
+            return None
+        load = functools.partial(open_kmer_index, self.uchime_ref_db_fp)
+        try:
+            with trace.span('open_kmer_index', 'reference', fasta=os.path.basename(self.uchime_ref_db_fp)):
+                if self.reference_cache is None:
+                    return load()
+                else:
+                    # the index is read-only, all runs can share it
+                    return self.reference_cache.get(load, self.uchime_ref_db_fp)
+        except OSError as e:
+            logging.getLogger(name=__name__).warning(
+                'can not index reference "%s": %s', self.uchime_ref_db_fp, e)
+            return None
+
+    def map_reads_to_otus(self, log, otus_fp, input_fps, output_dir, sequence_index):
+        """
+        Reads found in sequence_index are counted directly, the remaining distinct
+        sequences of each sample are searched against the OTUs with vsearch and
+        their assignments are added to sequence_index.
+        """
+        jobs = []
+        for input_fp in input_fps:
+            sample_name = os.path.basename(input_fp)
+            sample_dir = self.initialize_sample(log, output_dir, sample_name=sample_name)
+            if sample_dir is None:
+                continue
+            fasta_fp = os.path.join(
+                sample_dir,
+                re.sub(
+                    string=os.path.basename(input_fp),
+                    pattern='\.fastq\.gz',
+                    repl='.index_misses.fasta'))
+            index_hits_fp = os.path.join(sample_dir, get_sample_name(input_fp) + '.index_hits.tsv')
+            otu_table_uc_fp = os.path.join(sample_dir, get_sample_name(input_fp) + '.uchime.otutab.uc')
+
+            jobs.append(Job(
+                name=sample_name,
+                tool='vsearch_usearch_global',
+                cmd_line_list=[
+                    self.vsearch_executable_fp,
+                    '--usearch_global', fasta_fp,
+                    '--db', otus_fp,
+                    '--id', str(self.otu_identity),
+                    '--uc', otu_table_uc_fp
+                ],
+                threads_option='--threads',
+                input_size=get_file_size(input_fp),
+                prepare=functools.partial(
+                    split_sequence_index_hits,
+                    input_fp, sequence_index=sequence_index, index_hits_fp=index_hits_fp, misses_fasta_fp=fasta_fp),
+                finish=functools.partial(
+                    self.complete_sample,
+                    output_dir=output_dir, sample_dir=sample_dir, sample_name=sample_name,
+                    finish=functools.partial(grow_sequence_index, sequence_index, uc_fp=otu_table_uc_fp)),
+                log_file = os.path.join(output_dir, 'log')
+            ))
+
+        self.job_scheduler.run(jobs)
+
+    def build_otu_table(self, log, otus_fp, input_fps, output_dir):
+        # build one sparse table for all samples from the per-sample .uc files
+        otu_table_builder = OtuTableBuilder(otu_ids=get_fasta_labels(otus_fp))
+        read_counts = {}
+        for input_fp in sorted(input_fps):
+            sample_name = get_sample_name(input_fp)
+            otu_table_uc_fp = os.path.join(output_dir, sample_name + '.uchime.otutab.uc')
+            mapped, unmapped = otu_table_builder.add_mapping_file(otu_table_uc_fp, sample_id=sample_name)
+            index_hits_fp = os.path.join(output_dir, sample_name + '.index_hits.tsv')
+            if os.path.exists(index_hits_fp):
+                with open(index_hits_fp, 'rt') as index_hits_file:
+                    for line in index_hits_file:
+                        otu_id, count = line.rstrip('\n').split('\t')
+                        otu_table_builder.add(otu_id=otu_id, sample_id=sample_name, count=int(count))
+                        mapped += int(count)
+            log.info('sample "%s": %d reads mapped to OTUs, %d not mapped', sample_name, mapped, unmapped)
+            read_counts[sample_name] = (mapped, unmapped)
+        return otu_table_builder.build(), read_counts
+
+    def glob_step_outputs(self, step_dir_glob, file_glob):
+        # prefer the local scratch copy of the outputs of an earlier step
+        for parent_dir in (self.local_scratch_dir, self.work_dir):
+            if parent_dir is not None:
+                fps = [
+                    fp
+                    for step_dir in sorted(glob.glob(os.path.join(parent_dir, step_dir_glob)))
+                    for fp in find_step_outputs(step_dir, file_glob)
+                ]
+                if len(fps) > 0:
+                    return fps
+        return []
+
+    def get_uniques_fasta_fp(self):
+        uniques_fasta_fps = self.glob_step_outputs('step_05*', '*.uniques.fasta.gz')
+        if len(uniques_fasta_fps) != 1:
+            raise PipelineException(
+                'expected one unique sequence file from step 05 but found {}, '
+                'was step 05 run with --otu-table-from-uniques?'.format(len(uniques_fasta_fps)))
+        return uniques_fasta_fps[0]
+
+    def add_clustered_sequences(self, sequence_index):
+        """
+        Add the unique sequences that step 07 put in the cluster of an indexed
+        centroid to sequence_index.
+        """
+        derep_sequences = {}
+        for derep_fp in self.glob_step_outputs('step_06*', '*.fasta.gz'):
+            for label, sequence in read_fasta_records(derep_fp):
+                derep_sequences[strip_label_annotations(label)] = sequence
+        for uparse_fp in self.glob_step_outputs('step_07*', '*.rad3.txt'):
+            for query_label, centroid_label in read_mapping_records(uparse_fp, fmt='uparse'):
+                if centroid_label is None:
+                    continue
+                centroid_sequence = derep_sequences.get(strip_label_annotations(centroid_label))
+                query_sequence = derep_sequences.get(strip_label_annotations(query_label))
+                if centroid_sequence is None or query_sequence is None:
+                    continue
+                # centroids of chimeric OTUs are not in the index
+                otu_id = sequence_index.get(centroid_sequence)
+                if otu_id is not None:
+                    sequence_index.add(query_sequence, otu_id)
+
+    def build_otu_table_from_uniques(self, log, otus_fp, uniques_fasta_fp, output_dir, sequence_index):
+        """
+        Assign each unique sequence counted in step 05 to an OTU and build the OTU
+        table from the per-sample unique sequence counts. Unique sequences that were
+        clustered in step 07 are assigned by exact sequence match, the rest are
+        searched against the OTUs in one vsearch --usearch_global run.
+        """
+        otu_ids = get_fasta_labels(otus_fp)
+        otu_index = {otu_id: i for i, otu_id in enumerate(otu_ids)}
+        unique_counts = read_otu_table_npz(re.sub(string=uniques_fasta_fp, pattern='\.fasta\.gz$', repl='.npz'))
+        self.add_clustered_sequences(sequence_index)
+        assignment = np.fromiter(
+            (
+                otu_index.get(sequence_index.get(sequence), -1)
+                for _, sequence
+                in read_fasta_records(uniques_fasta_fp)
+            ),
+            dtype=np.int64, count=len(unique_counts.otu_ids))
+        residual_count = int(np.count_nonzero(assignment < 0))
+        log.info(
+            '%d of %d unique sequences assigned to OTUs by exact match, %d will be searched',
+            len(assignment) - residual_count, len(assignment), residual_count)
+
+        residual_uc_fp = os.path.join(output_dir, 'residual_uniques.uc')
+        sample_dir = self.initialize_sample(log, output_dir, sample_name='residual_uniques')
+        if sample_dir is not None:
+            residual_fasta_fp = os.path.join(sample_dir, 'residual_uniques.fasta')
+            with open_sequence_file(residual_fasta_fp, 'wb') as residual_fasta_file:
+                for i, (label, sequence) in enumerate(read_fasta_records(uniques_fasta_fp)):
+                    if assignment[i] < 0:
+                        residual_fasta_file.write(format_fasta_record(label.encode(), sequence))
+            if residual_count == 0:
+                open(os.path.join(sample_dir, os.path.basename(residual_uc_fp)), 'wt').close()
+                self.complete_sample(output_dir=output_dir, sample_dir=sample_dir, sample_name='residual_uniques')
+            else:
+                self.search_residual_uniques(
+                    otus_fp=otus_fp, residual_fasta_fp=residual_fasta_fp,
+                    residual_uc_fp=os.path.join(sample_dir, os.path.basename(residual_uc_fp)),
+                    output_dir=output_dir, sample_dir=sample_dir)
+
+        for query_label, target_label in read_mapping_records(residual_uc_fp, fmt='uc'):
+            if target_label is not None:
+                assignment[get_unique_index(query_label)] = otu_index[strip_label_annotations(target_label)]
+
+        otu_table, mapped_reads, unmapped_reads = assign_unique_counts(
+            unique_counts, assignment=assignment, otu_ids=otu_ids)
+        read_counts = {}
+        for sample_name, mapped, unmapped in zip(
+                unique_counts.sample_ids, mapped_reads.tolist(), unmapped_reads.tolist()):
+            log.info('sample "%s": %d reads mapped to OTUs, %d not mapped', sample_name, mapped, unmapped)
+            read_counts[sample_name] = (mapped, unmapped)
+        return otu_table, read_counts
+
+    def search_residual_uniques(self, otus_fp, residual_fasta_fp, residual_uc_fp, output_dir, sample_dir):
+        self.job_scheduler.run([
+            Job(
+                name='residual_uniques',
+                tool='vsearch_usearch_global',
+                cmd_line_list=[
+                    self.vsearch_executable_fp,
+                    '--usearch_global', residual_fasta_fp,
+                    '--db', otus_fp,
+                    '--id', str(self.otu_identity),
+                    '--uc', residual_uc_fp
+                ],
+                threads_option='--threads',
+                input_size=get_file_size(residual_fasta_fp),
+                finish=functools.partial(
+                    self.complete_sample,
+                    output_dir=output_dir, sample_dir=sample_dir, sample_name='residual_uniques'),
+                log_file=os.path.join(output_dir, 'log')
+            )
+        ])
+
+    def write_unmapped_read_report(self, log, read_counts, report_fp):
+        # a growing unmapped fraction means the OTUs no longer represent the samples
+        total_mapped = sum(mapped for mapped, _ in read_counts.values())
+        total_unmapped = sum(unmapped for _, unmapped in read_counts.values())
+        with open(report_fp, 'wt') as report_file:
+            report_file.write('sample\tmapped\tunmapped\tunmapped_fraction\n')
+            for sample_name, (mapped, unmapped) in sorted(read_counts.items()):
+                report_file.write('{}\t{}\t{}\t{:.4f}\n'.format(
+                    sample_name, mapped, unmapped, get_fraction(unmapped, mapped + unmapped)))
+            report_file.write('total\t{}\t{}\t{:.4f}\n'.format(
+                total_mapped, total_unmapped, get_fraction(total_unmapped, total_mapped + total_unmapped)))
+
+        unmapped_fraction = get_fraction(total_unmapped, total_mapped + total_unmapped)
+        if unmapped_fraction > self.recluster_unmapped_fraction:
+            log.warning(
+                '%.1f%% of new reads did not map to an existing OTU, consider a full recluster',
+                100.0 * unmapped_fraction)
+        else:
+            log.info('%.1f%% of new reads did not map to an existing OTU', 100.0 * unmapped_fraction)
+
+
+def get_output_names(output_dir):
+    # hidden entries are temporary sample directories
+    return [entry.name for entry in os.scandir(output_dir) if not entry.name.startswith('.')]
+
+
+def log_memory_record(log, memory_record):
+    log.info(
+        'peak RSS of the pipeline and its child processes: %s', format_size(memory_record['step_peak_rss_bytes']))
+    if 'python_peak_bytes' in memory_record:
+        log.info(
+            'peak of Python allocations: %s, top allocations still held:\n\t%s',
+            format_size(memory_record['python_peak_bytes']),
+            '\n\t'.join(
+                '{}: {} in {} block(s)'.format(allocation['location'], format_size(allocation['size_bytes']),
+                                               allocation['count'])
+                for allocation
+                in memory_record['top_allocations']))
+
+
+def get_file_size(*fp_list):
+    return sum(get_step_output_size(fp) for fp in fp_list)
+
+
+def get_ungzipped_file_paths(*fp_list, target_dir):
+    # the paths ungzip_files will write, without decompressing anything
+    return [os.path.join(target_dir, os.path.basename(fp)[:-3]) for fp in fp_list]
+
+
+def finish_pear(forward_fastq_fp, reverse_fastq_fp, joined_fastq_fp_prefix, compress_files=gzip_files):
+    # delete the uncompressed input files
+    os.remove(forward_fastq_fp)
+    os.remove(reverse_fastq_fp)
+
+    compress_files(glob.glob(joined_fastq_fp_prefix + '.*.fastq'))
+
+
+def load_sequence_index(otus_fp, sequence_index_fp=None):
+    if sequence_index_fp is None:
+        return SequenceIndex.from_fasta_records(read_fasta_records(otus_fp))
+    else:
+        sequence_index = SequenceIndex.load(sequence_index_fp)
+        sequence_index.check_otu_ids(get_fasta_labels(otus_fp))
+        return sequence_index
+
+
+def split_sequence_index_hits(input_fp, sequence_index, index_hits_fp, misses_fasta_fp):
+    """
+    Count the reads of input_fp that are in sequence_index by OTU and write every
+    other distinct sequence once to misses_fasta_fp, labelled with its digest and
+    weighted by its read count.
+    """
+    sequence_counts = collections.Counter()
+    for fastq_batch in read_fastq_batches(input_fp):
+        sequence_counts.update(map(bytes.upper, fastq_batch.sequences()))
+
+    otu_counts = collections.Counter()
+    with open_sequence_file(misses_fasta_fp, 'wb') as misses_fasta_file:
+        for sequence, count in sequence_counts.items():
+            digest = get_sequence_digest(sequence)
+            otu_id = sequence_index.get_digest(digest)
+            if otu_id is None:
+                misses_fasta_file.write(format_fasta_record(b'%s;size=%d' % (digest.hex().encode(), count), sequence))
+            else:
+                otu_counts[otu_id] += count
+    with open(index_hits_fp, 'wt') as index_hits_file:
+        for otu_id, count in otu_counts.items():
+            index_hits_file.write('{}\t{}\n'.format(otu_id, count))
+
+    logging.getLogger(name=__name__).info(
+        '"%s": %d of %d reads found in the sequence index',
+        input_fp, sum(otu_counts.values()), sum(sequence_counts.values()))
+
+
+def grow_sequence_index(sequence_index, uc_fp):
+    # add the vsearch hits of sequences written by split_sequence_index_hits, the hits of
+    # one file are added under one hold of the index's lock
+    sequence_index.add_digests([
+        (bytes.fromhex(strip_label_annotations(query_label)), strip_label_annotations(target_label))
+        for query_label, target_label
+        in read_mapping_records(uc_fp, fmt='uc')
+        if target_label is not None
+    ])
+
+
+def write_otu_tables(otu_table, otu_table_fp_prefix):
+    # the text table is the dense format of vsearch --otutabout
+    write_biom_json(otu_table, otu_table_fp_prefix + '.biom.json')
+    write_otu_table_npz(otu_table, otu_table_fp_prefix + '.npz')
+    write_otu_table(otu_table, otu_table_fp_prefix + '.txt')
+
+
+def write_sample_otu_tables(otu_table, output_dir):
+    """
+    Write <sample>.uchime.otutab.txt and <sample>.uchime.otutab.json (BIOM) for each
+    sample, the per-sample tables step 09 wrote when vsearch built them.
+    """
+    for sample_otu_table in otu_table.split_samples():
+        sample_fp_prefix = os.path.join(output_dir, sample_otu_table.sample_ids[0] + '.uchime.otutab')
+        write_otu_table(sample_otu_table, sample_fp_prefix + '.txt')
+        write_otu_table(sample_otu_table, sample_fp_prefix + '.json')
+
+
+def get_fraction(part, whole):
+    return part / whole if whole > 0 else 0.0
+
+
+def get_sample_name(fp):
+    # '/work/step_03_merge.../Mock_Run3_V4_merged.assembled.fastq.gz' -> 'Mock_Run3_V4_merged'
+    return os.path.basename(fp).split('.')[0]
+
+
 def get_combined_file_name(input_fp_list):
     if len(input_fp_list) == 0:
         raise PipelineException('get_combined_file_name called with empty input')
@@ -1,12 +1,16 @@
-import glob
 import gzip
 import logging
 from operator import attrgetter
 import os
 import re
 import shutil
-import subprocess
-import traceback
+
+from cluster_16S import trace
+from cluster_16S.step_archive import find_step_outputs
+
+
+# matches seqio.BUFFER_SIZE, which cannot be imported here
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
 
 
 class PipelineException(BaseException):
@@ -48,7 +52,8 @@ def get_forward_fastq_files(input_dir):
     log = logging.getLogger(name=__name__)
     input_glob = os.path.join(input_dir, '*_[R0]1*.fastq*')
     log.info('searching for forward read files with glob "%s"', input_glob)
-    forward_fastq_files = glob.glob(input_glob)
+    # leave out BGZF indices ('.fastq.gz.gzi')
+    forward_fastq_files = [fp for fp in find_step_outputs(input_dir, '*_[R0]1*.fastq*') if not fp.endswith('.gzi')]
     if len(forward_fastq_files) == 0:
         raise PipelineException('found no forward reads from glob "{}"'.format(input_glob))
     return forward_fastq_files
@@ -67,9 +72,10 @@ def get_associated_reverse_fastq_fp(forward_fp):
 def gzip_files(file_list):
     log = logging.getLogger(name=__name__)
     for fp in file_list:
-        with open(fp, 'rt') as src, gzip.open(fp + '.gz', 'wt') as dst:
-            log.info('compressing file "%s"', fp)
-            shutil.copyfileobj(fsrc=src, fdst=dst)
+        with trace.span('gzip', 'compression', file=os.path.basename(fp)):
+            with open(fp, 'rb') as src, gzip.open(fp + '.gz', 'wb') as dst:
+                log.info('compressing file "%s"', fp)
+                shutil.copyfileobj(fsrc=src, fdst=dst, length=COPY_BUFFER_SIZE)
         os.remove(fp)
 
 
@@ -79,35 +85,47 @@ def ungzip_files(*fp_list, target_dir):
         # remove '.gz' from the file path
         uncompressed_fp = os.path.join(target_dir, os.path.basename(fp)[:-3])
         uncompressed_fps.append(uncompressed_fp)
-        with gzip.open(fp, 'rt') as src, open(uncompressed_fp, 'wt') as dst:
-            shutil.copyfileobj(fsrc=src, fdst=dst)
+        with trace.span('gunzip', 'compression', file=os.path.basename(fp)):
+            with gzip.open(fp, 'rb') as src, open(uncompressed_fp, 'wb') as dst:
+                shutil.copyfileobj(fsrc=src, fdst=dst, length=COPY_BUFFER_SIZE)
     return uncompressed_fps
 
 
-def run_cmd(cmd_line_list, log_file, **kwargs):
-    log = logging.getLogger(name=__name__)
-    try:
-        with open(log_file, 'at') as log_file:
-            cmd_line_str = ' '.join((str(x) for x in cmd_line_list))
-            log.info('executing "%s"', cmd_line_str)
-            log_file.write('executing "{}"'.format(cmd_line_str))
-            output = subprocess.run(
-                cmd_line_list,
-                stdout=log_file,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                **kwargs)
-            log.info(output)
-        return output
-    except subprocess.CalledProcessError as c:
-        logging.exception(c)
-        print(c.message)
-        print(c.cmd)
-        print(c.output)
-        raise c
-    except Exception as e:
-        logging.exception(e)
-        print('blarg!')
-        print(e)
-        traceback.print_exc()
-        raise e
+def count_fasta_records(fp):
+    with open(fp, 'rb') as fasta_file:
+        return sum(1 for line in fasta_file if line.startswith(b'>'))
+
+
+def split_fasta_file(fp, shard_fp_list):
+    """
+    Split a FASTA file into consecutive runs of records with about the same number of
+    records in each shard. The lines of each record are copied unchanged so
+    concatenating the shards in order gives back the original file.
+    """
+    record_count = count_fasta_records(fp)
+    shard_count = len(shard_fp_list)
+    # shard i holds records [shard_starts[i], shard_starts[i+1])
+    shard_starts = [(i * record_count) // shard_count for i in range(shard_count + 1)]
+    with open(fp, 'rb') as fasta_file:
+        shard_index = -1
+        record_index = -1
+        shard_file = None
+        for line in fasta_file:
+            if line.startswith(b'>'):
+                record_index += 1
+                while record_index >= shard_starts[shard_index + 1]:
+                    if shard_file is not None:
+                        shard_file.close()
+                    shard_index += 1
+                    shard_file = open(shard_fp_list[shard_index], 'wb')
+            shard_file.write(line)
+        if shard_file is not None:
+            shard_file.close()
+    return shard_starts
+
+
+def concatenate_files(fp_list, output_fp):
+    with open(output_fp, 'wb') as output_file:
+        for fp in fp_list:
+            with open(fp, 'rb') as input_file:
+                shutil.copyfileobj(fsrc=input_file, fdst=output_file, length=COPY_BUFFER_SIZE)
@@ -0,0 +1,372 @@
+"""
+Run planning from the metrics of earlier runs.
+
+Every step that runs appends one record to <work_dir>/.ledger/metrics.jsonl with
+its wall time, CPU time (the pipeline process and its child processes), peak
+resident memory and the size of its output directory, together with a
+description of the run's inputs: the number of samples, their compressed size and
+an estimate of the number of reads and bases from the first megabyte of each file.
+
+A plan fits a linear model of each step's CPU time, peak memory and output size to
+(1, bases, samples) over all recorded runs and predicts the wall time for a core
+count from the fraction of the step's CPU time that ran in parallel (Amdahl's law),
+estimated from the runs that used more than one core.
+
+"""
+import fnmatch
+import glob
+import json
+import logging
+import math
+import os
+import resource
+import time
+import zlib
+
+import numpy as np
+
+from cluster_16S.step_ledger import LEDGER_DIR_NAME
+
+
+METRICS_FILE_NAME = 'metrics.jsonl'
+# compressed bytes read from each input file to estimate its read count
+SAMPLE_SIZE = 1024 * 1024
+MAX_SAMPLED_FILE_COUNT = 32
+# used for steps that have never run on more than one core
+DEFAULT_PARALLEL_FRACTION = 0.9
+# a core count is recommended if its predicted wall time is within this factor of the best
+CORE_COUNT_TOLERANCE = 1.1
+
+
+def get_metrics_fp(work_dir):
+    return os.path.join(work_dir, LEDGER_DIR_NAME, METRICS_FILE_NAME)
+
+
+def get_cpu_seconds():
+    # CPU time of this process and of the child processes that have finished
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+
+def get_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and is the peak since the process started, so
+    # it is an upper bound for the peak of one step
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def get_dir_size(dir_path):
+    size = 0
+    for dir_name, _, file_names in os.walk(dir_path):
+        size += sum(os.path.getsize(os.path.join(dir_name, file_name)) for file_name in file_names)
+    return size
+
+
+class StepMeter:
+    """
+    Measure one step from its start until get_record() is called. The input directory
+    is measured by get_record(), which is only called for a step that ran.
+    """
+    def __init__(self, step_name, input_dir=None):
+        self.step_name = step_name
+        self.input_dir = input_dir
+        self.start_time = time.time()
+        self.start_cpu_seconds = get_cpu_seconds()
+
+    def get_record(self, output_dir, core_count, input_description):
+        return {
+            'step': self.step_name,
+            'core_count': core_count,
+            'wall_seconds': time.time() - self.start_time,
+            'cpu_seconds': get_cpu_seconds() - self.start_cpu_seconds,
+            'peak_rss_bytes': get_peak_rss_bytes(),
+            'step_input_bytes': None if self.input_dir is None else get_dir_size(self.input_dir),
+            'output_bytes': get_dir_size(output_dir),
+            'inputs': input_description,
+        }
+
+
+def record_step_metrics(work_dir, record):
+    metrics_fp = get_metrics_fp(work_dir)
+    os.makedirs(os.path.dirname(metrics_fp), exist_ok=True)
+    with open(metrics_fp, 'at') as metrics_file:
+        metrics_file.write(json.dumps(record) + '\n')
+
+
+def read_step_metrics(history):
+    """
+    Return the step metrics records found in history, a list of work directories,
+    metrics files or glob patterns of either.
+    """
+    records = []
+    for pattern in history:
+        for fp in sorted(glob.glob(pattern)):
+            if os.path.isdir(fp):
+                fp = get_metrics_fp(fp)
+            if not os.path.exists(fp):
+                continue
+            with open(fp, 'rt') as metrics_file:
+                for line in metrics_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+    return records
+
+
+def get_input_fastq_files(input_dir):
+    return sorted(
+        fp
+        for fp
+        in glob.glob(os.path.join(input_dir, '*.fastq*'))
+        if not fp.endswith('.gzi')
+    )
+
+
+def estimate_fastq_file(fp, sample_size=SAMPLE_SIZE):
+    """
+    Return (estimated read count, total length of the sampled reads, sampled read
+    count) from the first sample_size bytes of fp.
+    """
+    file_size = os.path.getsize(fp)
+    with open(fp, 'rb') as f:
+        head = f.read(sample_size)
+    if fp.endswith('.gz'):
+        # decompress one gzip member after another, as for BGZF files
+        sample_parts = []
+        compressed = head
+        while len(compressed) > 0:
+            decompressor = zlib.decompressobj(wbits=31)
+            try:
+                sample_parts.append(decompressor.decompress(compressed))
+            except zlib.error:
+                break
+            compressed = decompressor.unused_data
+        sample = b''.join(sample_parts)
+    else:
+        sample = head
+    lines = sample.split(b'\n')
+    # the piece after the last newline is an incomplete line or empty
+    record_count = (len(lines) - 1) // 4
+    if record_count == 0:
+        return 0, 0, 0
+    sequence_length = sum(len(line.rstrip(b'\r')) for line in lines[1:4 * record_count:4])
+    if len(head) == file_size:
+        read_count = record_count
+    elif fp.endswith('.gz'):
+        read_count = record_count * file_size / len(head)
+    else:
+        read_count = record_count * file_size / sum(len(line) + 1 for line in lines[:4 * record_count])
+    return int(round(read_count)), sequence_length, record_count
+
+
+def describe_inputs(input_dir, max_sampled_file_count=MAX_SAMPLED_FILE_COUNT):
+    log = logging.getLogger(name=__name__)
+    fastq_fps = get_input_fastq_files(input_dir)
+    input_bytes = sum(os.path.getsize(fp) for fp in fastq_fps)
+    # files spread evenly over the sorted list stand in for the rest
+    sampled_fps = fastq_fps[::max(1, math.ceil(len(fastq_fps) / max_sampled_file_count))]
+    estimated_read_count = 0
+    sampled_length = 0
+    sampled_read_count = 0
+    for fp in sampled_fps:
+        file_read_count, file_sampled_length, file_sampled_read_count = estimate_fastq_file(fp)
+        estimated_read_count += file_read_count
+        sampled_length += file_sampled_length
+        sampled_read_count += file_sampled_read_count
+    sampled_bytes = sum(os.path.getsize(fp) for fp in sampled_fps)
+    read_count = int(estimated_read_count * input_bytes / sampled_bytes) if sampled_bytes > 0 else 0
+    mean_read_length = sampled_length / sampled_read_count if sampled_read_count > 0 else 0.0
+    # paired files are one sample, as in pipeline_util.get_forward_fastq_files
+    forward_fastq_fps = [fp for fp in fastq_fps if fnmatch.fnmatch(os.path.basename(fp), '*_[R0]1*')]
+    input_description = {
+        'file_count': len(fastq_fps),
+        'sample_count': len(forward_fastq_fps) or len(fastq_fps),
+        'input_bytes': input_bytes,
+        'read_count': read_count,
+        'mean_read_length': round(mean_read_length, 1),
+        'bases': int(read_count * mean_read_length),
+    }
+    log.info('inputs in "%s": %s', input_dir, input_description)
+    return input_description
+
+
+def get_step_peak_rss_bytes(record):
+    # the peak RSS of the step itself, metrics recorded before it was measured have only
+    # the peak since the pipeline started
+    return record.get('step_peak_rss_bytes', record['peak_rss_bytes'])
+
+
+def get_features(input_description):
+    return [1.0, float(input_description['bases']), float(input_description['sample_count'])]
+
+
+def fit_linear_model(features, targets):
+    """
+    Least squares coefficients of targets on features. Columns are scaled to a mean
+    of 1 first so the minimum-norm solution used when there are fewer runs than
+    features does not favour one feature for its units.
+    """
+    features = np.asarray(features, dtype=np.float64)
+    scale = np.abs(features).mean(axis=0)
+    scale[scale == 0.0] = 1.0
+    coefficients, *_ = np.linalg.lstsq(features / scale, np.asarray(targets, dtype=np.float64), rcond=None)
+    return coefficients / scale
+
+
+def get_parallel_fraction(records):
+    # Amdahl's law: wall = cpu * ((1 - p) + p / cores), solved for p in each multi-core run
+    parallel_fractions = [
+        (1.0 - r['wall_seconds'] / r['cpu_seconds']) / (1.0 - 1.0 / r['core_count'])
+        for r
+        in records
+        if r['core_count'] > 1 and r['cpu_seconds'] > 0.0 and r['wall_seconds'] > 0.0
+    ]
+    if len(parallel_fractions) == 0:
+        return DEFAULT_PARALLEL_FRACTION
+    return float(np.clip(np.median(parallel_fractions), 0.0, 1.0))
+
+
+class StepModel:
+    def __init__(self, step_name, records):
+        self.step_name = step_name
+        self.run_count = len(records)
+        features = [get_features(r['inputs']) for r in records]
+        self.cpu_coefficients = fit_linear_model(features, [r['cpu_seconds'] for r in records])
+        self.memory_coefficients = fit_linear_model(features, [get_step_peak_rss_bytes(r) for r in records])
+        self.output_coefficients = fit_linear_model(features, [r['output_bytes'] for r in records])
+        self.parallel_fraction = get_parallel_fraction(records)
+        # predictions are never below what the smallest run needed
+        self.min_cpu_seconds = min(r['cpu_seconds'] for r in records)
+        self.min_peak_rss_bytes = min(get_step_peak_rss_bytes(r) for r in records)
+
+    def predict(self, input_description, core_count):
+        features = np.array(get_features(input_description))
+        cpu_seconds = max(self.min_cpu_seconds, float(features @ self.cpu_coefficients))
+        return {
+            'step': self.step_name,
+            'run_count': self.run_count,
+            'cpu_seconds': cpu_seconds,
+            'wall_seconds': cpu_seconds * ((1.0 - self.parallel_fraction) + self.parallel_fraction / core_count),
+            'peak_rss_bytes': max(self.min_peak_rss_bytes, float(features @ self.memory_coefficients)),
+            'output_bytes': max(0.0, float(features @ self.output_coefficients)),
+        }
+
+
+def fit_step_models(records):
+    step_records = {}
+    for record in records:
+        step_records.setdefault(record['step'], []).append(record)
+    return {step_name: StepModel(step_name, step_records[step_name]) for step_name in sorted(step_records)}
+
+
+def get_candidate_core_counts(node_core_count):
+    core_counts = [2 ** i for i in range(int(math.log2(node_core_count)) + 1)]
+    if core_counts[-1] != node_core_count:
+        core_counts.append(node_core_count)
+    return core_counts
+
+
+def plan_run(input_dir, core_count, history, node_core_count=48, max_run_seconds=12 * 3600):
+    """
+    Predict each step of a run on the inputs in input_dir with core_count cores and
+    recommend a core count and node count.
+    """
+    input_description = describe_inputs(input_dir)
+    step_models = fit_step_models(read_step_metrics(history))
+
+    def get_total_wall_seconds(cores):
+        return sum(m.predict(input_description, cores)['wall_seconds'] for m in step_models.values())
+
+    if len(step_models) == 0:
+        # with no history only per-sample parallelism is known
+        recommended_core_count = min(node_core_count, max(1, input_description['sample_count']))
+        total_wall_seconds = None
+    else:
+        wall_seconds_by_core_count = {
+            c: get_total_wall_seconds(c)
+            for c
+            in get_candidate_core_counts(node_core_count)
+        }
+        best_wall_seconds = min(wall_seconds_by_core_count.values())
+        recommended_core_count = min(
+            c for c, w in wall_seconds_by_core_count.items() if w <= CORE_COUNT_TOLERANCE * best_wall_seconds)
+        total_wall_seconds = get_total_wall_seconds(recommended_core_count)
+
+    # one run uses one node, a run longer than the limit has to be split by samples
+    if total_wall_seconds is None:
+        node_count = 1
+    else:
+        node_count = max(1, math.ceil(total_wall_seconds / max_run_seconds))
+
+    steps = [m.predict(input_description, core_count) for m in step_models.values()]
+    return {
+        'inputs': input_description,
+        'core_count': core_count,
+        'steps': steps,
+        'wall_seconds': sum(s['wall_seconds'] for s in steps),
+        'peak_rss_bytes': max((s['peak_rss_bytes'] for s in steps), default=0.0),
+        'scratch_bytes': sum(s['output_bytes'] for s in steps),
+        'history_run_count': max((m.run_count for m in step_models.values()), default=0),
+        'recommended_core_count': recommended_core_count,
+        'recommended_wall_seconds': total_wall_seconds,
+        'recommended_node_count': node_count,
+        'max_run_seconds': max_run_seconds,
+    }
+
+
+def format_duration(seconds):
+    seconds = int(math.ceil(seconds))
+    return '{:d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+def parse_duration(duration):
+    # 'hh:mm:ss' as used for Slurm wall times
+    seconds = 0
+    for part in duration.split(':'):
+        seconds = 60 * seconds + int(part)
+    return seconds
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TB'.format(size)
+
+
+def format_plan(plan):
+    inputs = plan['inputs']
+    lines = [
+        'inputs: {} sample(s) in {} file(s), {}, about {:,} reads of {} bases'.format(
+            inputs['sample_count'], inputs['file_count'], format_size(inputs['input_bytes']),
+            inputs['read_count'], inputs['mean_read_length']),
+    ]
+    if len(plan['steps']) == 0:
+        lines.append('no step metrics found, run the pipeline once to record them')
+    else:
+        lines.append('predictions for {} core(s) from up to {} earlier run(s):'.format(
+            plan['core_count'], plan['history_run_count']))
+        lines.append('  {:<50} {:>10} {:>10} {:>10}'.format('step', 'wall time', 'memory', 'output'))
+        for step in plan['steps']:
+            lines.append('  {:<50} {:>10} {:>10} {:>10}'.format(
+                step['step'], format_duration(step['wall_seconds']),
+                format_size(step['peak_rss_bytes']), format_size(step['output_bytes'])))
+        lines.append('  {:<50} {:>10} {:>10} {:>10}'.format(
+            'total', format_duration(plan['wall_seconds']),
+            format_size(plan['peak_rss_bytes']), format_size(plan['scratch_bytes'])))
+    lines.append('recommended: --core-count {}'.format(plan['recommended_core_count']))
+    if plan['recommended_wall_seconds'] is not None:
+        lines.append('  predicted wall time {}, request about {} including a 25% margin'.format(
+            format_duration(plan['recommended_wall_seconds']),
+            format_duration(1.25 * plan['recommended_wall_seconds'])))
+    if plan['recommended_node_count'] > 1:
+        lines.append(
+            '  the run is longer than {}, split the samples into {} runs on separate nodes'.format(
+                format_duration(plan['max_run_seconds']), plan['recommended_node_count']))
+    else:
+        lines.append('  1 node')
+    return '\n'.join(lines)
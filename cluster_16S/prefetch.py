@@ -0,0 +1,69 @@
+"""
+Staging of job inputs before their tool runs and finishing of job outputs after it.
+
+A JobScheduler runs the prepare() of a job (e.g. decompressing the inputs of a
+sample) before the job takes its cores and the finish() (e.g. compressing its
+outputs) after the job has given them back, both on the threads of a Prefetcher.
+So while the tool runs on one sample the inputs of the next samples are staged and
+the outputs of the previous samples are compressed, and the disk, the tools and the
+Python I/O are busy at the same time instead of taking turns.
+
+The depth of a Prefetcher bounds the extra scratch space, memory and threads this
+takes. At most depth jobs are staged but not yet running, the others wait to be
+staged. At most depth jobs are being finished, a job whose tool is done keeps its
+cores until it can be finished, so no more tools start until the outputs waiting for
+compression are done. The depth does not grow with the core count, prepare() and
+finish() are expected to use one thread each.
+
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import os
+
+from cluster_16S.pipeline_util import PipelineException
+
+
+DEFAULT_PREFETCH_DEPTH = 2
+
+class Prefetcher:
+    def __init__(self, depth):
+        self.depth = max(1, depth)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=2 * self.depth, thread_name_prefix='prefetch')
+        self._staging_slots = None
+        self._finishing_slots = None
+
+    def get_slots(self):
+        # made on first use, on the event loop of the command runner
+        if self._staging_slots is None:
+            self._staging_slots = asyncio.Semaphore(self.depth)
+            self._finishing_slots = asyncio.Semaphore(self.depth)
+        return self._staging_slots, self._finishing_slots
+
+    async def run_in_thread(self, function):
+        # in the context of the caller, so the function's spans go to the caller's trace
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(contextvars.copy_context().run, function))
+
+
+def warm_page_cache(fp):
+    # start reading fp into the page cache without waiting for it
+    with open(fp, 'rb') as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while len(f.read(4 * 1024 * 1024)) > 0:
+                pass
+
+
+def stage_files(*fps):
+    """
+    The prepare() of a job whose tool reads its inputs as they are: check that they
+    exist, so a missing input fails before the tool is started, and read them ahead.
+    """
+    for fp in fps:
+        if not os.path.isfile(fp):
+            raise PipelineException('input file "{}" does not exist'.format(fp))
+        warm_page_cache(fp)
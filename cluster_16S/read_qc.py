@@ -0,0 +1,232 @@
+"""
+In-process read quality statistics.
+
+A ReadQcCollector accumulates per-position quality histograms, base composition,
+N content, the read length distribution and a duplicate level estimate from batches
+of reads. Each batch is processed with a few vectorized numpy operations, so the
+collector can be fed by a step that is already reading or writing the reads, or run
+as one streaming pass over a FASTQ file.
+
+"""
+import collections
+import html
+import json
+import logging
+import os
+
+import numpy as np
+
+from cluster_16S.seqio import read_fastq_batches
+
+
+PHRED_OFFSET = 33
+MAX_QUALITY = 41
+QUANTILES = (10, 25, 50, 75, 90)
+
+# A, C, G, T and everything else (N)
+BASES = 'ACGTN'
+BASE_CODES = np.full(256, 4, dtype=np.int64)
+for _i, _base in enumerate('ACGT'):
+    BASE_CODES[ord(_base)] = _i
+    BASE_CODES[ord(_base.lower())] = _i
+
+# like FastQC, duplication is estimated from the first DUPLICATE_TRACKING_LIMIT
+# distinct sequences, truncated to DUPLICATE_PREFIX_LENGTH
+DUPLICATE_TRACKING_LIMIT = 100000
+DUPLICATE_PREFIX_LENGTH = 50
+DUPLICATE_LEVELS = (1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+def get_positions(lengths):
+    # the position of every base within its read
+    read_starts = np.cumsum(lengths) - lengths
+    return np.arange(int(lengths.sum()), dtype=np.int64) - np.repeat(read_starts, lengths)
+
+
+class ReadQcCollector:
+    def __init__(self):
+        self.read_count = 0
+        self.max_length = 0
+        self.quality_counts = np.zeros((0, MAX_QUALITY + 1), dtype=np.int64)
+        self.base_counts = np.zeros((0, len(BASES)), dtype=np.int64)
+        self.length_counts = np.zeros(1, dtype=np.int64)
+        self.duplicate_counts = collections.Counter()
+        self.duplicate_tracked_read_count = 0
+
+    def _grow(self, max_length):
+        if max_length > self.max_length:
+            extra = max_length - self.max_length
+            self.quality_counts = np.vstack(
+                (self.quality_counts, np.zeros((extra, MAX_QUALITY + 1), dtype=np.int64)))
+            self.base_counts = np.vstack((self.base_counts, np.zeros((extra, len(BASES)), dtype=np.int64)))
+            self.length_counts = np.concatenate((self.length_counts, np.zeros(extra, dtype=np.int64)))
+            self.max_length = max_length
+
+    def add_batch(self, sequences, qualities):
+        """
+        Add a batch of reads given as equal-length lists of bytes.
+        """
+        if len(sequences) == 0:
+            return
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+        self._add(
+            lengths=lengths,
+            bases=np.frombuffer(b''.join(sequences), dtype=np.uint8),
+            qualities=np.frombuffer(b''.join(qualities), dtype=np.uint8))
+        self._add_duplicates(sequences)
+
+    def add_fastq_batch(self, fastq_batch):
+        """
+        Add a seqio.FastqBatch, e.g. one a step is already copying. Bases and quality
+        scores are gathered from the batch buffer without making a bytes object per read.
+        """
+        if len(fastq_batch) == 0:
+            return
+        lengths = fastq_batch.sequence_lengths()
+        positions = get_positions(lengths)
+        buffer_bytes = np.frombuffer(fastq_batch.buffer, dtype=np.uint8)
+        self._add(
+            lengths=lengths,
+            bases=buffer_bytes[np.repeat(fastq_batch.sequence_starts, lengths) + positions],
+            qualities=buffer_bytes[np.repeat(fastq_batch.quality_starts, lengths) + positions],
+            positions=positions)
+        self._add_duplicates(
+            fastq_batch.get_slices(
+                fastq_batch.sequence_starts,
+                np.minimum(fastq_batch.sequence_ends, fastq_batch.sequence_starts + DUPLICATE_PREFIX_LENGTH)))
+
+    def _add(self, lengths, bases, qualities, positions=None):
+        self._grow(int(lengths.max()))
+        base_codes = BASE_CODES[bases]
+        quality_scores = qualities.astype(np.int64) - PHRED_OFFSET
+        np.clip(quality_scores, 0, MAX_QUALITY, out=quality_scores)
+        if positions is None:
+            positions = get_positions(lengths)
+
+        self.quality_counts += np.bincount(
+            positions * (MAX_QUALITY + 1) + quality_scores,
+            minlength=self.max_length * (MAX_QUALITY + 1)).reshape(self.max_length, MAX_QUALITY + 1)
+        self.base_counts += np.bincount(
+            positions * len(BASES) + base_codes,
+            minlength=self.max_length * len(BASES)).reshape(self.max_length, len(BASES))
+        self.length_counts += np.bincount(lengths, minlength=self.max_length + 1)
+        self.read_count += len(lengths)
+
+    def _add_duplicates(self, sequences):
+        prefixes = (sequence[:DUPLICATE_PREFIX_LENGTH] for sequence in sequences)
+        if len(self.duplicate_counts) < DUPLICATE_TRACKING_LIMIT:
+            room = DUPLICATE_TRACKING_LIMIT - len(self.duplicate_counts)
+            # a batch can add at most one new sequence per read
+            if room >= len(sequences):
+                self.duplicate_counts.update(prefixes)
+                self.duplicate_tracked_read_count += len(sequences)
+                return
+            prefixes = list(prefixes)
+            self.duplicate_counts.update(prefixes[:room])
+            self.duplicate_tracked_read_count += room
+            prefixes = prefixes[room:]
+        # once the limit is reached only sequences already seen are counted
+        for prefix in prefixes:
+            if prefix in self.duplicate_counts:
+                self.duplicate_counts[prefix] += 1
+                self.duplicate_tracked_read_count += 1
+
+    def summary(self):
+        position_totals = self.quality_counts.sum(axis=1)
+        cumulative_counts = np.cumsum(self.quality_counts, axis=1)
+        quality_quantiles = {
+            str(q): (cumulative_counts < (position_totals * q / 100.0)[:, np.newaxis]).sum(axis=1).tolist()
+            for q in QUANTILES
+        }
+        safe_totals = np.maximum(position_totals, 1)
+        mean_quality = (self.quality_counts @ np.arange(MAX_QUALITY + 1)) / safe_totals
+
+        base_fractions = self.base_counts / safe_totals[:, np.newaxis]
+        lengths = np.flatnonzero(self.length_counts)
+
+        return {
+            'read_count': self.read_count,
+            'base_count': int(position_totals.sum()),
+            'length_distribution': {
+                str(length): int(self.length_counts[length]) for length in lengths.tolist()
+            },
+            'per_position': {
+                'read_count': position_totals.tolist(),
+                'mean_quality': np.round(mean_quality, 2).tolist(),
+                'quality_quantiles': quality_quantiles,
+                'base_fraction': {
+                    base: np.round(base_fractions[:, i], 4).tolist() for i, base in enumerate(BASES)
+                },
+            },
+            'n_fraction': round(float(self.base_counts[:, 4].sum() / max(1, position_totals.sum())), 6),
+            'duplication': self.duplication_summary(),
+        }
+
+    def duplication_summary(self):
+        if self.duplicate_tracked_read_count == 0:
+            return {'deduplicated_fraction': 1.0, 'levels': {}}
+        counts = np.fromiter(self.duplicate_counts.values(), dtype=np.int64, count=len(self.duplicate_counts))
+        level_index = np.searchsorted(DUPLICATE_LEVELS, counts, side='right') - 1
+        reads_per_level = np.bincount(level_index, weights=counts, minlength=len(DUPLICATE_LEVELS))
+        return {
+            'deduplicated_fraction': round(len(counts) / self.duplicate_tracked_read_count, 4),
+            # fraction of (tracked) reads at each duplication level, '10' means 10 to 49 copies
+            'levels': {
+                str(level): round(float(reads) / self.duplicate_tracked_read_count, 4)
+                for level, reads in zip(DUPLICATE_LEVELS, reads_per_level.tolist())
+            },
+        }
+
+
+def collect_read_qc(fastq_fp):
+    read_qc_collector = ReadQcCollector()
+    for fastq_batch in read_fastq_batches(fastq_fp):
+        read_qc_collector.add_fastq_batch(fastq_batch)
+    return read_qc_collector
+
+
+def write_read_qc(read_qc_collector, fastq_fp, qc_output_dir, write_html=False):
+    log = logging.getLogger(name=__name__)
+    summary = read_qc_collector.summary()
+    summary['file'] = os.path.basename(fastq_fp)
+    qc_json_fp = os.path.join(qc_output_dir, os.path.basename(fastq_fp) + '.qc.json')
+    with open(qc_json_fp, 'wt') as qc_json_file:
+        json.dump(summary, qc_json_file, separators=(',', ':'))
+    log.info('%d reads in "%s", QC written to "%s"', summary['read_count'], fastq_fp, qc_json_fp)
+
+    if write_html:
+        with open(qc_json_fp[:-len('.json')] + '.html', 'wt') as qc_html_file:
+            qc_html_file.write(get_read_qc_html(summary))
+    return qc_json_fp
+
+
+def get_read_qc_html(summary):
+    per_position = summary['per_position']
+    rows = []
+    for i in range(len(per_position['read_count'])):
+        rows.append('<tr>' + ''.join('<td>{}</td>'.format(x) for x in (
+            i + 1,
+            per_position['read_count'][i],
+            per_position['mean_quality'][i],
+            *(per_position['quality_quantiles'][str(q)][i] for q in QUANTILES),
+            *(per_position['base_fraction'][base][i] for base in BASES))) + '</tr>')
+    header = ''.join('<th>{}</th>'.format(h) for h in (
+        'position', 'reads', 'mean quality', *('Q{}'.format(q) for q in QUANTILES), *BASES))
+    lengths = ''.join(
+        '<tr><td>{}</td><td>{}</td></tr>'.format(length, count)
+        for length, count in summary['length_distribution'].items())
+    return '\n'.join([
+        '<html><head><title>{0}</title></head><body>',
+        '<h1>{0}</h1>',
+        '<p>{1} reads, N fraction {2}, deduplicated fraction {3}</p>',
+        '<h2>per position</h2><table><tr>{4}</tr>{5}</table>',
+        '<h2>read lengths</h2><table><tr><th>length</th><th>reads</th></tr>{6}</table>',
+        '</body></html>'
+    ]).format(
+        html.escape(summary.get('file', '')),
+        summary['read_count'],
+        summary['n_fraction'],
+        summary['duplication']['deduplicated_fraction'],
+        header,
+        ''.join(rows),
+        lengths)
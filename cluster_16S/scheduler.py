@@ -0,0 +1,182 @@
+"""
+Core-budget-aware scheduling of external tool jobs.
+
+Each tool has a ThreadProfile describing how well it uses threads. A job is given a
+thread count from its tool profile and the size of its input, then jobs are started
+largest first on a CommandRunner whenever enough cores are free, so the total number
+of threads in use never exceeds the core count.
+
+"""
+import collections
+import logging
+import math
+import threading
+
+from cluster_16S import trace
+from cluster_16S.command_runner import Command, CommandRunner, run_command
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.prefetch import DEFAULT_PREFETCH_DEPTH, Prefetcher
+
+
+MB = 1024 * 1024
+
+# min_threads and max_threads bound the thread count for one job, max_threads None means
+# the tool scales to all cores; bytes_per_thread is the input size (compressed) that
+# justifies one more thread, None means the thread count does not depend on input size
+ThreadProfile = collections.namedtuple('ThreadProfile', ['min_threads', 'max_threads', 'bytes_per_thread'])
+
+TOOL_THREAD_PROFILES = {
+    # fastqc uses at most one thread per file
+    'fastqc': ThreadProfile(min_threads=1, max_threads=None, bytes_per_thread=None),
+    # cutadapt is run without --cores
+    'cutadapt': ThreadProfile(min_threads=1, max_threads=1, bytes_per_thread=None),
+    'pear': ThreadProfile(min_threads=1, max_threads=16, bytes_per_thread=16 * MB),
+    'vsearch_mergepairs': ThreadProfile(min_threads=1, max_threads=16, bytes_per_thread=16 * MB),
+    # vsearch -fastq_filter and -derep_fulllength are single-threaded
+    'vsearch_filter': ThreadProfile(min_threads=1, max_threads=1, bytes_per_thread=None),
+    'vsearch_derep': ThreadProfile(min_threads=1, max_threads=1, bytes_per_thread=None),
+    # usearch -cluster_otus is single-threaded
+    'usearch_cluster_otus': ThreadProfile(min_threads=1, max_threads=1, bytes_per_thread=None),
+    # vsearch -uchime_ref scales poorly past a few threads
+    'vsearch_uchime_ref': ThreadProfile(min_threads=1, max_threads=4, bytes_per_thread=1 * MB),
+    'vsearch_usearch_global': ThreadProfile(min_threads=1, max_threads=None, bytes_per_thread=8 * MB),
+}
+
+
+class Job:
+    """
+    One external command. The scheduler appends threads_option and the chosen thread
+    count to cmd_line_list, or nothing if threads_option is None. prepare() and finish()
+    run before and after the command, e.g. to decompress the inputs and compress the
+    outputs of one sample, but without holding the job's cores (see prefetch).
+    """
+    def __init__(self, name, tool, cmd_line_list, log_file, threads_option=None, input_size=0,
+                 max_threads=None, prepare=None, finish=None):
+        if tool not in TOOL_THREAD_PROFILES:
+            raise PipelineException('no thread profile for tool "{}"'.format(tool))
+        self.name = name
+        self.tool = tool
+        self.cmd_line_list = cmd_line_list
+        self.log_file = log_file
+        self.threads_option = threads_option
+        self.input_size = input_size
+        self.max_threads = max_threads
+        self.prepare = prepare
+        self.finish = finish
+        self.thread_count = 1
+
+    def get_cmd_line_list(self):
+        if self.threads_option is None:
+            return list(self.cmd_line_list)
+        else:
+            return [*self.cmd_line_list, self.threads_option, str(self.thread_count)]
+
+
+def call_after_all(call_count, function):
+    """
+    Return a function to be used as the finish() of call_count jobs. It calls
+    function once, when the last of those jobs finishes, so a failed job means
+    function is never called.
+    """
+    remaining = [call_count]
+    lock = threading.Lock()
+
+    def finish():
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            function()
+
+    return finish
+
+
+def get_thread_count(tool, input_size, core_count, fair_share=1):
+    """
+    Threads for one job: enough for the input size, at least the fair share of the
+    cores when there are fewer jobs than cores, and within the tool's profile.
+    """
+    profile = TOOL_THREAD_PROFILES[tool]
+    max_threads = core_count if profile.max_threads is None else min(profile.max_threads, core_count)
+    if profile.bytes_per_thread is None:
+        thread_count = max_threads
+    else:
+        thread_count = max(fair_share, math.ceil(input_size / profile.bytes_per_thread))
+    return max(1, profile.min_threads, min(thread_count, max_threads))
+
+
+class JobScheduler:
+    def __init__(self, core_count, command_runner=None, command_timeout=None, prefetch_depth=None,
+                 memory_limit=None):
+        self.core_count = core_count
+        self.prefetcher = Prefetcher(depth=DEFAULT_PREFETCH_DEPTH if prefetch_depth is None else prefetch_depth)
+        # a CommandRunner may be shared by several schedulers to share one core budget
+        if command_runner is None:
+            self.command_runner = CommandRunner(
+                core_count=core_count, default_timeout=command_timeout, memory_limit=memory_limit)
+        else:
+            self.command_runner = command_runner
+
+    def plan(self, jobs):
+        # assign thread counts and return the jobs in the order they will be started
+        fair_share = max(1, self.core_count // max(1, len(jobs)))
+        for job in jobs:
+            if job.threads_option is None:
+                # the tool can not be told to use more than one thread
+                job.thread_count = 1
+                continue
+            job.thread_count = get_thread_count(
+                tool=job.tool, input_size=job.input_size, core_count=self.core_count, fair_share=fair_share)
+            if job.max_threads is not None:
+                job.thread_count = max(1, min(job.thread_count, job.max_threads))
+        return sorted(jobs, key=lambda j: (j.thread_count, j.input_size), reverse=True)
+
+    def run(self, jobs):
+        """
+        Run all jobs and wait for them. If a job fails the other jobs still run to
+        completion before the first failure is raised.
+        """
+        log = logging.getLogger(name=__name__)
+        planned_jobs = self.plan(list(jobs))
+        for job in planned_jobs:
+            log.info('job "%s" (%s): %d thread(s)', job.name, job.tool, job.thread_count)
+
+        self.command_runner.run_batch([self.run_job(job) for job in planned_jobs])
+        return planned_jobs
+
+    async def run_job(self, job):
+        command = Command(
+            job.get_cmd_line_list(),
+            log_file=job.log_file,
+            timeout=self.command_runner.default_timeout)
+        staging_slots, finishing_slots = self.prefetcher.get_slots()
+        start = trace.now()
+        try:
+            async with staging_slots:
+                # staged while the jobs before it hold the cores
+                if job.prepare is not None:
+                    await self.prefetcher.run_in_thread(job.prepare)
+                cores = self.command_runner.cores(job.thread_count)
+                await cores.__aenter__()
+            try:
+                output = await run_command(command)
+                # the cores are kept until the outputs can be finished
+                await finishing_slots.acquire()
+            finally:
+                await cores.__aexit__(None, None, None)
+            try:
+                if job.finish is not None:
+                    await self.prefetcher.run_in_thread(job.finish)
+            finally:
+                finishing_slots.release()
+            return output
+        finally:
+            # the job shares the lane of its child process, prepare() and finish() included
+            if command.pid is not None:
+                peak_rss = self.command_runner.memory_monitor.pop_child_peak(command.pid)
+                if peak_rss is not None:
+                    logging.getLogger(name=__name__).info(
+                        'job "%s" (%s): peak RSS %d MB', job.name, job.tool, peak_rss // 2 ** 20)
+                trace.add_span(
+                    job.name, job.tool, start, pid=command.pid, tid=command.pid, thread_count=job.thread_count,
+                    peak_rss_bytes=peak_rss)
@@ -0,0 +1,68 @@
+"""
+Node-local scratch directories.
+
+With a local scratch directory each step writes its output directory and its ledger
+on node-local storage, where creating, listing and removing many small files is
+cheap. When a step is complete its outputs, every entry of the output directory that
+is not hidden, are copied to the work directory in one pass. The step is recorded as
+complete in the work directory ledger only after the copy, so a step that was not
+synced is run again after a restart.
+
+"""
+import hashlib
+import logging
+import os
+import shutil
+
+
+SYNC_PREFIX = '.sync.'
+
+
+def get_local_scratch_dir(local_scratch, work_dir):
+    # one directory per work_dir so pipelines sharing a node do not collide
+    work_dir_digest = hashlib.md5(os.path.abspath(work_dir).encode()).hexdigest()[:12]
+    local_scratch_dir = os.path.join(local_scratch, 'cluster_16S_' + work_dir_digest)
+    os.makedirs(local_scratch_dir, exist_ok=True)
+    return local_scratch_dir
+
+
+def sync_dir(src_dir, dst_dir):
+    """
+    Copy the entries of src_dir that are not hidden to dst_dir, skipping files that
+    have the same size and modification time in dst_dir. Each file is copied to a
+    hidden name and renamed, so dst_dir never holds a partial file.
+    Returns the number of files copied.
+    """
+    os.makedirs(dst_dir, exist_ok=True)
+    dst_entries = {entry.name: entry.stat() for entry in os.scandir(dst_dir) if entry.is_file()}
+    copied_count = 0
+    for entry in os.scandir(src_dir):
+        if entry.name.startswith('.'):
+            continue
+        dst_fp = os.path.join(dst_dir, entry.name)
+        if entry.is_dir():
+            copied_count += sync_dir(entry.path, dst_fp)
+            continue
+        src_stat = entry.stat()
+        dst_stat = dst_entries.get(entry.name)
+        if dst_stat is not None \
+                and dst_stat.st_size == src_stat.st_size \
+                and int(dst_stat.st_mtime) == int(src_stat.st_mtime):
+            continue
+        sync_fp = os.path.join(dst_dir, SYNC_PREFIX + entry.name)
+        shutil.copy2(entry.path, sync_fp)
+        os.replace(sync_fp, dst_fp)
+        copied_count += 1
+    return copied_count
+
+
+def sync_file(src_fp, dst_fp):
+    os.makedirs(os.path.dirname(dst_fp), exist_ok=True)
+    sync_fp = os.path.join(os.path.dirname(dst_fp), SYNC_PREFIX + os.path.basename(dst_fp))
+    shutil.copy2(src_fp, sync_fp)
+    os.replace(sync_fp, dst_fp)
+
+
+def remove_local_scratch_dir(local_scratch_dir):
+    logging.getLogger(name=__name__).info('removing local scratch directory "%s"', local_scratch_dir)
+    shutil.rmtree(local_scratch_dir, ignore_errors=True)
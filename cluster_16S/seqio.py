@@ -0,0 +1,292 @@
+"""
+Batched FASTQ and FASTA reading and writing on bytes.
+
+Files are read in large chunks (decompressed transparently if the name ends with
+'.gz'). Each chunk of complete records becomes one batch: the chunk itself plus numpy
+arrays of the offsets of the header, sequence and quality of every record. Nothing is
+allocated per record unless a caller asks for the records as bytes, and a batch can
+be written back unchanged with one write. Outputs of a step run with --packed-outputs
+are read from the step's archive by the same path.
+
+"""
+import contextlib
+import gzip
+import io
+import shutil
+
+import numpy as np
+
+from cluster_16S.bgzf import is_bgzf, open_bgzf
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.step_archive import is_packed, open_step_output
+
+
+BUFFER_SIZE = 4 * 1024 * 1024
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+
+
+def open_sequence_file(fp, mode='rb', compresslevel=9, bgzf=False, threads=1):
+    """
+    Open a file for binary reading or writing with a large buffer, through gzip if
+    the file name ends with '.gz'. With bgzf=True a '.gz' file is written as BGZF.
+    BGZF files are always read as BGZF, with threads decompressing in parallel.
+    """
+    if mode not in ('rb', 'wb', 'ab'):
+        raise PipelineException('sequence files are opened in binary mode, not "{}"'.format(mode))
+    if mode == 'rb' and is_packed(fp):
+        return open_packed_sequence_file(fp)
+    if fp.endswith('.gz') and mode == 'rb' and is_bgzf(fp):
+        return open_bgzf(fp, 'rb', threads=threads, buffer_size=BUFFER_SIZE)
+    elif fp.endswith('.gz') and mode == 'wb' and bgzf:
+        return open_bgzf(fp, 'wb', threads=threads, compresslevel=compresslevel)
+    elif fp.endswith('.gz'):
+        gzip_file = gzip.GzipFile(fp, mode, compresslevel=compresslevel)
+        if mode == 'rb':
+            return io.BufferedReader(gzip_file, buffer_size=BUFFER_SIZE)
+        else:
+            return io.BufferedWriter(gzip_file, buffer_size=BUFFER_SIZE)
+    else:
+        return open(fp, mode, buffering=BUFFER_SIZE)
+
+
+def open_packed_sequence_file(fp):
+    # packed BGZF members are read as plain gzip, which BGZF is
+    member_file = open_step_output(fp)
+    if fp.endswith('.gz'):
+        gzip_file = gzip.GzipFile(fileobj=member_file, mode='rb')
+        # closed with the gzip file, as if gzip had opened it
+        gzip_file.myfileobj = member_file
+        return io.BufferedReader(gzip_file, buffer_size=BUFFER_SIZE)
+    else:
+        return member_file
+
+
+class CopyingReader(io.RawIOBase):
+    """
+    Reads raw_file and writes every byte read to copy_file.
+    """
+    def __init__(self, raw_file, copy_file):
+        self.raw_file = raw_file
+        self.copy_file = copy_file
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.raw_file.readinto(b)
+        if n:
+            self.copy_file.write(memoryview(b)[:n])
+        return n
+
+
+@contextlib.contextmanager
+def open_copying_sequence_file(fp, copy_file):
+    """
+    Open a sequence file for reading, through gzip if the name ends with '.gz', and
+    copy it unchanged to copy_file as it is read, so a file can be copied and parsed
+    in one pass.
+    """
+    with open(fp, 'rb') as raw_file:
+        copying_file = CopyingReader(raw_file, copy_file)
+        if fp.endswith('.gz'):
+            copying_file = gzip.GzipFile(fileobj=copying_file, mode='rb')
+        with io.BufferedReader(copying_file, buffer_size=BUFFER_SIZE) as sequence_file:
+            yield sequence_file
+        # anything gzip did not read, e.g. padding after the last member
+        shutil.copyfileobj(raw_file, copy_file)
+
+
+def read_buffer(sequence_file, remainder, chunk_size):
+    """
+    Return (remainder + next chunk, at_end). At the end of the file a final newline
+    is added if it is missing.
+    """
+    chunk = sequence_file.read(chunk_size)
+    at_end = len(chunk) == 0
+    buffer = remainder + chunk if len(remainder) > 0 else chunk
+    if at_end and len(buffer) > 0 and not buffer.endswith(b'\n'):
+        buffer += b'\n'
+    return buffer, at_end
+
+
+def get_line_offsets(buffer, line_ends):
+    # start and end (without '\r\n') of each line given the positions of its '\n'
+    line_starts = np.empty(len(line_ends), dtype=np.int64)
+    line_starts[:1] = 0
+    line_starts[1:] = line_ends[:-1] + 1
+    content_ends = line_ends.copy()
+    if len(line_ends) > 0:
+        content_ends -= np.frombuffer(buffer, dtype=np.uint8)[np.maximum(line_ends - 1, 0)] == CARRIAGE_RETURN
+        content_ends = np.maximum(content_ends, line_starts)
+    return line_starts, content_ends
+
+
+class FastqBatch:
+    """
+    Consecutive FASTQ records. Offsets index buffer; header offsets exclude the '@'.
+    """
+    __slots__ = (
+        'buffer', 'end',
+        'header_starts', 'header_ends',
+        'sequence_starts', 'sequence_ends',
+        'quality_starts', 'quality_ends',
+        'record_starts', 'record_ends')
+
+    def __init__(self, buffer, line_ends, fp=''):
+        self.buffer = buffer
+        self.end = int(line_ends[-1]) + 1
+        line_starts, content_ends = get_line_offsets(buffer, line_ends)
+        self.record_starts = line_starts[0::4]
+        self.record_ends = line_ends[3::4] + 1
+        self.header_starts = line_starts[0::4] + 1
+        self.header_ends = content_ends[0::4]
+        self.sequence_starts = line_starts[1::4]
+        self.sequence_ends = content_ends[1::4]
+        self.quality_starts = line_starts[3::4]
+        self.quality_ends = content_ends[3::4]
+
+        buffer_bytes = np.frombuffer(buffer, dtype=np.uint8)
+        if not (np.all(buffer_bytes[line_starts[0::4]] == ord('@'))
+                and np.all(buffer_bytes[line_starts[2::4]] == ord('+'))
+                and np.array_equal(self.sequence_ends - self.sequence_starts, self.quality_ends - self.quality_starts)):
+            raise PipelineException('malformed FASTQ record in "{}"'.format(fp))
+
+    def __len__(self):
+        return len(self.record_starts)
+
+    def sequence_lengths(self):
+        return self.sequence_ends - self.sequence_starts
+
+    def get_slices(self, starts, ends):
+        buffer = self.buffer
+        return [buffer[s:e] for s, e in zip(starts.tolist(), ends.tolist())]
+
+    def headers(self):
+        return self.get_slices(self.header_starts, self.header_ends)
+
+    def sequences(self):
+        return self.get_slices(self.sequence_starts, self.sequence_ends)
+
+    def qualities(self):
+        return self.get_slices(self.quality_starts, self.quality_ends)
+
+    def raw(self):
+        # the records exactly as they were read
+        return memoryview(self.buffer)[:self.end]
+
+    def select(self, indices):
+        # the records at indices, as they were read
+        return b''.join(self.get_slices(self.record_starts[indices], self.record_ends[indices]))
+
+
+def read_fastq_batches(fp, batch_size=BUFFER_SIZE, threads=1, copy_file=None):
+    """
+    Yield a FastqBatch for each batch_size bytes (or a little more) of FASTQ records.
+    With copy_file the file is also copied, as it is on disk, to copy_file.
+    """
+    if copy_file is None:
+        opened_file = open_sequence_file(fp, 'rb', threads=threads)
+    else:
+        opened_file = open_copying_sequence_file(fp, copy_file)
+    with opened_file as fastq_file:
+        remainder = b''
+        while True:
+            buffer, at_end = read_buffer(fastq_file, remainder, batch_size)
+            newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == NEWLINE)
+            record_line_count = 4 * (len(newlines) // 4)
+            if record_line_count == 0:
+                remainder = buffer
+            else:
+                batch = FastqBatch(buffer, newlines[:record_line_count], fp=fp)
+                remainder = buffer[batch.end:]
+                yield batch
+            if at_end:
+                if len(remainder.strip()) > 0:
+                    raise PipelineException('incomplete FASTQ record at the end of "{}"'.format(fp))
+                return
+
+
+class FastaBatch:
+    """
+    Consecutive FASTA records, each a header line starting with '>' followed by zero
+    or more sequence lines. Header offsets exclude the '>'.
+    """
+    __slots__ = ('buffer', 'end', 'header_starts', 'header_ends', 'sequence_starts', 'sequence_ends')
+
+    def __init__(self, buffer, header_line_starts, header_line_ends, end):
+        self.buffer = buffer
+        self.end = end
+        self.header_starts = header_line_starts + 1
+        self.header_ends = header_line_ends
+        self.sequence_starts = np.minimum(header_line_ends + 1, end)
+        self.sequence_ends = np.empty(len(header_line_starts), dtype=np.int64)
+        self.sequence_ends[:-1] = header_line_starts[1:]
+        self.sequence_ends[-1:] = end
+
+    def __len__(self):
+        return len(self.header_starts)
+
+    def headers(self):
+        buffer = self.buffer
+        return [
+            buffer[s:e].rstrip(b'\r')
+            for s, e
+            in zip(self.header_starts.tolist(), self.header_ends.tolist())
+        ]
+
+    def labels(self):
+        return [header.decode() for header in self.headers()]
+
+    def sequences(self):
+        # sequences written over several lines are joined
+        buffer = self.buffer
+        return [
+            buffer[s:e].replace(b'\n', b'').replace(b'\r', b'')
+            for s, e
+            in zip(self.sequence_starts.tolist(), self.sequence_ends.tolist())
+        ]
+
+    def raw(self):
+        return memoryview(self.buffer)[:self.end]
+
+
+def read_fasta_batches(fp, batch_size=BUFFER_SIZE):
+    with open_sequence_file(fp, 'rb') as fasta_file:
+        remainder = b''
+        while True:
+            buffer, at_end = read_buffer(fasta_file, remainder, batch_size)
+            buffer_bytes = np.frombuffer(buffer, dtype=np.uint8)
+            line_ends = np.flatnonzero(buffer_bytes == NEWLINE)
+            line_starts = np.concatenate(([0], line_ends[:-1] + 1)).astype(np.int64)
+            all_header_lines = np.flatnonzero(buffer_bytes[line_starts[:len(line_ends)]] == ord('>'))
+            # the last record is known to be complete only at the end of the file
+            header_lines = all_header_lines if at_end else all_header_lines[:-1]
+            if len(header_lines) == 0:
+                remainder = buffer
+            else:
+                if header_lines[0] != 0:
+                    raise PipelineException('FASTA file "{}" does not start with a ">" header'.format(fp))
+                end = len(buffer) if at_end else int(line_starts[all_header_lines[-1]])
+                yield FastaBatch(buffer, line_starts[header_lines], line_ends[header_lines], end=end)
+                remainder = buffer[end:]
+            if at_end:
+                if len(remainder.strip()) > 0:
+                    raise PipelineException('FASTA file "{}" does not start with a ">" header'.format(fp))
+                return
+
+
+def read_fasta_records(fp):
+    """
+    Yield (label, sequence) with the sequence as upper case bytes.
+    """
+    for batch in read_fasta_batches(fp):
+        yield from zip(batch.labels(), (sequence.upper() for sequence in batch.sequences()))
+
+
+def format_fastq_record(header, sequence, quality):
+    return b'@%s\n%s\n+\n%s\n' % (header, sequence, quality)
+
+
+def format_fasta_record(label, sequence):
+    return b'>%s\n%s\n' % (label, sequence)
@@ -0,0 +1,106 @@
+"""
+Exact-sequence index of OTU assignments.
+
+A SequenceIndex maps the 128-bit BLAKE2 digest of a sequence to an OTU id. It starts
+with the OTU centroids and grows as vsearch assigns more sequences, so a read that
+is byte-identical to a centroid or to any read assigned earlier is resolved with one
+dictionary lookup instead of a search. An index can be saved and loaded again to
+map the samples of a later incremental run. The finish() of several mapping jobs
+can grow one index at the same time, so it is changed under a lock.
+
+"""
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+from cluster_16S.otu_table import strip_label_annotations
+from cluster_16S.pipeline_util import PipelineException
+
+
+DIGEST_SIZE = 16
+
+
+def get_sequence_digest(sequence):
+    return hashlib.blake2b(sequence, digest_size=DIGEST_SIZE).digest()
+
+
+class SequenceIndex:
+    def __init__(self, otu_ids=()):
+        self.otu_ids = []
+        self._otu_index = {}
+        self._digest_otu = {}
+        self._lock = threading.Lock()
+        for otu_id in otu_ids:
+            self._get_otu_index(otu_id)
+
+    def __len__(self):
+        return len(self._digest_otu)
+
+    def copy(self):
+        with self._lock:
+            sequence_index = SequenceIndex(otu_ids=self.otu_ids)
+            sequence_index._digest_otu = dict(self._digest_otu)
+        return sequence_index
+
+    def _get_otu_index(self, otu_id):
+        if otu_id not in self._otu_index:
+            self._otu_index[otu_id] = len(self.otu_ids)
+            self.otu_ids.append(otu_id)
+        return self._otu_index[otu_id]
+
+    @classmethod
+    def from_fasta_records(cls, fasta_records):
+        # index OTU centroids given as (label, sequence) records
+        sequence_index = cls()
+        for label, sequence in fasta_records:
+            sequence_index.add(sequence, strip_label_annotations(label))
+        return sequence_index
+
+    def add(self, sequence, otu_id):
+        self.add_digest(get_sequence_digest(sequence), otu_id)
+
+    def add_digest(self, digest, otu_id):
+        self.add_digests([(digest, otu_id)])
+
+    def add_digests(self, digest_otu_ids):
+        # the first assignment of a sequence is kept
+        with self._lock:
+            for digest, otu_id in digest_otu_ids:
+                self._digest_otu.setdefault(digest, self._get_otu_index(otu_id))
+
+    def get(self, sequence):
+        return self.get_digest(get_sequence_digest(sequence))
+
+    def get_digest(self, digest):
+        otu_index = self._digest_otu.get(digest)
+        return None if otu_index is None else self.otu_ids[otu_index]
+
+    def check_otu_ids(self, otu_ids):
+        unknown_otu_ids = set(self.otu_ids).difference(otu_ids)
+        if len(unknown_otu_ids) > 0:
+            raise PipelineException(
+                'sequence index refers to {} OTU(s) that are not in the OTU file, e.g. "{}"'.format(
+                    len(unknown_otu_ids), sorted(unknown_otu_ids)[0]))
+
+    def save(self, fp):
+        with self._lock:
+            np.savez(
+                fp,
+                otu_ids=np.array(self.otu_ids, dtype=str),
+                digests=np.frombuffer(b''.join(self._digest_otu), dtype=np.uint8).reshape(-1, DIGEST_SIZE),
+                otu_indices=np.fromiter(self._digest_otu.values(), dtype=np.int64, count=len(self._digest_otu)))
+        logging.getLogger(name=__name__).info('saved %d sequences to index "%s"', len(self), fp)
+
+    @classmethod
+    def load(cls, fp):
+        with np.load(fp) as npz:
+            sequence_index = cls(otu_ids=npz['otu_ids'].tolist())
+            digest_bytes = npz['digests'].tobytes()
+            otu_indices = npz['otu_indices'].tolist()
+        sequence_index._digest_otu = dict(zip(
+            (digest_bytes[i:i + DIGEST_SIZE] for i in range(0, len(digest_bytes), DIGEST_SIZE)),
+            otu_indices))
+        logging.getLogger(name=__name__).info('loaded %d sequences from index "%s"', len(sequence_index), fp)
+        return sequence_index
@@ -0,0 +1,277 @@
+"""
+Packed step outputs.
+
+With --packed-outputs the per-sample read steps append the output files of each
+sample to one archive file in the step output directory, outputs.pack, instead of
+renaming them into the directory, so the reads of a run over many samples take one
+file per step rather than several per sample. Subdirectories of a sample's outputs
+and the per-step read QC are still written as files.
+
+An archive is a sequence of members, each a header line (PACK1 and a JSON object with
+the member name, sample and size) followed by the bytes of the member. Members are
+only ever appended and each sample is synced before it is recorded in the step
+ledger. A member cut short by a crash is ignored and written over by the next append,
+and a member added again (a sample that was run again) replaces the earlier one. The
+index of members is read by seeking from header to header, without reading the data.
+
+Outputs are found and read by path whether they are packed or not: the path of a
+member is its name in the step output directory. find_step_outputs() lists files and
+members that match a glob, open_step_output() reads either, and
+stage_step_outputs() copies members to real files for external tools.
+
+    unpack_step_outputs work_dir/step_03_merge_forward_reverse_reads_with_pear -o merged '*.assembled.fastq.gz'
+
+"""
+import argparse
+import collections
+import fnmatch
+import glob
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+
+
+ARCHIVE_NAME = 'outputs.pack'
+HEADER_PREFIX = b'PACK1 '
+# longer header lines are not headers
+MAX_HEADER_SIZE = 64 * 1024
+# packed inputs are staged here, in the temporary directory of the sample that reads them
+STAGED_DIR_NAME = '.staged'
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+Member = collections.namedtuple('Member', ['name', 'sample', 'offset', 'size'])
+
+# archives read by find_step_outputs() and open_step_output(), with the size and mtime they were read at
+_archive_cache = {}
+_archive_cache_lock = threading.Lock()
+
+
+class StepArchive:
+    def __init__(self, fp):
+        self.fp = fp
+        # Members by name, in the order they were added
+        self.members = {}
+        self._end = 0
+        self._lock = threading.Lock()
+        if os.path.exists(fp):
+            self._read_index()
+
+    def _read_index(self):
+        archive_size = os.path.getsize(self.fp)
+        with open(self.fp, 'rb') as archive_file:
+            while True:
+                header_line = archive_file.readline(MAX_HEADER_SIZE)
+                if not (header_line.startswith(HEADER_PREFIX) and header_line.endswith(b'\n')):
+                    break
+                try:
+                    header = json.loads(header_line[len(HEADER_PREFIX):])
+                except ValueError:
+                    break
+                offset = self._end + len(header_line)
+                if offset + header['size'] > archive_size:
+                    # a member cut short by a crash
+                    break
+                self.members.pop(header['name'], None)
+                self.members[header['name']] = Member(header['name'], header['sample'], offset, header['size'])
+                self._end = offset + header['size']
+                archive_file.seek(self._end)
+
+    def get_names(self, sample=None):
+        return [name for name, member in self.members.items() if sample is None or member.sample == sample]
+
+    def add_sample_dir(self, sample_name, sample_dir):
+        """
+        Append the files in sample_dir (not its subdirectories) as members of sample
+        sample_name, then remove them. Returns the member names.
+        """
+        fps = sorted(entry.path for entry in os.scandir(sample_dir) if entry.is_file())
+        with self._lock:
+            fd = os.open(self.fp, os.O_RDWR | os.O_CREAT, 0o644)
+            with open(fd, 'r+b') as archive_file:
+                archive_file.truncate(self._end)
+                archive_file.seek(self._end)
+                members = []
+                for fp in fps:
+                    name = os.path.basename(fp)
+                    size = os.path.getsize(fp)
+                    header_line = HEADER_PREFIX + json.dumps(
+                        {'name': name, 'sample': sample_name, 'size': size}).encode() + b'\n'
+                    archive_file.write(header_line)
+                    members.append(Member(name, sample_name, archive_file.tell(), size))
+                    with open(fp, 'rb') as member_file:
+                        shutil.copyfileobj(member_file, archive_file, length=COPY_BUFFER_SIZE)
+                    if archive_file.tell() != members[-1].offset + size:
+                        raise OSError('"{}" changed while it was added to "{}"'.format(fp, self.fp))
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
+                self._end = archive_file.tell()
+            for member in members:
+                self.members.pop(member.name, None)
+                self.members[member.name] = member
+        for fp in fps:
+            os.remove(fp)
+        return [member.name for member in members]
+
+    def open_member(self, name):
+        if name not in self.members:
+            raise FileNotFoundError('no member "{}" in "{}"'.format(name, self.fp))
+        member = self.members[name]
+        return io.BufferedReader(MemberReader(self.fp, member.offset, member.size), buffer_size=COPY_BUFFER_SIZE)
+
+    def extract_member(self, name, output_fp):
+        with self.open_member(name) as member_file, open(output_fp, 'wb') as output_file:
+            shutil.copyfileobj(member_file, output_file, length=COPY_BUFFER_SIZE)
+        return output_fp
+
+
+class MemberReader(io.RawIOBase):
+    """
+    Reads one member of an archive like a file of its own.
+    """
+    def __init__(self, archive_fp, offset, size):
+        self.archive_file = open(archive_fp, 'rb', buffering=0)
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        self.position = max(0, self.position)
+        return self.position
+
+    def readinto(self, b):
+        n = max(0, min(len(b), self.size - self.position))
+        if n == 0:
+            return 0
+        self.archive_file.seek(self.offset + self.position)
+        n = self.archive_file.readinto(memoryview(b)[:n])
+        self.position += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.archive_file.close()
+        super().close()
+
+
+def get_archive_fp(step_dir):
+    return os.path.join(step_dir, ARCHIVE_NAME)
+
+
+def read_step_archive(step_dir):
+    """
+    The archive of step_dir, or None if the step was not packed. Archives are read
+    again only when they have changed.
+    """
+    archive_fp = get_archive_fp(step_dir)
+    try:
+        archive_stat = os.stat(archive_fp)
+    except FileNotFoundError:
+        return None
+    signature = (archive_stat.st_size, archive_stat.st_mtime_ns)
+    with _archive_cache_lock:
+        cached = _archive_cache.get(archive_fp)
+        if cached is None or cached[0] != signature:
+            cached = (signature, StepArchive(archive_fp))
+            _archive_cache[archive_fp] = cached
+        return cached[1]
+
+
+def get_member(fp):
+    # the archive member for path fp, or None if fp is a file or does not exist
+    if os.path.exists(fp):
+        return None
+    step_archive = read_step_archive(os.path.dirname(fp))
+    if step_archive is None:
+        return None
+    return step_archive.members.get(os.path.basename(fp))
+
+
+def is_packed(fp):
+    return get_member(fp) is not None
+
+
+def find_step_outputs(step_dir, file_glob):
+    """
+    Like glob.glob(os.path.join(step_dir, file_glob)), sorted, with the members of the
+    step's archive listed as if they were files.
+    """
+    fps = set(glob.glob(os.path.join(step_dir, file_glob)))
+    step_archive = read_step_archive(step_dir)
+    if step_archive is not None:
+        fps.update(os.path.join(step_dir, name) for name in fnmatch.filter(step_archive.get_names(), file_glob))
+        fps.discard(step_archive.fp)
+    return sorted(fps)
+
+
+def get_step_output_size(fp):
+    member = get_member(fp)
+    return os.path.getsize(fp) if member is None else member.size
+
+
+def open_step_output(fp):
+    # open a step output for binary reading, packed or not
+    if os.path.exists(fp):
+        return open(fp, 'rb')
+    step_archive = read_step_archive(os.path.dirname(fp))
+    if step_archive is None:
+        raise FileNotFoundError('no file or packed output "{}"'.format(fp))
+    return step_archive.open_member(os.path.basename(fp))
+
+
+def get_staged_fps(fps, staging_dir):
+    # the paths stage_step_outputs() will copy packed outputs to, files keep their paths
+    return [os.path.join(staging_dir, os.path.basename(fp)) if is_packed(fp) else fp for fp in fps]
+
+
+def stage_step_outputs(fps, staging_dir):
+    """
+    Copy the packed outputs among fps to staging_dir and return the paths to read
+    all of fps from.
+    """
+    staged_fps = get_staged_fps(fps, staging_dir)
+    for fp, staged_fp in zip(fps, staged_fps):
+        if staged_fp != fp:
+            os.makedirs(staging_dir, exist_ok=True)
+            read_step_archive(os.path.dirname(fp)).extract_member(os.path.basename(fp), staged_fp)
+    return staged_fps
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description='list or extract the packed outputs of a pipeline step')
+    arg_parser.add_argument('step_dir', help='output directory of a step run with --packed-outputs')
+    arg_parser.add_argument('file_globs', nargs='*', default=['*'], help='outputs to list or extract')
+    arg_parser.add_argument('-o', '--output-dir', default=None, help='extract the outputs to this directory')
+    args = arg_parser.parse_intermixed_args()
+
+    step_archive = read_step_archive(args.step_dir)
+    if step_archive is None:
+        logging.getLogger(name=__name__).error('no packed outputs in "%s"', args.step_dir)
+        return 1
+    names = sorted({name for file_glob in args.file_globs for name in fnmatch.filter(step_archive.get_names(), file_glob)})
+    for name in names:
+        if args.output_dir is None:
+            member = step_archive.members[name]
+            print('{}\t{}\t{}'.format(member.sample, name, member.size))
+        else:
+            os.makedirs(args.output_dir, exist_ok=True)
+            step_archive.extract_member(name, os.path.join(args.output_dir, name))
+    return 0
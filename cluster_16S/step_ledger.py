@@ -0,0 +1,118 @@
+"""
+Per-step ledgers of completed samples.
+
+Each per-sample task writes its outputs to a hidden temporary directory inside the
+step output directory. When the task succeeds the outputs are renamed into the step
+output directory and the sample is recorded in the step's ledger. A restarted step
+runs only the samples that are not in its ledger. The ledger is created when the step
+starts, so an output directory without a ledger is from a run that did not keep one.
+
+Ledgers are JSON lines files in <work_dir>/.ledger so they do not appear among the
+step output files.
+
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+
+
+LEDGER_DIR_NAME = '.ledger'
+SAMPLE_DIR_PREFIX = '.tmp.'
+
+
+class StepLedger:
+    def __init__(self, ledger_fp):
+        self.ledger_fp = ledger_fp
+        self.completed_samples = {}
+        self.step_complete = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(ledger_fp):
+            with open(ledger_fp, 'rt') as ledger_file:
+                for line in ledger_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a record cut short by a crash
+                        continue
+                    if record['status'] == 'sample_complete':
+                        self.completed_samples[record['sample']] = record['outputs']
+                    elif record['status'] == 'step_complete':
+                        self.step_complete = True
+
+    def exists(self):
+        return os.path.exists(self.ledger_fp)
+
+    def reset(self):
+        with self._lock:
+            if os.path.exists(self.ledger_fp):
+                os.remove(self.ledger_fp)
+            self.completed_samples = {}
+            self.step_complete = False
+
+    def record_step_started(self):
+        # a started step has a ledger, so outputs left by a failed first run are not taken for a completed step
+        if not self.exists():
+            self._append({'status': 'step_started'})
+
+    def sample_is_complete(self, sample_name):
+        return sample_name in self.completed_samples
+
+    def record_sample_complete(self, sample_name, outputs):
+        self._append({'status': 'sample_complete', 'sample': sample_name, 'outputs': outputs})
+        self.completed_samples[sample_name] = outputs
+
+    def record_step_complete(self):
+        if not self.step_complete:
+            self._append({'status': 'step_complete'})
+            self.step_complete = True
+
+    def _append(self, record):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.ledger_fp), exist_ok=True)
+            with open(self.ledger_fp, 'a+b') as ledger_file:
+                ledger_file.seek(0, os.SEEK_END)
+                if ledger_file.tell() > 0:
+                    ledger_file.seek(-1, os.SEEK_END)
+                    if ledger_file.read(1) != b'\n':
+                        # end a record cut short by a crash so this one is read
+                        ledger_file.write(b'\n')
+                ledger_file.write(json.dumps(record).encode() + b'\n')
+                ledger_file.flush()
+                os.fsync(ledger_file.fileno())
+
+
+def get_step_ledger_fp(work_dir, step_name):
+    return os.path.join(work_dir, LEDGER_DIR_NAME, step_name + '.jsonl')
+
+
+def create_sample_dir(output_dir, sample_name):
+    """
+    Return a new, empty temporary directory for one sample's outputs. Anything left
+    by an earlier attempt at the same sample is removed.
+    """
+    sample_dir = os.path.join(output_dir, SAMPLE_DIR_PREFIX + sample_name)
+    if os.path.exists(sample_dir):
+        logging.getLogger(name=__name__).info('removing incomplete outputs in "%s"', sample_dir)
+        shutil.rmtree(sample_dir)
+    os.mkdir(sample_dir)
+    return sample_dir
+
+
+def commit_sample_dir(sample_dir, output_dir):
+    """
+    Rename every file in sample_dir into output_dir and remove sample_dir. Each rename
+    is atomic, so output_dir never holds a partially written file.
+    """
+    output_names = []
+    for entry in sorted(os.scandir(sample_dir), key=lambda e: e.name):
+        if entry.is_dir():
+            commit_sample_dir(entry.path, os.path.join(output_dir, entry.name))
+        else:
+            os.makedirs(output_dir, exist_ok=True)
+            os.replace(entry.path, os.path.join(output_dir, entry.name))
+        output_names.append(entry.name)
+    os.rmdir(sample_dir)
+    return output_names
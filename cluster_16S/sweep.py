@@ -0,0 +1,257 @@
+"""
+Parameter sweeps that run the steps shared by several settings once.
+
+A sweep takes several values for each of --vsearch-filter-maxee,
+--vsearch-filter-trunclen and --vsearch-derep-minuniquesize and runs every
+combination. Steps 01 to 03 do not depend on these parameters so they run once;
+steps 04 and 05 run once for each (maxee, trunclen) setting; steps 06 to 09 run once
+for each combination. The work directory holds the tree of step executions:
+
+    work_dir/                                        steps 01-03
+    work_dir/maxee_1.trunclen_245/                   steps 04-05
+    work_dir/maxee_1.trunclen_245/minuniquesize_3/   steps 06-09
+
+Each branch directory also has links to the step directories of the branches above
+it, so it looks like the work directory of a single run. The branches of a level run
+concurrently on one JobScheduler. When all of them are done a table comparing OTU
+counts and read retention for each combination is written to
+work_dir/sweep_summary.tsv.
+
+"""
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import glob
+import itertools
+import json
+import logging
+import os
+
+from cluster_16S import trace
+from cluster_16S.batch import ReferenceCache
+from cluster_16S.otu_table import read_otu_table_npz
+from cluster_16S.pipeline import Pipeline, get_args
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.planner import describe_inputs
+from cluster_16S.scheduler import JobScheduler
+
+
+# the swept parameters each group of steps adds to the parameters of the steps before it
+SweepStage = collections.namedtuple('SweepStage', ['parameters', 'steps'])
+
+SWEEP_STAGES = (
+    SweepStage(
+        parameters=(),
+        steps=(
+            'step_01_copy_and_compress',
+            'step_02_remove_primers',
+            'step_03_merge_forward_reverse_reads_with_pear')),
+    SweepStage(
+        parameters=('vsearch_filter_maxee', 'vsearch_filter_trunclen'),
+        steps=(
+            'step_04_qc_reads_with_vsearch',
+            'step_05_combine_runs')),
+    SweepStage(
+        parameters=('vsearch_derep_minuniquesize', ),
+        steps=(
+            'step_06_dereplicate_sort_remove_low_abundance_reads',
+            'step_07_cluster_97_percent',
+            'step_08_reference_based_chimera_detection',
+            'step_09_create_otu_table')),
+)
+
+PARAMETER_DIR_NAMES = {
+    'vsearch_filter_maxee': 'maxee',
+    'vsearch_filter_trunclen': 'trunclen',
+    'vsearch_derep_minuniquesize': 'minuniquesize',
+}
+
+SUMMARY_COLUMNS = (
+    'vsearch_filter_maxee', 'vsearch_filter_trunclen', 'vsearch_derep_minuniquesize',
+    'merged_reads', 'filtered_reads', 'filtered_fraction',
+    'otu_count', 'otu_table_reads', 'otu_table_fraction',
+    'work_dir', 'error',
+)
+
+# one branch of the tree: the swept settings so far, its work directory and the
+# output directory of its last step
+SweepBranch = collections.namedtuple('SweepBranch', ['settings', 'work_dir', 'output_dir'])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    grid, args, max_concurrent_branches = get_sweep_args()
+    summary_rows = run_sweep(grid, args, max_concurrent_branches=max_concurrent_branches)
+    return 1 if any(row['error'] for row in summary_rows) else 0
+
+
+def get_sweep_args(argv=None):
+    """
+    Return (grid, pipeline arguments, max concurrent branches). The grid is
+    {parameter: [values]} for the swept parameters, all other arguments are those of
+    the pipeline.
+    """
+    arg_parser = argparse.ArgumentParser(
+        description='run the pipeline for every combination of the swept parameters, '
+                    'all other arguments are passed to the pipeline')
+    for parameter in PARAMETER_DIR_NAMES:
+        arg_parser.add_argument('--' + parameter.replace('_', '-'), nargs='+', required=True, type=int)
+    arg_parser.add_argument('--max-concurrent-branches', default=None, type=int,
+                            help='run at most this many branches of the sweep at once, by default all of them')
+    sweep_args, pipeline_argv = arg_parser.parse_known_args(argv)
+    grid = {parameter: getattr(sweep_args, parameter) for parameter in PARAMETER_DIR_NAMES}
+    for parameter, values in grid.items():
+        if len(set(values)) < len(values):
+            arg_parser.error('values of --{} are not unique'.format(parameter.replace('_', '-')))
+
+    # the pipeline checks its arguments as usual, with the first value of each swept parameter
+    args = get_args(pipeline_argv + [
+        a for parameter, values in grid.items() for a in ('--' + parameter.replace('_', '-'), str(values[0]))])
+    if args.previous_otus_fp is not None:
+        arg_parser.error('a sweep can not map new samples to the OTUs of a previous run')
+    return grid, args, sweep_args.max_concurrent_branches
+
+
+def get_branch_dir_name(settings):
+    # {'vsearch_filter_maxee': 1, 'vsearch_filter_trunclen': 245} -> 'maxee_1.trunclen_245'
+    return '.'.join('{}_{}'.format(PARAMETER_DIR_NAMES[parameter], value) for parameter, value in settings.items())
+
+
+def link_step_dirs(parent_work_dir, work_dir):
+    # relative links, so the sweep directory can be moved
+    for entry in os.scandir(parent_work_dir):
+        link_fp = os.path.join(work_dir, entry.name)
+        if entry.name.startswith('step_') and entry.is_dir() and not os.path.lexists(link_fp):
+            os.symlink(os.path.relpath(os.path.realpath(entry.path), work_dir), link_fp)
+
+
+def run_sweep(grid, args, max_concurrent_branches=None):
+    """
+    Run every combination of the parameter values in grid, sharing steps as described
+    above, and write the summary table. A failed branch does not stop the other
+    branches. Returns the summary rows.
+    """
+    log = logging.getLogger(name=__name__)
+    job_scheduler = JobScheduler(
+        core_count=args.core_count, command_timeout=args.command_timeout, memory_limit=args.memory_limit)
+    reference_cache = ReferenceCache()
+    input_description = describe_inputs(args.input_dir)
+
+    def run_branch(parent_branch, stage, settings):
+        work_dir = parent_branch.work_dir
+        if len(stage.parameters) > 0:
+            work_dir = os.path.join(
+                work_dir, get_branch_dir_name({parameter: settings[parameter] for parameter in stage.parameters}))
+        log.info('running %s in "%s"', ', '.join(stage.steps), work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+        if work_dir != parent_branch.work_dir:
+            link_step_dirs(parent_branch.work_dir, work_dir)
+
+        # the branches are traced by the sweep's tracer, not one of their own
+        pipeline = Pipeline(**dict(
+            args.__dict__, **settings, work_dir=work_dir, trace_fp=None,
+            job_scheduler=job_scheduler, reference_cache=reference_cache))
+        pipeline.input_description = input_description
+        output_dir_list = [parent_branch.output_dir]
+        for step in stage.steps:
+            output_dir_list.append(getattr(pipeline, step)(input_dir=output_dir_list[-1]))
+        output_dir_list = pipeline.complete_run(output_dir_list[1:])
+        return SweepBranch(settings=settings, work_dir=work_dir, output_dir=output_dir_list[-1])
+
+    # branches and errors by the tuple of their swept parameter values
+    branches = {(): SweepBranch(settings={}, work_dir=args.work_dir, output_dir=args.input_dir)}
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrent_branches or max(1, len(list(get_grid_settings(grid)))),
+            thread_name_prefix='branch') as executor, tracing(args.trace_fp):
+        parent_keys = [()]
+        for stage in SWEEP_STAGES:
+            futures = {}
+            for parent_key in parent_keys:
+                for values in itertools.product(*(grid[parameter] for parameter in stage.parameters)):
+                    settings = dict(branches[parent_key].settings, **dict(zip(stage.parameters, values)))
+                    futures[parent_key + values] = executor.submit(
+                        contextvars.copy_context().run, run_branch, branches[parent_key], stage, settings)
+            for key, future in futures.items():
+                try:
+                    branches[key] = future.result()
+                except BaseException as e:
+                    log.exception('sweep branch %s failed', key)
+                    errors[key] = e
+            parent_keys = [key for key in futures if key in branches]
+
+    summary_rows = []
+    for settings in get_grid_settings(grid):
+        key = tuple(settings[parameter] for stage in SWEEP_STAGES for parameter in stage.parameters)
+        # the error of the first branch on the way to this combination that failed
+        error = next((errors[key[:i]] for i in range(len(key) + 1) if key[:i] in errors), None)
+        if error is not None:
+            summary_rows.append(dict(settings, error=str(error) or type(error).__name__))
+        else:
+            summary_rows.append(dict(settings, **get_branch_summary(branches[key].work_dir), error=''))
+
+    summary_fp = os.path.join(args.work_dir, 'sweep_summary.tsv')
+    write_summary(summary_rows, summary_fp)
+    log.info('sweep summary written to "%s"', summary_fp)
+    return summary_rows
+
+
+@contextlib.contextmanager
+def tracing(trace_fp):
+    # one trace of all branches, which run in copies of this context
+    tracer = None if trace_fp is None else trace.Tracer()
+    try:
+        with trace.use_tracer(tracer), trace.span('sweep', 'pipeline'):
+            yield
+    finally:
+        if tracer is not None:
+            trace.write_trace(trace_fp, tracer)
+
+
+def get_grid_settings(grid):
+    # every combination of the values in grid, in the order of the values
+    parameters = [parameter for stage in SWEEP_STAGES for parameter in stage.parameters]
+    for values in itertools.product(*(grid[parameter] for parameter in parameters)):
+        yield dict(zip(parameters, values))
+
+
+def get_read_count(step_dir, qc_json_glob='*.qc.json'):
+    # read counts of the built-in read QC of a step
+    read_count = 0
+    for qc_json_fp in glob.glob(os.path.join(step_dir, 'read_qc', qc_json_glob)):
+        with open(qc_json_fp, 'rt') as qc_json_file:
+            read_count += json.load(qc_json_file)['read_count']
+    return read_count
+
+
+def get_branch_summary(work_dir):
+    merged_reads = get_read_count(
+        os.path.join(work_dir, SWEEP_STAGES[0].steps[-1]), qc_json_glob='*.assembled.fastq*.qc.json')
+    filtered_reads = get_read_count(os.path.join(work_dir, SWEEP_STAGES[1].steps[0]))
+    otu_table_fps = glob.glob(os.path.join(work_dir, SWEEP_STAGES[2].steps[-1], '*.otutab.merged.npz'))
+    if len(otu_table_fps) != 1:
+        raise PipelineException('expected one OTU table in "{}" but found {}'.format(work_dir, len(otu_table_fps)))
+    otu_table = read_otu_table_npz(otu_table_fps[0])
+    otu_table_reads = int(otu_table.sample_totals().sum())
+    return {
+        'merged_reads': merged_reads,
+        'filtered_reads': filtered_reads,
+        'filtered_fraction': round(filtered_reads / merged_reads, 4) if merged_reads > 0 else '',
+        'otu_count': otu_table.shape[0],
+        'otu_table_reads': otu_table_reads,
+        'otu_table_fraction': round(otu_table_reads / merged_reads, 4) if merged_reads > 0 else '',
+        'work_dir': work_dir,
+    }
+
+
+def write_summary(summary_rows, summary_fp):
+    with open(summary_fp, 'wt') as summary_file:
+        summary_file.write('\t'.join(SUMMARY_COLUMNS) + '\n')
+        for row in summary_rows:
+            summary_file.write('\t'.join(str(row.get(column, '')) for column in SUMMARY_COLUMNS) + '\n')
+
+
+if __name__ == '__main__':
+    main()
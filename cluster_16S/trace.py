@@ -0,0 +1,187 @@
+"""
+Timeline tracing in Chrome trace event format.
+
+Tracing is off unless a Tracer is made current with use_tracer(), as each Pipeline
+with a trace file does for its run, or enable_tracing() is called for the whole
+process. The current tracer is a context variable, so the runs of a batch or a
+daemon each trace only their own work; work handed to other threads is run in a
+copy of the context that handed it over. While tracing is off span() returns one
+shared do-nothing context manager and add_span() returns at once, so the calls can
+stay in the code. While it is on every span is kept in memory as a complete ('X')
+event on the lane of the thread that ran it, or of the child process for external
+commands, and write_trace() saves them as JSON that Perfetto and chrome://tracing
+can open.
+
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+
+# the tracer of the whole process, see enable_tracing()
+_tracer = None
+# the tracer of the current run, see use_tracer()
+_current_tracer = contextvars.ContextVar('tracer', default=None)
+_null_span = contextlib.nullcontext()
+
+
+class Tracer:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.start_ns = time.perf_counter_ns()
+        self.events = []
+        # metadata events naming each process and thread lane, by (pid, tid)
+        self.lane_names = {}
+        self.lock = threading.Lock()
+
+    def now(self):
+        # microseconds since tracing started
+        return (time.perf_counter_ns() - self.start_ns) / 1000
+
+    def add_span(self, name, category, start, end, pid=None, tid=None, lane_name=None, args=None):
+        if pid is None:
+            pid = self.pid
+        if tid is None:
+            tid = threading.get_native_id()
+            lane_name = threading.current_thread().name
+        event = {
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': start, 'dur': end - start, 'pid': pid, 'tid': tid,
+        }
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+            if (pid, tid) not in self.lane_names:
+                self.lane_names[(pid, tid)] = lane_name or str(tid)
+
+    def get_trace_events(self):
+        with self.lock:
+            metadata_events = []
+            for (pid, tid), lane_name in self.lane_names.items():
+                if pid != self.pid:
+                    metadata_events.append(
+                        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': lane_name}})
+                metadata_events.append(
+                    {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': lane_name}})
+            metadata_events.append(
+                {'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': 0, 'args': {'name': 'cluster_16S'}})
+            return metadata_events + sorted(self.events, key=lambda e: e['ts'])
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start')
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add_span(self.name, self.category, self.start, self.tracer.now(), args=self.args)
+
+
+def enable_tracing():
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def disable_tracing():
+    # returns the tracer, which still holds the spans recorded so far
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+@contextlib.contextmanager
+def use_tracer(tracer):
+    """
+    Record the spans of the with block, and of the work it hands to other threads,
+    with tracer. With tracer None the current tracer is kept.
+    """
+    if tracer is None:
+        yield
+        return
+    token = _current_tracer.set(tracer)
+    try:
+        yield
+    finally:
+        _current_tracer.reset(token)
+
+
+def get_tracer():
+    # the tracer of the current run, else the tracer of the process
+    tracer = _current_tracer.get()
+    return _tracer if tracer is None else tracer
+
+
+def tracing_enabled():
+    return get_tracer() is not None
+
+
+def span(name, category, **args):
+    """
+    Record the time spent in a with block on the current thread's lane.
+    """
+    tracer = get_tracer()
+    if tracer is None:
+        return _null_span
+    return Span(tracer, name, category, args)
+
+
+def traced(category):
+    """
+    Decorator recording a span named after the function for every call.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = get_tracer()
+            if tracer is None:
+                return function(*args, **kwargs)
+            with Span(tracer, function.__name__, category, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def now():
+    tracer = get_tracer()
+    return None if tracer is None else tracer.now()
+
+
+def add_span(name, category, start, pid=None, tid=None, lane_name=None, **args):
+    """
+    Record a span from start (a value returned by now()) until now, e.g. for work
+    that does not run in one thread such as an external command.
+    """
+    tracer = get_tracer()
+    if tracer is None or start is None:
+        return
+    tracer.add_span(name, category, start, tracer.now(), pid=pid, tid=tid, lane_name=lane_name, args=args)
+
+
+def write_trace(fp, tracer=None):
+    # writes the spans of tracer, by default of the current tracer
+    if tracer is None:
+        tracer = get_tracer()
+    if tracer is None:
+        return
+    trace_events = tracer.get_trace_events()
+    with open(fp, 'wt') as trace_file:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, trace_file)
+    logging.getLogger(name=__name__).info('wrote %d trace events to "%s"', len(trace_events), fp)
@@ -0,0 +1,83 @@
+"""
+Per-sample counts of unique sequences.
+
+Step 05 counts every distinct read sequence in every sample while it combines the
+samples. The counts are kept as an OtuTable with one row per unique sequence (ids
+'Uniq1', 'Uniq2', ...) next to a FASTA file of the unique sequences. Step 09 can then
+assign each unique sequence to an OTU once and add up the sample counts of the
+unique sequences assigned to each OTU instead of searching every read.
+
+"""
+import numpy as np
+
+from cluster_16S.otu_table import OtuTable, strip_label_annotations
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.seqio import format_fasta_record, open_sequence_file
+
+
+UNIQUE_ID_PREFIX = 'Uniq'
+
+
+class UniqueSequenceCounter:
+    def __init__(self):
+        self.unique_index = {}
+        self.sample_ids = []
+        self._rows = []
+        self._cols = []
+        self._counts = []
+
+    def add_sample(self, sample_id, sequence_counts):
+        """
+        Add one sample given as a {sequence (bytes): count} mapping, e.g. a Counter.
+        """
+        if sample_id in self.sample_ids:
+            raise PipelineException('sample "{}" was counted more than once'.format(sample_id))
+        col = len(self.sample_ids)
+        self.sample_ids.append(sample_id)
+        self._rows.append(
+            np.fromiter(
+                (self.unique_index.setdefault(sequence, len(self.unique_index)) for sequence in sequence_counts),
+                dtype=np.int64, count=len(sequence_counts)))
+        self._cols.append(np.full(len(sequence_counts), col, dtype=np.int64))
+        self._counts.append(np.fromiter(sequence_counts.values(), dtype=np.int64, count=len(sequence_counts)))
+
+    def get_table(self):
+        return OtuTable.from_coo(
+            otu_ids=get_unique_ids(len(self.unique_index)),
+            sample_ids=self.sample_ids,
+            rows=np.concatenate(self._rows) if self._rows else np.zeros(0, dtype=np.int64),
+            cols=np.concatenate(self._cols) if self._cols else np.zeros(0, dtype=np.int64),
+            data=np.concatenate(self._counts) if self._counts else np.zeros(0, dtype=np.int64))
+
+    def write_fasta(self, fp, bgzf=False, threads=1):
+        # dicts keep insertion order so the i-th sequence is 'Uniq<i+1>'
+        with open_sequence_file(fp, 'wb', bgzf=bgzf, threads=threads) as fasta_file:
+            for i, sequence in enumerate(self.unique_index, start=1):
+                fasta_file.write(format_fasta_record(b'%s%d' % (UNIQUE_ID_PREFIX.encode(), i), sequence))
+
+
+def get_unique_ids(unique_count):
+    return ['{}{}'.format(UNIQUE_ID_PREFIX, i) for i in range(1, unique_count + 1)]
+
+
+def get_unique_index(unique_id):
+    # 'Uniq12;size=3;' -> 11
+    return int(strip_label_annotations(unique_id)[len(UNIQUE_ID_PREFIX):]) - 1
+
+
+def assign_unique_counts(unique_counts, assignment, otu_ids):
+    """
+    Build an OTU table from a table of unique sequence counts and an array giving the
+    OTU index of each unique sequence, or -1 for unique sequences with no OTU.
+    Returns (OTU table, mapped reads per sample, unmapped reads per sample).
+    """
+    rows, cols, data = unique_counts.to_coo()
+    otu_rows = np.asarray(assignment, dtype=np.int64)[rows]
+    mapped = otu_rows >= 0
+    otu_table = OtuTable.from_coo(
+        otu_ids=otu_ids, sample_ids=unique_counts.sample_ids,
+        rows=otu_rows[mapped], cols=cols[mapped], data=data[mapped])
+    sample_count = len(unique_counts.sample_ids)
+    mapped_reads = np.bincount(cols[mapped], weights=data[mapped], minlength=sample_count).astype(np.int64)
+    unmapped_reads = np.bincount(cols[~mapped], weights=data[~mapped], minlength=sample_count).astype(np.int64)
+    return otu_table, mapped_reads, unmapped_reads
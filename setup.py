@@ -105,7 +105,13 @@ setup(
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
         'console_scripts': [
+            'normalize_otu_table=cluster_16S.normalize:main',
             'pipeline=cluster_16S.pipeline:main',
+            'pipeline_batch=cluster_16S.batch:main',
+            'pipeline_daemon=cluster_16S.daemon:main',
+            'pipeline_sweep=cluster_16S.sweep:main',
+            'restore_read_names=cluster_16S.compact_reads:main',
+            'unpack_step_outputs=cluster_16S.step_archive:main',
             'write_launcher_job_file=cluster_16S.write_launcher_job_file:main'
         ],
     },
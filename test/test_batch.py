@@ -0,0 +1,116 @@
+import functools
+import json
+import os
+import tempfile
+import threading
+
+import pytest
+
+import cluster_16S.batch as batch
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.sequence_index import SequenceIndex
+
+
+default_settings = {
+    'cutadapt_min_length': 100,
+    'pear_min_overlap': 20, 'pear_max_assembly_length': 270, 'pear_min_assembly_length': 200,
+    'vsearch_filter_maxee': 1, 'vsearch_filter_trunclen': 245, 'vsearch_derep_minuniquesize': 3,
+}
+
+
+def write_manifest(work_dir, projects, defaults=default_settings):
+    manifest_fp = os.path.join(work_dir, 'manifest.json')
+    with open(manifest_fp, 'wt') as manifest_file:
+        json.dump({'defaults': defaults, 'projects': projects}, manifest_file)
+    return manifest_fp
+
+
+def test_get_project_argv():
+    assert batch.get_project_argv(
+        {'core_count': 4, 'fastqc': True, 'bgzf': False, 'local_scratch': None, 'plan_history': ['a', 'b']}
+    ) == ['--core-count', '4', '--fastqc', '--plan-history', 'a', 'b']
+
+
+def test_read_manifest():
+    with tempfile.TemporaryDirectory() as work_dir:
+        manifest_fp = write_manifest(work_dir, [
+            {'name': 'p1', 'input_dir': '/data/p1', 'work_dir': '/work/p1'},
+            {'name': 'p2', 'input_dir': '/data/p2', 'work_dir': '/work/p2', 'core_count': 2, 'fastqc': True,
+             'pear_min_overlap': 10},
+        ])
+        (name_1, args_1), (name_2, args_2) = batch.read_manifest(manifest_fp, core_count=8)
+
+    assert (name_1, name_2) == ('p1', 'p2')
+    assert args_1.input_dir == '/data/p1'
+    assert args_1.core_count == 8
+    assert args_1.pear_min_overlap == 20
+    assert args_1.fastqc is False
+    # the same default as a separate run
+    assert args_1.forward_primer == 'ATTAGAWACCCVNGTAGTCC'
+    assert args_2.core_count == 2
+    assert args_2.pear_min_overlap == 10
+    assert args_2.fastqc is True
+
+
+def test_read_manifest__invalid():
+    with tempfile.TemporaryDirectory() as work_dir:
+        with pytest.raises(PipelineException):
+            batch.read_manifest(write_manifest(work_dir, [{'name': 'p1', 'input_dir': '/data/p1'}]))
+        with pytest.raises(PipelineException):
+            batch.read_manifest(write_manifest(work_dir, [
+                {'name': 'p1', 'input_dir': '/data/p1', 'work_dir': '/work/p'},
+                {'name': 'p2', 'input_dir': '/data/p2', 'work_dir': '/work/p'}]))
+        with pytest.raises(PipelineException):
+            # a required pipeline argument is missing
+            batch.read_manifest(write_manifest(
+                work_dir, [{'name': 'p1', 'input_dir': '/data/p1', 'work_dir': '/work/p1'}], defaults={}))
+
+
+def test_reference_cache():
+    load_count = [0]
+
+    def load(fp):
+        load_count[0] += 1
+        return SequenceIndex.from_fasta_records([('OTU_1', b'ACGT')])
+
+    reference_cache = batch.ReferenceCache()
+    with tempfile.TemporaryDirectory() as work_dir:
+        otus_fp = os.path.join(work_dir, 'otus.fasta')
+        with open(otus_fp, 'wt') as otus_file:
+            otus_file.write('>OTU_1\nACGT\n')
+
+        threads = [
+            threading.Thread(target=reference_cache.get, args=(functools.partial(load, otus_fp), otus_fp))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert load_count[0] == 1
+
+        os.utime(otus_fp, (0, 0))
+        sequence_index = reference_cache.get(functools.partial(load, otus_fp), otus_fp)
+        assert load_count[0] == 2
+
+    # copies given to pipelines do not change the cached index
+    sequence_index_copy = sequence_index.copy()
+    sequence_index_copy.add(b'TTTT', 'OTU_2')
+    assert len(sequence_index) == 1
+    assert sequence_index_copy.get(b'ACGT') == 'OTU_1'
+
+
+def test_run_batch__failed_project():
+    with tempfile.TemporaryDirectory() as work_dir:
+        empty_input_dir = os.path.join(work_dir, 'empty')
+        os.mkdir(empty_input_dir)
+        manifest_fp = write_manifest(work_dir, [
+            {'name': 'p1', 'input_dir': empty_input_dir, 'work_dir': os.path.join(work_dir, 'p1')},
+            {'name': 'p2', 'input_dir': empty_input_dir, 'work_dir': os.path.join(work_dir, 'p2')},
+        ])
+        results = batch.run_batch(batch.read_manifest(manifest_fp), core_count=2)
+
+        # each project fails on its own
+        assert sorted(results) == ['p1', 'p2']
+        assert all(isinstance(result, PipelineException) for result in results.values())
+        assert os.path.isdir(os.path.join(work_dir, 'p2', 'step_01_copy_and_compress'))
@@ -0,0 +1,89 @@
+import gzip
+import os
+import tempfile
+
+import numpy as np
+
+import cluster_16S.bgzf as bgzf
+import cluster_16S.seqio as seqio
+
+
+def get_data(size):
+    # compressible but not trivially so
+    return np.random.RandomState(1).choice(list(b'ACGT\n'), size=size).astype(np.uint8).tobytes()
+
+
+def test_write_and_read():
+    data = get_data(5 * bgzf.BLOCK_DATA_SIZE + 123)
+    with tempfile.TemporaryDirectory() as work_dir:
+        fp = os.path.join(work_dir, 'data.gz')
+        with bgzf.BgzfWriter(fp, threads=3) as bgzf_file:
+            # writes that do not line up with blocks
+            for i in range(0, len(data), 10000):
+                bgzf_file.write(data[i:i + 10000])
+
+        assert bgzf.is_bgzf(fp)
+        with gzip.open(fp, 'rb') as gzip_file:
+            assert gzip_file.read() == data
+
+        compressed_offsets, uncompressed_offsets = bgzf.read_block_index(fp)
+        assert uncompressed_offsets.tolist() == [i * bgzf.BLOCK_DATA_SIZE for i in range(6)]
+        os.remove(fp + bgzf.INDEX_SUFFIX)
+        scanned_compressed_offsets, scanned_uncompressed_offsets = bgzf.read_block_index(fp)
+        assert scanned_compressed_offsets.tolist() == compressed_offsets.tolist()
+        assert scanned_uncompressed_offsets.tolist() == uncompressed_offsets.tolist()
+
+        with bgzf.open_bgzf(fp, threads=2) as bgzf_file:
+            assert bgzf_file.read() == data
+            for offset in (0, bgzf.BLOCK_DATA_SIZE - 1, 3 * bgzf.BLOCK_DATA_SIZE + 7, len(data) - 5):
+                bgzf_file.seek(offset)
+                assert bgzf_file.tell() == offset
+                assert bgzf_file.read(100) == data[offset:offset + 100]
+
+
+def test_write_empty():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fp = os.path.join(work_dir, 'empty.gz')
+        with bgzf.BgzfWriter(fp):
+            pass
+        with gzip.open(fp, 'rb') as gzip_file:
+            assert gzip_file.read() == b''
+        with bgzf.open_bgzf(fp) as bgzf_file:
+            assert bgzf_file.read() == b''
+
+
+def test_compress_and_decompress_files():
+    data = get_data(2 * bgzf.BLOCK_DATA_SIZE)
+    with tempfile.TemporaryDirectory() as work_dir:
+        fp = os.path.join(work_dir, 'reads.fastq')
+        with open(fp, 'wb') as f:
+            f.write(data)
+        bgzf.compress_files([fp], threads=2)
+        assert not os.path.exists(fp)
+        assert bgzf.is_bgzf(fp + '.gz')
+
+        target_dir = os.path.join(work_dir, 'target')
+        os.mkdir(target_dir)
+        # plain gzip files are decompressed too
+        gzip_fp = os.path.join(work_dir, 'other.fastq.gz')
+        with gzip.open(gzip_fp, 'wb') as gzip_file:
+            gzip_file.write(b'ACGT\n')
+        decompressed_fp, other_fp = bgzf.decompress_files(fp + '.gz', gzip_fp, target_dir=target_dir, threads=2)
+        with open(decompressed_fp, 'rb') as f:
+            assert f.read() == data
+        with open(other_fp, 'rb') as f:
+            assert f.read() == b'ACGT\n'
+
+
+def test_read_fastq_batches():
+    fastq_records = b''.join(
+        seqio.format_fastq_record(b'read_%d' % i, b'ACGT' * 30, b'I' * 120) for i in range(2000))
+    with tempfile.TemporaryDirectory() as work_dir:
+        fastq_fp = os.path.join(work_dir, 'reads.fastq.gz')
+        with seqio.open_sequence_file(fastq_fp, 'wb', bgzf=True, threads=2) as fastq_file:
+            fastq_file.write(fastq_records)
+        assert bgzf.is_bgzf(fastq_fp)
+
+        batches = list(seqio.read_fastq_batches(fastq_fp, batch_size=100000, threads=2))
+        assert sum(len(batch) for batch in batches) == 2000
+        assert b''.join(bytes(batch.raw()) for batch in batches) == fastq_records
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+import cluster_16S.command_runner as command_runner
+from cluster_16S.pipeline_util import PipelineException
+
+
+def test_run_cmd():
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_fp = os.path.join(log_dir, 'log')
+        output = command_runner.run_cmd(['sh', '-c', 'echo hello; echo world 1>&2'], log_file=log_fp)
+
+        assert output.returncode == 0
+        with open(log_fp, 'rt') as log_file:
+            assert log_file.read().splitlines() == [
+                'executing "sh -c echo hello; echo world 1>&2"', 'hello', 'world']
+        # the per-command log has been appended to the shared log and removed
+        assert os.listdir(log_dir) == ['log']
+
+
+def test_run_cmd__failure():
+    with tempfile.TemporaryDirectory() as log_dir:
+        with pytest.raises(PipelineException) as e:
+            command_runner.run_cmd(['sh', '-c', 'echo bad input; exit 3'], log_file=os.path.join(log_dir, 'log'))
+
+        assert 'exit code 3' in str(e.value)
+        assert 'bad input' in str(e.value)
+
+
+def test_run_cmd__missing_executable():
+    with tempfile.TemporaryDirectory() as log_dir:
+        with pytest.raises(PipelineException):
+            command_runner.run_cmd(['no-such-executable-16S'], log_file=os.path.join(log_dir, 'log'))
+
+
+def test_run_cmd__timeout():
+    with tempfile.TemporaryDirectory() as log_dir:
+        with pytest.raises(PipelineException) as e:
+            command_runner.run_cmd(['sleep', '10'], log_file=os.path.join(log_dir, 'log'), timeout=0.2)
+
+        assert 'timed out' in str(e.value)
+
+
+def test_command_runner__concurrent_batch():
+    runner = command_runner.CommandRunner(core_count=4)
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_fp = os.path.join(log_dir, 'log')
+        start = time.time()
+        results = runner.run_commands(
+            [command_runner.Command(['sleep', '0.3'], log_file=log_fp) for _ in range(4)])
+        elapsed = time.time() - start
+
+    assert [result.returncode for result in results] == [0, 0, 0, 0]
+    # the four commands ran at the same time
+    assert elapsed < 1.0
+
+
+def test_command_runner__batch_failure():
+    runner = command_runner.CommandRunner(core_count=2)
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_fp = os.path.join(log_dir, 'log')
+        with pytest.raises(PipelineException):
+            runner.run_commands([
+                command_runner.Command(['sh', '-c', 'exit 1'], log_file=log_fp),
+                command_runner.Command(['sh', '-c', 'echo done > {}'.format(os.path.join(log_dir, 'ok'))],
+                                       log_file=log_fp),
+            ])
+        # the other command still ran to completion
+        assert os.path.exists(os.path.join(log_dir, 'ok'))
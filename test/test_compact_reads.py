@@ -0,0 +1,73 @@
+import gzip
+import os
+import tempfile
+
+import numpy as np
+
+import cluster_16S.compact_reads as compact_reads
+import cluster_16S.seqio as seqio
+
+
+def test_get_quality_bin_table():
+    table = compact_reads.get_quality_bin_table()
+    qualities = bytes(33 + q for q in range(42))
+    binned = [b - 33 for b in qualities.translate(table)]
+    assert binned[:3] == [2, 2, 2]
+    assert binned[3:10] == [6] * 7
+    assert binned[19:21] == [15, 22]
+    assert binned[38:] == [37, 37, 40, 40]
+    assert len(set(binned)) == 8
+    # bytes that are not quality scores are left alone
+    assert b'\n '.translate(table) == b'\n '
+
+
+def test_get_sample_numbers():
+    assert compact_reads.get_sample_numbers(['/i/b_R2.fastq', '/i/a_R1.fastq', '/i/b_R1.fastq', '/i/a_R2.fastq']) == {
+        '/i/a_R1.fastq': 1, '/i/a_R2.fastq': 1, '/i/b_R1.fastq': 2, '/i/b_R2.fastq': 2}
+
+
+def test_get_read_names_fp():
+    assert compact_reads.get_read_names_fp('/w/step_01/a_R1_001.fastq.gz') == \
+        '/w/step_01/read_names/a_R1_001.fastq.names.gz'
+
+
+def test_compact_read_encoder():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fastq_fp = os.path.join(work_dir, 'reads_R1.fastq')
+        with open(fastq_fp, 'wb') as fastq_file:
+            fastq_file.write(b''.join(
+                seqio.format_fastq_record(b'M0:1:%d 1:N:0:1' % i, b'ACGT', b'#5?I') for i in range(20)))
+        names_fp = os.path.join(work_dir, 'reads_R1.fastq.names.gz')
+        encoded_fp = os.path.join(work_dir, 'reads_R1.ids.fastq.gz')
+        with gzip.open(names_fp, 'wb') as names_file, gzip.open(encoded_fp, 'wb') as encoded_file:
+            encoder = compact_reads.CompactReadEncoder(
+                names_file=names_file, quality_bin_table=compact_reads.get_quality_bin_table(), sample_number=2)
+            # several batches, ids continue from batch to batch
+            for batch in seqio.read_fastq_batches(fastq_fp, batch_size=100):
+                encoded_file.write(encoder.encode(batch).raw())
+        assert encoder.read_count == 20
+
+        batch, = seqio.read_fastq_batches(encoded_fp)
+        assert batch.headers() == [b'2_%d' % (i + 1) for i in range(20)]
+        assert batch.sequences() == [b'ACGT'] * 20
+        assert batch.qualities() == [b'#7BI'] * 20
+
+        # a later step adds a suffix to the read ids
+        fasta_fp = os.path.join(work_dir, 'uniques.fasta')
+        with open(fasta_fp, 'wb') as fasta_file:
+            fasta_file.write(b'>2_3;size=5;\nACGT\n>2_20\nACGT\n>Uniq1\nACGT\n>1_3\nACGT\n')
+        restored_fasta_fp = os.path.join(work_dir, 'uniques.restored.fasta')
+        compact_reads.restore_read_names(fasta_fp, names_fp, restored_fasta_fp)
+        assert [label for label, _ in seqio.read_fasta_records(restored_fasta_fp)] == [
+            'M0:1:2 1:N:0:1;size=5;', 'M0:1:19 1:N:0:1', 'Uniq1', '1_3']
+
+        restored_fastq_fp = os.path.join(work_dir, 'reads_R1.restored.fastq.gz')
+        compact_reads.restore_read_names(encoded_fp, names_fp, restored_fastq_fp)
+        batch, = seqio.read_fastq_batches(restored_fastq_fp)
+        assert batch.headers() == [b'M0:1:%d 1:N:0:1' % i for i in range(20)]
+
+
+def test_compact_read_encoder__qualities_only():
+    batch = seqio.FastqBatch(b'@r1\nAC\n+\n+5\n', np.array([3, 6, 8, 11]))
+    encoded = compact_reads.CompactReadEncoder(quality_bin_table=compact_reads.get_quality_bin_table()).encode(batch)
+    assert bytes(encoded.raw()) == b'@r1\nAC\n+\n07\n'
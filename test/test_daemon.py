@@ -0,0 +1,127 @@
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+
+import pytest
+
+import cluster_16S.daemon as daemon
+from cluster_16S.pipeline_util import PipelineException
+
+
+settings = {
+    'cutadapt_min_length': 100, 'pear_min_overlap': 20,
+    'pear_max_assembly_length': 270, 'pear_min_assembly_length': 200,
+    'vsearch_filter_maxee': 1, 'vsearch_filter_trunclen': 245, 'vsearch_derep_minuniquesize': 3,
+}
+
+
+def fake_run_pipeline(pipeline, args):
+    # records the pipeline each job got, fails for a missing input directory
+    if not os.path.isdir(args.input_dir):
+        raise FileNotFoundError(args.input_dir)
+    with open(os.path.join(args.work_dir, 'pipeline.json'), 'wt') as pipeline_file:
+        json.dump({'core_count': pipeline.core_count, 'job_scheduler': id(pipeline.job_scheduler)}, pipeline_file)
+    return [args.work_dir]
+
+
+def test_get_job_settings():
+    job_settings = daemon.get_job_settings(daemon.get_daemon_args([
+        'submit', '/spool', '--wait', '--', '-i', 'data', '-w', 'work',
+        '--cutadapt-min-length', '100', '--pear-min-overlap', '20',
+        '--pear-max-assembly-length', '270', '--pear-min-assembly-length', '200',
+        '--vsearch-filter-maxee', '1', '--vsearch-filter-trunclen', '245', '--vsearch-derep-minuniquesize', '3'])[1])
+    assert job_settings['input_dir'] == os.path.abspath('data')
+    assert job_settings['cutadapt_min_length'] == 100
+    # the daemon decides the core count
+    assert 'core_count' not in job_settings
+
+
+def test_pipeline_daemon(monkeypatch):
+    monkeypatch.setattr(daemon, 'run_pipeline', fake_run_pipeline)
+    with tempfile.TemporaryDirectory() as spool_dir, tempfile.TemporaryDirectory() as work_dir:
+        job_ids = [
+            daemon.submit_job(spool_dir, dict(
+                settings, input_dir=work_dir, work_dir=os.path.join(work_dir, 'p1'))),
+            daemon.submit_job(spool_dir, dict(
+                settings, input_dir=os.path.join(work_dir, 'missing'), work_dir=os.path.join(work_dir, 'p2'))),
+            daemon.submit_job(spool_dir, dict(
+                settings, input_dir=work_dir, work_dir=os.path.join(work_dir, 'p3'), core_count=2), name='three'),
+        ]
+        assert daemon.read_job_status(spool_dir, job_ids[0])['state'] == 'queued'
+        assert daemon.get_job_ids(spool_dir) == job_ids
+
+        pipeline_daemon = daemon.PipelineDaemon(spool_dir, core_count=4, max_concurrent_jobs=2, poll_interval=0.01)
+        serve_thread = threading.Thread(target=pipeline_daemon.serve)
+        serve_thread.start()
+        try:
+            statuses = daemon.wait_for_jobs(spool_dir, job_ids, poll_interval=0.01, timeout=30)
+        finally:
+            daemon.request_stop(spool_dir)
+            serve_thread.join()
+
+        assert [(status['name'], status['state']) for status in statuses] == [
+            ('p1', 'succeeded'), ('p2', 'failed'), ('three', 'succeeded')]
+        assert statuses[0]['output_dirs'] == [os.path.join(work_dir, 'p1')]
+        assert 'missing' in statuses[1]['error']
+        pipelines = []
+        for project in ('p1', 'p3'):
+            with open(os.path.join(work_dir, project, 'pipeline.json'), 'rt') as pipeline_file:
+                pipelines.append(json.load(pipeline_file))
+        assert [p['core_count'] for p in pipelines] == [4, 2]
+        # all jobs share the daemon's scheduler
+        assert pipelines[0]['job_scheduler'] == pipelines[1]['job_scheduler']
+        assert sorted(os.listdir(spool_dir)) == ['queue', 'running', 'status']
+        assert os.listdir(os.path.join(spool_dir, 'running')) == []
+
+
+def get_dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+def test_pipeline_daemon__requeue(monkeypatch):
+    monkeypatch.setattr(daemon, 'run_pipeline', fake_run_pipeline)
+    with tempfile.TemporaryDirectory() as spool_dir, tempfile.TemporaryDirectory() as work_dir:
+        dead_job_id, live_job_id = [
+            daemon.submit_job(spool_dir, dict(settings, input_dir=work_dir, work_dir=os.path.join(work_dir, project)))
+            for project in ('p1', 'p2')
+        ]
+        # claimed by a daemon that died and by a process that is still running
+        os.rename(
+            daemon.get_spool_fp(spool_dir, daemon.QUEUE_DIR_NAME, dead_job_id),
+            daemon.get_running_fp(spool_dir, dead_job_id, socket.gethostname(), get_dead_pid()))
+        live_running_fp = daemon.get_running_fp(spool_dir, live_job_id, socket.gethostname(), os.getppid())
+        os.rename(daemon.get_spool_fp(spool_dir, daemon.QUEUE_DIR_NAME, live_job_id), live_running_fp)
+        # and the daemon that died left its daemon.json
+        daemon.write_json(
+            os.path.join(spool_dir, daemon.DAEMON_FILE_NAME), {'pid': get_dead_pid(), 'host': socket.gethostname()})
+
+        pipeline_daemon = daemon.PipelineDaemon(spool_dir, core_count=1, poll_interval=0.01)
+        serve_thread = threading.Thread(target=pipeline_daemon.serve)
+        serve_thread.start()
+        try:
+            status, = daemon.wait_for_jobs(spool_dir, [dead_job_id], poll_interval=0.01, timeout=30)
+        finally:
+            daemon.request_stop(spool_dir)
+            serve_thread.join()
+        assert status['state'] == 'succeeded'
+        # the job of the live process is not run again
+        assert os.path.exists(live_running_fp)
+        assert daemon.read_job_status(spool_dir, live_job_id)['state'] == 'queued'
+        assert not os.path.exists(os.path.join(spool_dir, daemon.DAEMON_FILE_NAME))
+
+
+def test_pipeline_daemon__running_daemon():
+    with tempfile.TemporaryDirectory() as spool_dir:
+        daemon.create_spool_dir(spool_dir)
+        daemon_fp = os.path.join(spool_dir, daemon.DAEMON_FILE_NAME)
+        daemon.write_json(daemon_fp, {'pid': os.getppid(), 'host': socket.gethostname()})
+        with pytest.raises(PipelineException):
+            daemon.PipelineDaemon(spool_dir, core_count=1, poll_interval=0.01).serve()
+        # the running daemon keeps its daemon.json
+        assert daemon.read_json(daemon_fp)['pid'] == os.getppid()
+        assert sorted(os.listdir(spool_dir)) == ['daemon.json', 'queue', 'running', 'status']
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import cluster_16S.kmer_index as kmer_index
+
+
+def test_get_kmers():
+    assert kmer_index.get_kmers(b'ACGTA', kmer_length=2).tolist() == [1, 6, 11, 12]
+    # k-mers with an N are left out
+    assert kmer_index.get_kmers(b'ACNTA', kmer_length=2).tolist() == [1, 12]
+    assert len(kmer_index.get_kmers(b'A', kmer_length=2)) == 0
+
+
+def test_top_hits():
+    index = kmer_index.KmerIndex.from_kmer_arrays(
+        [kmer_index.get_kmers(s) for s in (b'ACGTACGTACGT', b'TTTTTTTTTTTT', b'ACGTACGTAAAA')])
+    query_kmer_arrays = [kmer_index.get_kmers(s) for s in (b'ACGTACGTACGA', b'GGGGGGGGGGGG', b'TTTTTTTTTACG')]
+    hits = index.top_hits(query_kmer_arrays, 2)
+    assert [h.tolist() for h in hits] == [[0, 2], [], [1]]
+    (hits, counts), _, _ = index.top_hits(query_kmer_arrays, 1, return_counts=True)
+    assert hits.tolist() == [0] and counts.tolist() == [4]
+    # ACGTACGT and CGTACGTA are in 2 sequences
+    assert index.get_shared_kmer_counts(query_kmer_arrays[:1], max_postings=1).tolist() == [[2, 0, 0]]
+
+
+def test_open_kmer_index():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fasta_fp = os.path.join(work_dir, 'reference.fasta')
+        rng = np.random.default_rng(1)
+        sequences = [bytes(rng.choice(list(b'ACGT'), size=300).tolist()) for _ in range(50)]
+        with open(fasta_fp, 'wb') as fasta_file:
+            for i, sequence in enumerate(sequences):
+                fasta_file.write(b'>ref_%d\n%s\n%s\n' % (i, sequence[:150], sequence[150:]))
+
+        index = kmer_index.open_kmer_index(fasta_fp)
+        assert os.path.isdir(kmer_index.get_kmer_index_dir(fasta_fp))
+        assert isinstance(index.postings, np.memmap)
+        assert index.sequence_count == 50
+        # the same index as one built in memory
+        in_memory_index = kmer_index.KmerIndex.from_kmer_arrays([kmer_index.get_kmers(s) for s in sequences])
+        assert np.array_equal(index.offsets, in_memory_index.offsets)
+        assert np.array_equal(index.postings, in_memory_index.postings)
+
+        (label, shared_count), = index.search([sequences[7][20:120]], 1)[0]
+        assert label == 'ref_7' and shared_count == 93
+
+        # the index is used again until the reference changes
+        postings_fp = os.path.join(kmer_index.get_kmer_index_dir(fasta_fp), 'postings.npy')
+        postings_mtime = os.path.getmtime(postings_fp)
+        kmer_index.open_kmer_index(fasta_fp)
+        assert os.path.getmtime(postings_fp) == postings_mtime
+        with open(fasta_fp, 'ab') as fasta_file:
+            fasta_file.write(b'>ref_50\nACGTACGTACGT\n')
+        assert kmer_index.open_kmer_index(fasta_fp).sequence_count == 51
+
+
+def test_build_kmer_index__concurrent():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fasta_fp = os.path.join(work_dir, 'reference.fasta')
+        with open(fasta_fp, 'wb') as fasta_file:
+            fasta_file.write(b'>ref_0\nACGTACGTACGTTTGA\n>ref_1\nTTTTGGGGCCCCAAAA\n')
+        index_dir = kmer_index.get_kmer_index_dir(fasta_fp)
+
+        # runs building the same index at once each build in a directory of their own
+        errors = []
+
+        def build():
+            try:
+                kmer_index.build_kmer_index(fasta_fp, index_dir)
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=build) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert sorted(os.listdir(work_dir)) == ['reference.fasta', os.path.basename(index_dir)]
+        assert kmer_index.kmer_index_is_current(fasta_fp, index_dir)
+        assert kmer_index.load_kmer_index(index_dir).labels == ['ref_0', 'ref_1']
@@ -0,0 +1,101 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+import cluster_16S.memory as memory
+from cluster_16S.command_runner import CommandRunner
+
+
+MB = 1024 * 1024
+
+
+def test_parse_memory_size():
+    assert memory.parse_memory_size('1000') == 1000
+    assert memory.parse_memory_size('512M') == 512 * MB
+    assert memory.parse_memory_size('1.5g') == 1536 * MB
+    assert memory.parse_memory_size('2TB') == 2 * 1024 ** 4
+    with pytest.raises(ValueError):
+        memory.parse_memory_size('lots')
+
+
+def test_get_tree_rss():
+    with tempfile.TemporaryDirectory() as proc_dir:
+        # pid: (parent pid, RSS in pages), 40 is not below 10
+        for pid, (parent_pid, pages) in {10: (1, 100), 11: (10, 20), 12: (11, 3), 13: (10, 5), 40: (1, 1000)}.items():
+            os.mkdir(os.path.join(proc_dir, str(pid)))
+            with open(os.path.join(proc_dir, str(pid), 'stat'), 'wt') as stat_file:
+                stat_file.write('{} (a (b) c) S {} {} {}\n'.format(pid, parent_pid, ' '.join(['0'] * 19), pages))
+        os.mkdir(os.path.join(proc_dir, 'self'))
+
+        processes = memory.read_process_table(proc_dir)
+        assert processes[12] == (11, 3 * memory.PAGE_SIZE)
+        rss, child_rss = memory.get_tree_rss(processes, 10)
+    assert rss == 128 * memory.PAGE_SIZE
+    assert child_rss == {11: 23 * memory.PAGE_SIZE, 13: 5 * memory.PAGE_SIZE}
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason='needs /proc')
+def test_memory_monitor():
+    memory_monitor = memory.MemoryMonitor(interval=0.01)
+    child = subprocess.Popen(
+        [sys.executable, '-c', 'import sys, time; x = bytearray(64 * 2 ** 20); print(); sys.stdout.flush(); '
+                               'time.sleep(10)'],
+        stdout=subprocess.PIPE)
+    try:
+        child.stdout.readline()
+        measurement = memory_monitor.begin('step')
+        memory_monitor.sample()
+    finally:
+        child.kill()
+        child.wait()
+    memory_record = memory_monitor.end(measurement)
+    assert memory_monitor.pop_child_peak(child.pid) >= 64 * MB
+    assert memory_monitor.pop_child_peak(child.pid) is None
+    assert memory_record['step_peak_rss_bytes'] >= 64 * MB
+    memory_monitor.stop()
+
+
+def test_memory_monitor__tracemalloc():
+    memory_monitor = memory.MemoryMonitor(interval=0.01)
+    measurement = memory_monitor.begin('step', tracemalloc_top=3)
+    held = [bytes(MB) for _ in range(8)]
+    memory_record = memory_monitor.end(measurement)
+    memory_monitor.stop()
+    assert memory_record['python_peak_bytes'] >= 8 * MB
+    assert len(memory_record['top_allocations']) <= 3
+    top_allocation = memory_record['top_allocations'][0]
+    assert top_allocation['location'].startswith(__file__)
+    assert top_allocation['size_bytes'] >= 8 * MB
+    assert len(held) == 8
+    # tracing stops with the last measurement
+    assert not tracemalloc.is_tracing()
+
+
+def test_command_runner__memory_limit():
+    # always over a limit of one byte: one function at a time runs, never none
+    command_runner = CommandRunner(core_count=3, memory_limit=1)
+    command_runner.memory_monitor.interval = 0.01
+    running = [0]
+    max_running = [0]
+    lock = threading.Lock()
+
+    def function():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    command_runner.run_functions([function] * 4)
+    assert max_running[0] == 1
+
+    command_runner = CommandRunner(core_count=3)
+    command_runner.run_functions([function] * 3)
+    assert max_running[0] == 3
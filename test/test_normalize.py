@@ -0,0 +1,93 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+import cluster_16S.normalize as normalize
+from cluster_16S.otu_table import OtuTable, read_otu_table, write_otu_table
+from cluster_16S.pipeline_util import PipelineException
+
+
+def get_table():
+    # OTU_3 is rare, sample s3 is shallow
+    return OtuTable.from_coo(
+        otu_ids=['OTU_1', 'OTU_2', 'OTU_3', 'OTU_4'], sample_ids=['s1', 's2', 's3'],
+        rows=[0, 0, 1, 1, 2, 3, 3, 0],
+        cols=[0, 1, 0, 1, 1, 0, 1, 2],
+        data=[500, 20, 300, 900, 1, 200, 79, 5])
+
+
+def get_dense(table):
+    dense = np.zeros(table.shape, dtype=table.data.dtype)
+    rows, cols, data = table.to_coo()
+    dense[rows, cols] = data
+    return dense
+
+
+def test_rarefy():
+    table = get_table()
+    rarefied = normalize.rarefy(table, depth=100, seed=1)
+    assert rarefied.sample_ids == ['s1', 's2']
+    assert rarefied.otu_ids == table.otu_ids
+    assert rarefied.sample_totals().tolist() == [100, 100]
+    assert np.all(get_dense(rarefied) <= get_dense(table)[:, :2])
+    assert np.issubdtype(rarefied.data.dtype, np.integer)
+    # the same seed gives the same table
+    assert np.array_equal(get_dense(normalize.rarefy(table, depth=100, seed=1)), get_dense(rarefied))
+
+    # the expected count of each OTU is its share of the sample
+    mean = np.mean([get_dense(normalize.rarefy(table, depth=100, seed=seed)) for seed in range(300)], axis=0)
+    assert np.allclose(mean[:, 0], [50, 30, 0, 20], atol=1.5)
+    assert np.allclose(mean[:, 1], [2, 90, 0.1, 7.9], atol=1.5)
+
+    # all reads of a sample at its full depth
+    assert np.array_equal(get_dense(normalize.rarefy(table, depth=1000, seed=2)), get_dense(table)[:, :2])
+    assert normalize.rarefy(table, depth=2000).nnz == 0
+
+
+def test_rarefy__not_counts():
+    with pytest.raises(PipelineException):
+        normalize.rarefy(normalize.relative_abundance(get_table()), depth=1)
+
+
+def test_filter_otus():
+    table = get_table()
+    assert normalize.filter_otus(table, min_count=2).otu_ids == ['OTU_1', 'OTU_2', 'OTU_4']
+    assert normalize.filter_otus(table, min_sample_count=3).otu_ids == ['OTU_1']
+    filtered = normalize.filter_otus(table, min_fraction=0.3)
+    assert filtered.otu_ids == ['OTU_2']
+    assert filtered.get_sample_counts('s2') == {'OTU_2': 900}
+
+
+def test_relative_abundance_and_clr():
+    table = get_table()
+    relative = normalize.relative_abundance(table)
+    assert np.allclose(relative.sample_totals(), 1.0)
+    assert relative.get_sample_counts('s1')['OTU_1'] == 0.5
+
+    transformed = get_dense(normalize.clr(table))
+    dense = get_dense(table)
+    for c in range(dense.shape[1]):
+        nonzero = dense[:, c] > 0
+        logs = np.log(dense[nonzero, c])
+        assert np.allclose(transformed[nonzero, c], logs - logs.mean())
+        assert np.all(transformed[~nonzero, c] == 0)
+
+
+def test_normalize_otu_table():
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_fp = os.path.join(work_dir, 'a.otutab.txt')
+        output_fp = os.path.join(work_dir, 'a.rarefied.otutab.txt')
+        write_otu_table(get_table(), input_fp)
+        args = normalize.get_args([
+            input_fp, '-o', output_fp, '--min-otu-count', '2', '--rarefy-depth', '100', '--seed', '3',
+            '--normalization', 'relative'])
+        table = normalize.normalize_otu_table(
+            read_otu_table(args.input_fps[0]), min_otu_count=args.min_otu_count, rarefy_depth=args.rarefy_depth,
+            seed=args.seed, normalization=args.normalization)
+        write_otu_table(table, args.output_fp)
+        written = read_otu_table(output_fp)
+    assert written.otu_ids == ['OTU_1', 'OTU_2', 'OTU_4']
+    assert written.sample_ids == ['s1', 's2']
+    assert np.allclose(written.sample_totals(), 1.0)
@@ -0,0 +1,95 @@
+import gzip
+import os
+import random
+import tempfile
+
+import numpy as np
+
+import cluster_16S.otu_clustering as otu_clustering
+from cluster_16S.otu_table import read_mapping_records
+from cluster_16S.seqio import read_fasta_records
+
+
+def get_edit_distance(a, b):
+    previous_row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            row[j] = min(previous_row[j - 1] + (a[i - 1] != b[j - 1]), previous_row[j] + 1, row[j - 1] + 1)
+        previous_row = row
+    return previous_row[-1]
+
+
+def mutate(rng, sequence, edit_count):
+    sequence = bytearray(sequence)
+    for _ in range(edit_count):
+        r = rng.random()
+        position = rng.randrange(len(sequence))
+        if r < 0.4:
+            sequence[position] = rng.choice(b'ACGT')
+        elif r < 0.7:
+            del sequence[position]
+        else:
+            sequence.insert(position, rng.choice(b'ACGT'))
+    return bytes(sequence)
+
+
+def get_random_sequence(rng, length):
+    return bytes(rng.choice(b'ACGT') for _ in range(length))
+
+
+def test_get_edit_distances():
+    rng = random.Random(1)
+    queries, targets, max_edits = [], [], []
+    for _ in range(200):
+        query = get_random_sequence(rng, rng.randint(20, 60))
+        queries.append(query)
+        targets.append(mutate(rng, query, rng.randint(0, 10)))
+        max_edits.append(rng.randint(0, 8))
+    distances = otu_clustering.get_edit_distances(queries, targets, max_edits)
+    assert distances.tolist() == [
+        min(get_edit_distance(q, t), m + 1) for q, t, m in zip(queries, targets, max_edits)]
+
+
+def test_cluster_otus():
+    rng = random.Random(2)
+    parents = [get_random_sequence(rng, 200) for _ in range(5)]
+    # the parents and 1 to 3 edit variants of them, less abundant than the parents
+    records = [(b'Uniq%d;size=%d;' % (i + 1, 100 - i), parent) for i, parent in enumerate(parents)]
+    for i in range(200):
+        parent_index = rng.randrange(len(parents))
+        label = b'Uniq%d;size=%d;' % (len(records) + 1, 3 + i % 7)
+        records.append((label, mutate(rng, parents[parent_index], rng.randint(1, 3))))
+    parent_labels = [label.decode() for label, _ in records[:len(parents)]]
+    rng.shuffle(records)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_fp = os.path.join(work_dir, 'combined.derepmin3.fasta.gz')
+        with gzip.open(input_fp, 'wb') as input_file:
+            input_file.write(b''.join(b'>%s\n%s\n' % record for record in records))
+
+        results = []
+        for threads in (1, 3):
+            otus_fp = os.path.join(work_dir, 'otus_{}.fasta'.format(threads))
+            uparse_fp = os.path.join(work_dir, 'otus_{}.txt'.format(threads))
+            otu_count = otu_clustering.cluster_otus(input_fp, otus_fp, uparse_fp, identity=0.97, threads=threads)
+            results.append((list(read_fasta_records(otus_fp)), list(read_mapping_records(uparse_fp, fmt='uparse'))))
+
+    assert otu_count == 5
+    otus, mapping = results[0]
+    # the most abundant sequences are the centroids
+    assert otus == [('OTU_{}'.format(i + 1), parent) for i, parent in enumerate(parents)]
+    assert len(mapping) == len(records)
+    assert {centroid_label for _, centroid_label in mapping} == set(parent_labels)
+    # the same clusters with any number of threads
+    assert results[1] == results[0]
+
+
+def test_greedy_clusterer__batches():
+    rng = random.Random(3)
+    parents = [get_random_sequence(rng, 100) for _ in range(20)]
+    sequences = parents + [mutate(rng, rng.choice(parents), 2) for _ in range(300)]
+    # centroids found earlier in the same batch are used
+    centroid_indices, assignment, identities = otu_clustering.GreedyClusterer(batch_size=1000).cluster(sequences)
+    assert centroid_indices == list(range(20))
+    assert np.all(identities >= 0.97)
@@ -0,0 +1,114 @@
+import os
+import tempfile
+
+import numpy as np
+
+import cluster_16S.otu_table as otu_table
+
+
+uc_records = '''\
+H\t0\t250\t100.0\t+\t0\t0\t250M\tread_1;size=3;\tOTU_1
+H\t1\t250\t98.4\t+\t0\t0\t250M\tread_2\tOTU_2;size=10;
+N\t*\t250\t*\t*\t*\t*\t*\tread_3\t*
+H\t0\t250\t99.2\t+\t0\t0\t250M\tread_4\tOTU_1
+'''
+
+
+def write_uc_file(uc_dir, name, records=uc_records):
+    uc_fp = os.path.join(uc_dir, name)
+    with open(uc_fp, 'wt') as uc_file:
+        uc_file.write(records)
+    return uc_fp
+
+
+def test_otu_table_builder__uc():
+    with tempfile.TemporaryDirectory() as uc_dir:
+        builder = otu_table.OtuTableBuilder(otu_ids=['OTU_1', 'OTU_2', 'OTU_3'])
+        mapped, unmapped = builder.add_mapping_file(write_uc_file(uc_dir, 's1.uc'), sample_id='s1')
+        table = builder.build()
+
+    assert (mapped, unmapped) == (5, 1)
+    assert table.shape == (3, 1)
+    assert table.nnz == 2
+    assert table.get_sample_counts('s1') == {'OTU_1': 4, 'OTU_2': 1}
+
+
+def test_otu_table_builder__coalesce_chunks():
+    builder = otu_table.OtuTableBuilder(chunk_size=3)
+    for _ in range(10):
+        builder.add('OTU_1', 's1')
+        builder.add('OTU_2', 's2', count=2)
+    table = builder.build()
+
+    assert table.nnz == 2
+    assert table.get_sample_counts('s1') == {'OTU_1': 10}
+    assert table.get_sample_counts('s2') == {'OTU_2': 20}
+
+
+def test_read_mapping_records__label_sample():
+    with tempfile.TemporaryDirectory() as uc_dir:
+        uc_fp = write_uc_file(
+            uc_dir, 'mixed.uc',
+            'H\t0\t250\t100.0\t+\t0\t0\t250M\tread_1;sample=abc;\tOTU_1\n'
+            'H\t0\t250\t100.0\t+\t0\t0\t250M\tR3-16S-mockE-1__HWI\tOTU_1\n')
+        builder = otu_table.OtuTableBuilder()
+        builder.add_mapping_file(uc_fp)
+        table = builder.build()
+
+    assert table.sample_ids == ['abc', 'R3']
+
+
+def test_read_mapping_records__uparse():
+    with tempfile.TemporaryDirectory() as uparse_dir:
+        uparse_fp = write_uc_file(
+            uparse_dir, 'otus.up',
+            'read_1;size=2\tOTU\t*\t*\t*\n'
+            '\n'
+            'read_2;size=2\tmatch\t0.0\t97.5\tread_1;size=2\n'
+            'read_3;size=1\tchimera\t*\t*\t*\n'
+            '\n')
+        records = list(otu_table.read_mapping_records(uparse_fp, fmt='uparse'))
+
+    assert records == [
+        ('read_1;size=2', 'read_1;size=2'), ('read_2;size=2', 'read_1;size=2'), ('read_3;size=1', None)]
+
+
+def test_merge_otu_tables():
+    table_1 = otu_table.OtuTable.from_coo(['OTU_1', 'OTU_2'], ['s1'], rows=[0, 1], cols=[0, 0], data=[1, 2])
+    table_2 = otu_table.OtuTable.from_coo(['OTU_2', 'OTU_3'], ['s2'], rows=[0, 1], cols=[0, 0], data=[5, 7])
+
+    merged = otu_table.merge_otu_tables([table_1, table_2])
+
+    assert merged.otu_ids == ['OTU_1', 'OTU_2', 'OTU_3']
+    assert merged.sample_ids == ['s1', 's2']
+    assert merged.get_sample_counts('s2') == {'OTU_2': 5, 'OTU_3': 7}
+    assert list(merged.sample_totals()) == [3, 12]
+
+
+def test_split_samples():
+    table = otu_table.OtuTable.from_coo(
+        ['OTU_1', 'OTU_2', 'OTU_3'], ['s1', 's2', 's3'], rows=[0, 2, 2], cols=[1, 0, 1], data=[4, 1, 9])
+
+    sample_tables = list(table.split_samples())
+
+    assert [t.sample_ids for t in sample_tables] == [['s1'], ['s2'], ['s3']]
+    # only the OTUs seen in each sample
+    assert [t.otu_ids for t in sample_tables] == [['OTU_3'], ['OTU_1', 'OTU_3'], []]
+    assert sample_tables[1].get_sample_counts('s2') == {'OTU_1': 4, 'OTU_3': 9}
+    assert sample_tables[2].nnz == 0
+
+
+def test_write_read_round_trip():
+    table = otu_table.OtuTable.from_coo(
+        ['OTU_1', 'OTU_2', 'OTU_3'], ['s1', 's2'], rows=[0, 2, 2], cols=[1, 0, 1], data=[4, 1, 9])
+    with tempfile.TemporaryDirectory() as table_dir:
+        for file_name in ('table.biom.json', 'table.npz', 'table.otutab.txt'):
+            table_fp = os.path.join(table_dir, file_name)
+            otu_table.write_otu_table(table, table_fp)
+            read_table = otu_table.read_otu_table(table_fp)
+
+            assert read_table.otu_ids == table.otu_ids
+            assert read_table.sample_ids == table.sample_ids
+            assert np.array_equal(read_table.indptr, table.indptr)
+            assert np.array_equal(read_table.indices, table.indices)
+            assert np.array_equal(read_table.data, table.data)
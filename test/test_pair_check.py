@@ -0,0 +1,58 @@
+import gzip
+import os
+import tempfile
+
+import pytest
+
+import cluster_16S.pair_check as pair_check
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.seqio import format_fastq_record, read_fastq_batches
+
+
+def get_fastq_records(names, read_number):
+    return b''.join(format_fastq_record(name + b' %d:N:0' % read_number, b'ACGT', b'IIII') for name in names)
+
+
+def write_pair(input_dir, forward_names, reverse_names, sample_name=b's1'):
+    for read_number, names in ((1, forward_names), (2, reverse_names)):
+        with gzip.open(os.path.join(input_dir, '%s_R%d_001.fastq.gz' % (sample_name.decode(), read_number)), 'wb') \
+                as fastq_file:
+            fastq_file.write(get_fastq_records(names, read_number))
+
+
+def test_get_pair_names():
+    assert pair_check.get_pair_names([b'M:1:2 1:N:0', b'M:1:3/1', b'M:1:4/2 x', b'M:1:5\tx', b'M:1:6']) == \
+        b'M:1:2\nM:1:3\nM:1:4\nM:1:5\nM:1:6\n'
+
+
+def test_check_pairs():
+    names = [b'read_%d' % i for i in range(10)]
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+        write_pair(input_dir, names, names, sample_name=b's1')
+        write_pair(input_dir, names, names[:-1], sample_name=b's2')
+        write_pair(input_dir, names, names[1:] + names[:1], sample_name=b's3')
+        for fastq_name in sorted(os.listdir(input_dir)):
+            fastq_fp = os.path.join(input_dir, fastq_name)
+            pair_check_collector = pair_check.PairCheckCollector()
+            # several batches
+            for batch in read_fastq_batches(fastq_fp, batch_size=64):
+                pair_check_collector.add_fastq_batch(batch)
+            pair_check.write_pair_check(pair_check_collector, output_dir=output_dir, fastq_fp=fastq_fp)
+
+        pair_checks = pair_check.read_pair_checks(output_dir)
+        assert pair_checks['s1_R1_001.fastq.gz']['read_count'] == 10
+        assert pair_checks['s1_R1_001.fastq.gz']['name_digest'] == pair_checks['s1_R2_001.fastq.gz']['name_digest']
+        assert pair_checks['s1_R1_001.fastq.gz']['mean_length'] == 4
+
+        with pytest.raises(PipelineException) as e:
+            pair_check.check_pairs(output_dir)
+        message = str(e.value)
+        assert 's1_' not in message
+        assert '"s2_R1_001.fastq.gz" has 10 reads but "s2_R2_001.fastq.gz" has 9' in message
+        assert 'the read names of "s3_R1_001.fastq.gz" and "s3_R2_001.fastq.gz" are out of step' in message
+
+        os.remove(os.path.join(output_dir, pair_check.PAIR_CHECK_DIR_NAME, 's2_R2_001.fastq.gz.json'))
+        os.remove(os.path.join(output_dir, pair_check.PAIR_CHECK_DIR_NAME, 's3_R2_001.fastq.gz.json'))
+        with pytest.raises(PipelineException, match='has no reverse read file'):
+            pair_check.check_pairs(output_dir)
+
@@ -1,17 +1,27 @@
 import gzip
+import json
 import logging
 import os.path
+import shutil
+import sys
 import tempfile
 
 import pytest
 
 import cluster_16S.pipeline as pipeline
+import cluster_16S.compact_reads
+import cluster_16S.pair_check
 import cluster_16S.pipeline_util
+import cluster_16S.planner
+import cluster_16S.scheduler
+import cluster_16S.seqio
+import cluster_16S.step_archive
+import cluster_16S.trace
 
 logging.basicConfig(level=logging.DEBUG)
 
 
-def get_pipeline(work_dir='/work_dir'):
+def get_pipeline(work_dir='/work_dir', **kwargs):
     return pipeline.Pipeline(
         work_dir=work_dir, core_count=1,
         cutadapt_min_length=10,
@@ -19,7 +29,8 @@ def get_pipeline(work_dir='/work_dir'):
         forward_primer='ATTAGAWACCCVNGTAGTCC', reverse_primer='TTACCGCGGCKGCTGGCAC',
         pear_min_overlap=1, pear_max_assembly_length=270, pear_min_assembly_length=0,
         vsearch_derep_minuniquesize=3,
-        uchime_ref_db_fp='')
+        uchime_ref_db_fp='',
+        **kwargs)
 
 
 def test_create_output_dir__input_dir(fs):
@@ -80,6 +91,101 @@ def test_step_01__compressed_input():
             assert output_2.read() == reverse_fastq_records
 
 
+def test_step_01__local_scratch():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir, \
+            tempfile.TemporaryDirectory() as local_scratch:
+
+        write_forward_reverse_read_files(input_dir=input_dir, suffix='.fastq', compress=False)
+        output_dir = get_pipeline(
+            work_dir=work_dir, local_scratch=local_scratch).step_01_copy_and_compress(input_dir=input_dir)
+
+        assert output_dir.startswith(local_scratch)
+        durable_output_dir = os.path.join(work_dir, 'step_01_copy_and_compress')
+        output_file_list = cluster_16S.pipeline_util.get_sorted_file_list(durable_output_dir)
+        assert [f.name for f in output_file_list] == ['input_file_01.fastq.gz', 'input_file_02.fastq.gz']
+        with gzip.open(output_file_list[0].path, 'rt') as output_1:
+            assert output_1.read() == forward_fastq_records
+
+        # a restarted pipeline finds the complete step in work_dir
+        restarted_output_dir = get_pipeline(
+            work_dir=work_dir, local_scratch=local_scratch).step_01_copy_and_compress(input_dir=input_dir)
+        assert restarted_output_dir == durable_output_dir
+
+
+def test_step_01__pair_check():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        write_forward_reverse_read_files(input_dir=input_dir, suffix='.fastq', compress=True)
+        output_dir = get_pipeline(work_dir=work_dir).step_01_copy_and_compress(input_dir=input_dir)
+        # compressed input is copied unchanged
+        for fastq_name in ('input_file_01.fastq.gz', 'input_file_02.fastq.gz'):
+            with open(os.path.join(input_dir, fastq_name), 'rb') as f, \
+                    open(os.path.join(output_dir, fastq_name), 'rb') as g:
+                assert f.read() == g.read()
+        assert sorted(cluster_16S.pair_check.read_pair_checks(output_dir)) == [
+            'input_file_01.fastq.gz', 'input_file_02.fastq.gz']
+
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        write_forward_reverse_read_files(input_dir=input_dir, suffix='.fastq', compress=True)
+        reverse_fp = os.path.join(input_dir, 'input_file_02.fastq.gz')
+        with open(reverse_fp, 'rb') as f:
+            compressed = f.read()
+        with open(reverse_fp, 'wb') as f:
+            f.write(compressed[:len(compressed) // 2])
+        with pytest.raises(cluster_16S.pipeline_util.PipelineException, match='truncated or corrupt'):
+            get_pipeline(work_dir=work_dir).step_01_copy_and_compress(input_dir=input_dir)
+
+
+def test_step_01__packed_outputs():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        write_forward_reverse_read_files(input_dir=input_dir, suffix='.fastq', compress=False)
+        output_dir = get_pipeline(work_dir=work_dir, packed_outputs=True).step_01_copy_and_compress(input_dir=input_dir)
+
+        output_file_list = cluster_16S.pipeline_util.get_sorted_file_list(output_dir)
+        assert [f.name for f in output_file_list] == ['outputs.pack']
+        forward_fps = cluster_16S.pipeline_util.get_forward_fastq_files(input_dir=output_dir)
+        assert forward_fps == [os.path.join(output_dir, 'input_file_01.fastq.gz')]
+        with cluster_16S.seqio.open_sequence_file(forward_fps[0]) as output_1:
+            assert output_1.read().decode() == forward_fastq_records
+        assert os.path.exists(os.path.join(output_dir, 'read_qc', 'input_file_02.fastq.gz.qc.json'))
+
+        # a restarted pipeline finds the complete step
+        restarted_output_dir = get_pipeline(
+            work_dir=work_dir, packed_outputs=True).step_01_copy_and_compress(input_dir=input_dir)
+        assert restarted_output_dir == output_dir
+
+
+def test_step_01__memory_record():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        write_forward_reverse_read_files(input_dir=input_dir, suffix='.fastq', compress=False)
+        test_pipeline = get_pipeline(work_dir=work_dir, memory_limit=2 ** 40, tracemalloc_top=5)
+        test_pipeline.input_description = cluster_16S.planner.describe_inputs(input_dir)
+        test_pipeline.step_01_copy_and_compress(input_dir=input_dir)
+
+        record, = cluster_16S.planner.read_step_metrics([work_dir])
+        assert record['step_peak_rss_bytes'] > 0
+        assert record['python_peak_bytes'] > 0
+        assert 0 < len(record['top_allocations']) <= 5
+
+
+def test_step_01__trace():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        write_forward_reverse_read_files(input_dir=input_dir, suffix='.fastq')
+        trace_fp = os.path.join(work_dir, 'trace.json')
+        for run_name in ('traced', 'untraced'):
+            os.mkdir(os.path.join(work_dir, run_name))
+        traced_pipeline = get_pipeline(work_dir=os.path.join(work_dir, 'traced'), trace_fp=trace_fp)
+        with traced_pipeline.tracing('run'):
+            traced_pipeline.step_01_copy_and_compress(input_dir=input_dir)
+        # a later run without a trace file, as in a batch or a daemon, is not traced
+        get_pipeline(work_dir=os.path.join(work_dir, 'untraced')).step_01_copy_and_compress(input_dir=input_dir)
+
+        with open(trace_fp, 'rt') as trace_file:
+            trace_events = json.load(trace_file)['traceEvents']
+        assert [e['args']['work_dir'] for e in trace_events if e['name'] == 'run'] == [traced_pipeline.work_dir]
+        assert len([e for e in trace_events if e['name'] == 'step_01_copy_and_compress']) == 1
+        assert not cluster_16S.trace.tracing_enabled()
+
+
 def test_step_02():
     with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
         write_forward_reverse_read_files(input_dir=input_dir, suffix='.fastq')
@@ -97,6 +203,33 @@ def test_step_02():
         assert output_file_list[2].name == 'log'
 
 
+def test_step_02__resume_after_failed_job(monkeypatch):
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        write_forward_reverse_read_files(input_dir=input_dir, suffix='.fastq')
+
+        monkeypatch.setenv('CUTADAPT', 'false')
+        with pytest.raises(cluster_16S.pipeline_util.PipelineException):
+            get_pipeline(work_dir=work_dir).step_02_remove_primers(input_dir=input_dir)
+        # the failed job left its log, which is not a completed step
+        assert 'log' in os.listdir(os.path.join(work_dir, 'step_02_remove_primers'))
+
+        # a cutadapt that copies its inputs
+        cutadapt_fp = os.path.join(work_dir, 'cutadapt')
+        with open(cutadapt_fp, 'wt') as cutadapt_file:
+            cutadapt_file.write(
+                '#!{}\n'
+                'import shutil, sys\n'
+                'shutil.copy(sys.argv[-2], sys.argv[sys.argv.index("-o") + 1])\n'
+                'shutil.copy(sys.argv[-1], sys.argv[sys.argv.index("-p") + 1])\n'.format(sys.executable))
+        os.chmod(cutadapt_fp, 0o755)
+        monkeypatch.setenv('CUTADAPT', cutadapt_fp)
+        output_dir = get_pipeline(work_dir=work_dir).step_02_remove_primers(input_dir=input_dir)
+
+        output_file_list = cluster_16S.pipeline_util.get_sorted_file_list(output_dir)
+        assert [output_file.name for output_file in output_file_list] == [
+            'input_file_trimmed_01.fastq.gz', 'input_file_trimmed_02.fastq.gz', 'log']
+
+
 def test_step_03_pear():
     with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
         write_forward_reverse_read_files(input_dir=input_dir, suffix='.fastq')
@@ -172,6 +305,48 @@ def test_step_05():
         assert output_file_list[0].name == 'input_file_01_02_trimmed_merged_V4.assembled.ee1trunc200.fastq.gz'
 
 
+def test_step_05__packed_input():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        sample_dir = os.path.join(input_dir, '.tmp.samples')
+        os.mkdir(sample_dir)
+        write_forward_reverse_read_files(
+            input_dir=sample_dir, suffix='_trimmed_merged_V4.assembled.ee1trunc200.fastq')
+        cluster_16S.step_archive.StepArchive(
+            cluster_16S.step_archive.get_archive_fp(input_dir)).add_sample_dir('samples', sample_dir)
+
+        output_dir = get_pipeline(work_dir=work_dir).step_05_combine_runs(input_dir=input_dir)
+
+        output_fp = os.path.join(output_dir, 'input_file_01_02_trimmed_merged_V4.assembled.ee1trunc200.fastq.gz')
+        with gzip.open(output_fp, 'rt') as output_file:
+            assert output_file.read() == forward_fastq_records + reverse_fastq_records
+
+
+def test_step_05__restore_compact_read_ids():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        for sample_name, fastq_records in (('sample_a', forward_fastq_records), ('sample_b', reverse_fastq_records)):
+            for direction in ('R1', 'R2'):
+                with open(os.path.join(input_dir, '{}_{}.fastq'.format(sample_name, direction)), 'wt') as input_file:
+                    input_file.write(fastq_records)
+        test_pipeline = get_pipeline(work_dir=work_dir, compact_read_ids=True)
+        step_01_output_dir = test_pipeline.step_01_copy_and_compress(input_dir=input_dir)
+
+        # the forward reads stand in for the merged and filtered reads of steps 03 and 04
+        step_04_output_dir = os.path.join(work_dir, 'step_04')
+        os.mkdir(step_04_output_dir)
+        for sample_name in ('sample_a', 'sample_b'):
+            shutil.copy(
+                os.path.join(step_01_output_dir, sample_name + '_R1.fastq.gz'),
+                os.path.join(step_04_output_dir, sample_name + '_R1.assembled.ee1trunc200.fastq.gz'))
+        step_05_output_dir = test_pipeline.step_05_combine_runs(input_dir=step_04_output_dir)
+
+        combined_fp = os.path.join(step_05_output_dir, 'sample_a_b_R1.assembled.ee1trunc200.fastq.gz')
+        restored_fp = os.path.join(work_dir, 'restored.fastq')
+        cluster_16S.compact_reads.restore_read_names(
+            combined_fp, os.path.join(step_01_output_dir, 'read_names'), restored_fp)
+        with open(restored_fp, 'rt') as restored_file:
+            assert restored_file.read() == forward_fastq_records + reverse_fastq_records
+
+
 def test_step_06():
     with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
         write_forward_reverse_read_files(input_dir=input_dir, suffix='_trimmed_merged_V4.assembled.ee1trunc200.fastq')
@@ -210,6 +385,42 @@ def test_step_07():
         assert output_file_list[4].name == 'log'
 
 
+def test_step_07__native_engine_holds_cores(monkeypatch):
+    job_scheduler = cluster_16S.scheduler.JobScheduler(core_count=3)
+    held_cores = []
+
+    def fake_cluster_otus(input_fp, otu_output_fp, uparse_output_fp, identity, threads):
+        held_cores.append(job_scheduler.command_runner.core_count - job_scheduler.command_runner._cores_available)
+        for output_fp in (otu_output_fp, uparse_output_fp):
+            with open(output_fp, 'wt'):
+                pass
+
+    monkeypatch.setattr(pipeline, 'cluster_otus', fake_cluster_otus)
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        with gzip.open(os.path.join(input_dir, 'input_file_01.fasta.gz'), 'wt') as input_file:
+            input_file.write('>1;size=3;\nACGT\n')
+        test_pipeline = get_pipeline(work_dir=work_dir, otu_clustering_engine='native', job_scheduler=job_scheduler)
+        output_dir = test_pipeline.step_07_cluster_97_percent(input_dir=input_dir)
+
+        assert sorted(os.listdir(output_dir)) == ['input_file_01.rad3.fasta', 'input_file_01.rad3.txt']
+    # the pipeline's one core is taken from the shared budget while clustering runs
+    assert held_cores == [1]
+
+
+def test_search_residual_uniques__otu_identity(monkeypatch):
+    with tempfile.TemporaryDirectory() as work_dir:
+        test_pipeline = get_pipeline(work_dir=work_dir, otu_identity=0.99)
+        jobs = []
+        monkeypatch.setattr(test_pipeline.job_scheduler, 'run', jobs.extend)
+        residual_fasta_fp = os.path.join(work_dir, 'residual.fasta')
+        with open(residual_fasta_fp, 'wt') as residual_fasta_file:
+            residual_fasta_file.write('>1;size=2;\nACGT\n')
+        test_pipeline.search_residual_uniques(
+            'otus.fasta', residual_fasta_fp, 'residual.uc', output_dir=work_dir, sample_dir=work_dir)
+    cmd_line_list = jobs[0].cmd_line_list
+    assert cmd_line_list[cmd_line_list.index('--id') + 1] == '0.99'
+
+
 @pytest.mark.skip()
 def test_step_08():
     with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
@@ -1,10 +1,17 @@
+import collections
+import gzip
+import logging
 import os
 import tempfile
 
 import pytest
 
+import cluster_16S.otu_table
 import cluster_16S.pipeline as pipeline
 import cluster_16S.pipeline_util
+from cluster_16S.seqio import read_fasta_records
+from cluster_16S.sequence_index import SequenceIndex
+import cluster_16S.uniques as uniques
 
 
 def test_create_output_dir():
@@ -61,3 +68,155 @@ def test_get_combined_file_name__2():
     ])
 
     assert combined_file_name == 'Mock_Run1_Run3_V4.assembled.fastq.gz'
+
+
+def get_pipeline(work_dir):
+    return pipeline.Pipeline(
+        work_dir=work_dir, core_count=1,
+        cutadapt_min_length=10,
+        vsearch_filter_maxee=1, vsearch_filter_trunclen=200,
+        forward_primer='ATTAGAWACCCVNGTAGTCC', reverse_primer='TTACCGCGGCKGCTGGCAC',
+        pear_min_overlap=1, pear_max_assembly_length=270, pear_min_assembly_length=0,
+        vsearch_derep_minuniquesize=3,
+        uchime_ref_db_fp='')
+
+
+def test_build_otu_table_and_unmapped_read_report():
+    with tempfile.TemporaryDirectory() as work_dir:
+        otus_fp = os.path.join(work_dir, 'otus.rad3.uchime.fasta')
+        with open(otus_fp, 'wt') as otus_file:
+            otus_file.write('>OTU_1\nACGT\n>OTU_2\nTTGA\n')
+        with open(os.path.join(work_dir, 'Mock_Run5_V4_merged.uchime.otutab.uc'), 'wt') as uc_file:
+            uc_file.write('H\t0\t4\t100.0\t+\t0\t0\t4M\tread_1\tOTU_2\n')
+            uc_file.write('N\t*\t4\t*\t*\t*\t*\t*\tread_2\t*\n')
+
+        p = get_pipeline(work_dir=work_dir)
+        log = logging.getLogger(name=__name__)
+        otu_table, read_counts = p.build_otu_table(
+            log=log,
+            otus_fp=otus_fp,
+            input_fps=['/step_03/Mock_Run5_V4_merged.assembled.fastq.gz'],
+            output_dir=work_dir)
+
+        assert otu_table.otu_ids == ['OTU_1', 'OTU_2']
+        assert otu_table.get_sample_counts('Mock_Run5_V4_merged') == {'OTU_2': 1}
+        assert read_counts == {'Mock_Run5_V4_merged': (1, 1)}
+
+        report_fp = os.path.join(work_dir, 'unmapped_reads.tsv')
+        p.write_unmapped_read_report(log=log, read_counts=read_counts, report_fp=report_fp)
+        with open(report_fp, 'rt') as report_file:
+            assert report_file.read().splitlines() == [
+                'sample\tmapped\tunmapped\tunmapped_fraction',
+                'Mock_Run5_V4_merged\t1\t1\t0.5000',
+                'total\t1\t1\t0.5000'
+            ]
+
+
+def test_build_otu_table_from_uniques():
+    with tempfile.TemporaryDirectory() as work_dir:
+        step_dirs = {}
+        for step_name in ('step_05_combine_runs', 'step_06_derep', 'step_07_cluster', 'step_09_otu_table'):
+            step_dirs[step_name] = os.path.join(work_dir, step_name)
+            os.mkdir(step_dirs[step_name])
+
+        unique_sequence_counter = uniques.UniqueSequenceCounter()
+        unique_sequence_counter.add_sample('Mock_Run1_V4', collections.Counter([b'ACGT', b'ACGT', b'ACGA']))
+        unique_sequence_counter.add_sample('Mock_Run3_V4', collections.Counter([b'TTGA', b'ACGA']))
+        uniques_fp_prefix = os.path.join(
+            step_dirs['step_05_combine_runs'], 'Mock_Run1_Run3_V4.assembled.ee1trunc200.uniques')
+        unique_sequence_counter.write_fasta(uniques_fp_prefix + '.fasta.gz')
+        cluster_16S.otu_table.write_otu_table_npz(unique_sequence_counter.get_table(), uniques_fp_prefix + '.npz')
+
+        # ACGA was clustered with the ACGT centroid, TTGA is a centroid
+        with gzip.open(os.path.join(step_dirs['step_06_derep'], 'combined.derepmin3.fasta.gz'), 'wt') as f:
+            f.write('>read_1;size=2\nACGT\n>read_2;size=2\nACGA\n>read_3;size=1\nTTGA\n')
+        with open(os.path.join(step_dirs['step_07_cluster'], 'combined.derepmin3.rad3.txt'), 'wt') as f:
+            f.write('read_1;size=2\tOTU\t*\t*\t*\n')
+            f.write('read_2;size=2\tmatch\t0.0\t97.5\tread_1;size=2\n')
+            f.write('read_3;size=1\tOTU\t*\t*\t*\n')
+        otus_fp = os.path.join(work_dir, 'otus.rad3.uchime.fasta')
+        with open(otus_fp, 'wt') as otus_file:
+            otus_file.write('>OTU_1\nACGT\n>OTU_2\nTTGA\n')
+
+        otu_table, read_counts = get_pipeline(work_dir=work_dir).build_otu_table_from_uniques(
+            log=logging.getLogger(name=__name__),
+            otus_fp=otus_fp,
+            uniques_fasta_fp=uniques_fp_prefix + '.fasta.gz',
+            output_dir=step_dirs['step_09_otu_table'],
+            sequence_index=SequenceIndex.from_fasta_records(read_fasta_records(otus_fp)))
+
+        assert otu_table.get_sample_counts('Mock_Run1_V4') == {'OTU_1': 3}
+        assert otu_table.get_sample_counts('Mock_Run3_V4') == {'OTU_1': 1, 'OTU_2': 1}
+        assert read_counts == {'Mock_Run1_V4': (3, 0), 'Mock_Run3_V4': (2, 0)}
+
+
+def test_write_otu_tables():
+    otu_table = cluster_16S.otu_table.OtuTable.from_coo(
+        ['OTU_1', 'OTU_2'], ['Mock_Run1_V4', 'Mock_Run3_V4'], rows=[0, 0, 1], cols=[0, 1, 1], data=[3, 1, 1])
+    with tempfile.TemporaryDirectory() as work_dir:
+        otu_table_fp_prefix = os.path.join(work_dir, 'Mock_Run1_Run3_V4.uchime.otutab.merged')
+        pipeline.write_otu_tables(otu_table, otu_table_fp_prefix)
+        pipeline.write_sample_otu_tables(otu_table, work_dir)
+
+        assert sorted(os.listdir(work_dir)) == [
+            'Mock_Run1_Run3_V4.uchime.otutab.merged.biom.json',
+            'Mock_Run1_Run3_V4.uchime.otutab.merged.npz',
+            'Mock_Run1_Run3_V4.uchime.otutab.merged.txt',
+            'Mock_Run1_V4.uchime.otutab.json',
+            'Mock_Run1_V4.uchime.otutab.txt',
+            'Mock_Run3_V4.uchime.otutab.json',
+            'Mock_Run3_V4.uchime.otutab.txt',
+        ]
+        with open(otu_table_fp_prefix + '.txt', 'rt') as otutab_file:
+            assert otutab_file.read().splitlines() == [
+                '#OTU ID\tMock_Run1_V4\tMock_Run3_V4', 'OTU_1\t3\t1', 'OTU_2\t0\t1']
+        for sample_fp in ('Mock_Run1_V4.uchime.otutab.txt', 'Mock_Run1_V4.uchime.otutab.json'):
+            sample_otu_table = cluster_16S.otu_table.read_otu_table(os.path.join(work_dir, sample_fp))
+            assert sample_otu_table.sample_ids == ['Mock_Run1_V4']
+            assert sample_otu_table.get_sample_counts('Mock_Run1_V4') == {'OTU_1': 3}
+
+
+def test_split_sequence_index_hits_and_grow_sequence_index():
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_fp = os.path.join(work_dir, 'Mock_Run5_V4_merged.assembled.fastq.gz')
+        with gzip.open(input_fp, 'wt') as input_file:
+            input_file.write('@r1\nACGT\n+\nIIII\n@r2\nACGT\n+\nIIII\n@r3\nTTTT\n+\nIIII\n@r4\nTTTT\n+\nIIII\n')
+        sequence_index = SequenceIndex()
+        sequence_index.add(b'ACGT', 'OTU_1')
+
+        index_hits_fp = os.path.join(work_dir, 'hits.tsv')
+        misses_fasta_fp = os.path.join(work_dir, 'misses.fasta')
+        pipeline.split_sequence_index_hits(
+            input_fp, sequence_index=sequence_index, index_hits_fp=index_hits_fp, misses_fasta_fp=misses_fasta_fp)
+
+        with open(index_hits_fp, 'rt') as index_hits_file:
+            assert index_hits_file.read() == 'OTU_1\t2\n'
+        (miss_label, miss_sequence), = read_fasta_records(misses_fasta_fp)
+        assert miss_sequence == b'TTTT'
+        assert miss_label.endswith(';size=2')
+
+        # vsearch assigns the miss to OTU_2
+        uc_fp = os.path.join(work_dir, 'misses.uc')
+        with open(uc_fp, 'wt') as uc_file:
+            uc_file.write('H\t1\t4\t100.0\t+\t0\t0\t4M\t{}\tOTU_2\n'.format(miss_label))
+        pipeline.grow_sequence_index(sequence_index, uc_fp=uc_fp)
+        assert sequence_index.get(b'TTTT') == 'OTU_2'
+
+
+def test_split_fasta_file_and_concatenate_files():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fasta_fp = os.path.join(work_dir, 'otus.fasta')
+        with open(fasta_fp, 'wt') as fasta_file:
+            for i in range(1, 8):
+                fasta_file.write('>OTU_{}\nACGT\nAC\n'.format(i))
+        assert cluster_16S.pipeline_util.count_fasta_records(fasta_fp) == 7
+
+        shard_fps = [os.path.join(work_dir, 'shard_{}.fasta'.format(i)) for i in range(3)]
+        shard_starts = cluster_16S.pipeline_util.split_fasta_file(fasta_fp, shard_fps)
+        assert shard_starts == [0, 2, 4, 7]
+        assert [cluster_16S.pipeline_util.count_fasta_records(fp) for fp in shard_fps] == [2, 2, 3]
+
+        joined_fp = os.path.join(work_dir, 'joined.fasta')
+        cluster_16S.pipeline_util.concatenate_files(shard_fps, joined_fp)
+        with open(fasta_fp, 'rb') as fasta_file, open(joined_fp, 'rb') as joined_file:
+            assert fasta_file.read() == joined_file.read()
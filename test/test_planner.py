@@ -0,0 +1,122 @@
+import gzip
+import os
+import tempfile
+
+import cluster_16S.planner as planner
+from cluster_16S.seqio import format_fastq_record
+
+
+def write_fastq(fp, read_count, read_length=100):
+    records = b''.join(
+        format_fastq_record(b'read_%d' % i, b'ACGT' * (read_length // 4), b'I' * read_length)
+        for i in range(read_count))
+    with (gzip.open(fp, 'wb') if fp.endswith('.gz') else open(fp, 'wb')) as f:
+        f.write(records)
+
+
+def test_estimate_fastq_file():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fastq_fp = os.path.join(work_dir, 'reads.fastq')
+        write_fastq(fastq_fp, read_count=50000)
+        read_count, sampled_length, sampled_read_count = planner.estimate_fastq_file(fastq_fp, sample_size=100000)
+        # read names get longer further into the file
+        assert abs(read_count - 50000) < 0.02 * 50000
+        assert sampled_length == 100 * sampled_read_count
+
+        # a small file is read completely
+        fastq_gz_fp = os.path.join(work_dir, 'reads.fastq.gz')
+        write_fastq(fastq_gz_fp, read_count=10)
+        assert planner.estimate_fastq_file(fastq_gz_fp) == (10, 1000, 10)
+
+
+def test_describe_inputs():
+    with tempfile.TemporaryDirectory() as input_dir:
+        for sample in ('a', 'b'):
+            write_fastq(os.path.join(input_dir, '{}_R1_001.fastq.gz'.format(sample)), read_count=10)
+            write_fastq(os.path.join(input_dir, '{}_R2_001.fastq.gz'.format(sample)), read_count=10)
+        input_description = planner.describe_inputs(input_dir)
+        assert input_description['sample_count'] == 2
+        assert input_description['file_count'] == 4
+        assert input_description['read_count'] == 40
+        assert input_description['bases'] == 4000
+
+
+def get_record(step, bases, sample_count, core_count, cpu_seconds, wall_seconds):
+    return {
+        'step': step, 'core_count': core_count,
+        'cpu_seconds': cpu_seconds, 'wall_seconds': wall_seconds,
+        'peak_rss_bytes': 1000 + bases, 'output_bytes': 2 * bases,
+        'inputs': {'bases': bases, 'sample_count': sample_count},
+    }
+
+
+def test_step_model():
+    # cpu time is 1 second per 1000 bases, half of it runs in parallel
+    records = [
+        get_record('step_02', bases=1000, sample_count=2, core_count=1, cpu_seconds=1.0, wall_seconds=1.0),
+        get_record('step_02', bases=4000, sample_count=4, core_count=2, cpu_seconds=4.0, wall_seconds=3.0),
+        get_record('step_02', bases=8000, sample_count=4, core_count=4, cpu_seconds=8.0, wall_seconds=5.0),
+    ]
+    step_model, = planner.fit_step_models(records).values()
+    assert abs(step_model.parallel_fraction - 0.5) < 1e-6
+
+    prediction = step_model.predict({'bases': 6000, 'sample_count': 4}, core_count=4)
+    assert abs(prediction['cpu_seconds'] - 6.0) < 1e-6
+    assert abs(prediction['wall_seconds'] - 3.75) < 1e-6
+    assert abs(prediction['output_bytes'] - 12000) < 1e-3
+
+
+def test_step_model__step_peak_rss():
+    # the lifetime peak only grows, the model follows the peak of the step itself
+    records = [
+        dict(get_record('step_02', bases=bases, sample_count=1, core_count=1, cpu_seconds=1.0, wall_seconds=1.0),
+             peak_rss_bytes=10 ** 9, step_peak_rss_bytes=1000 + bases)
+        for bases in (1000, 2000, 4000)
+    ]
+    # older records have no step peak
+    records.append(get_record('step_02', bases=3000, sample_count=1, core_count=1, cpu_seconds=1.0, wall_seconds=1.0))
+    step_model, = planner.fit_step_models(records).values()
+
+    prediction = step_model.predict({'bases': 6000, 'sample_count': 1}, core_count=1)
+    assert abs(prediction['peak_rss_bytes'] - 7000) < 1e-3
+
+
+def test_step_meter():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+        step_meter = planner.StepMeter('step_02', input_dir=input_dir)
+        # the input directory is measured when the record is made
+        write_fastq(os.path.join(input_dir, 'a_R1_001.fastq'), read_count=10)
+        record = step_meter.get_record(output_dir=output_dir, core_count=1, input_description={})
+        assert record['step_input_bytes'] == os.path.getsize(os.path.join(input_dir, 'a_R1_001.fastq'))
+        assert planner.StepMeter('step_01').get_record(
+            output_dir=output_dir, core_count=1, input_description={})['step_input_bytes'] is None
+
+
+def test_plan_run():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        write_fastq(os.path.join(input_dir, 'a_R1_001.fastq.gz'), read_count=10)
+        write_fastq(os.path.join(input_dir, 'a_R2_001.fastq.gz'), read_count=10)
+
+        plan = planner.plan_run(input_dir, core_count=4, history=[work_dir])
+        assert plan['steps'] == []
+        assert plan['recommended_core_count'] == 1
+        assert 'no step metrics' in planner.format_plan(plan)
+
+        for record in (
+                get_record('step_01', bases=1000, sample_count=1, core_count=1, cpu_seconds=10.0, wall_seconds=10.0),
+                get_record('step_01', bases=2000, sample_count=1, core_count=4, cpu_seconds=20.0, wall_seconds=5.0)):
+            planner.record_step_metrics(work_dir, record)
+
+        plan = planner.plan_run(input_dir, core_count=4, history=[work_dir], node_core_count=8, max_run_seconds=3)
+        step, = plan['steps']
+        assert abs(step['cpu_seconds'] - 20.0) < 1e-6
+        assert abs(step['wall_seconds'] - 5.0) < 1e-6
+        # all of step_01 runs in parallel
+        assert plan['recommended_core_count'] == 8
+        assert plan['recommended_node_count'] == 1
+        assert 'step_01' in planner.format_plan(plan)
+
+
+def test_format_and_parse_duration():
+    assert planner.parse_duration('12:00:00') == 12 * 3600
+    assert planner.format_duration(3661.2) == '1:01:02'
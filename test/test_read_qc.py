@@ -0,0 +1,66 @@
+import gzip
+import json
+import os
+import tempfile
+
+import cluster_16S.read_qc as read_qc
+
+
+fastq_records = b"""\
+@read_1
+ACGTN
++
+IIII#
+@read_2
+ACGT
++
+5555
+@read_3
+ACGTN
++
+IIII#
+"""
+
+
+def test_read_qc_collector():
+    read_qc_collector = read_qc.ReadQcCollector()
+    lines = fastq_records.splitlines()
+    read_qc_collector.add_batch(sequences=lines[1:4:4], qualities=lines[3:4:4])
+    read_qc_collector.add_batch(sequences=lines[5::4], qualities=lines[7::4])
+    summary = read_qc_collector.summary()
+
+    assert summary['read_count'] == 3
+    assert summary['base_count'] == 14
+    assert summary['length_distribution'] == {'4': 1, '5': 2}
+    assert summary['n_fraction'] == round(2 / 14, 6)
+
+    per_position = summary['per_position']
+    assert per_position['read_count'] == [3, 3, 3, 3, 2]
+    # 'I' is 40, '5' is 20 and '#' is 2
+    assert per_position['quality_quantiles']['50'] == [40, 40, 40, 40, 2]
+    assert per_position['quality_quantiles']['10'] == [20, 20, 20, 20, 2]
+    assert per_position['mean_quality'][0] == round(100 / 3, 2)
+    assert per_position['base_fraction']['A'][0] == 1.0
+    assert per_position['base_fraction']['N'][4] == 1.0
+
+    # read_1 and read_3 are duplicates
+    assert summary['duplication']['deduplicated_fraction'] == round(2 / 3, 4)
+    assert summary['duplication']['levels']['1'] == round(1 / 3, 4)
+    assert summary['duplication']['levels']['2'] == round(2 / 3, 4)
+
+
+def test_collect_and_write_read_qc():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fastq_fp = os.path.join(work_dir, 'sample.fastq.gz')
+        with gzip.open(fastq_fp, 'wb') as fastq_file:
+            fastq_file.write(fastq_records)
+
+        read_qc_collector = read_qc.collect_read_qc(fastq_fp)
+        qc_json_fp = read_qc.write_read_qc(read_qc_collector, fastq_fp, qc_output_dir=work_dir, write_html=True)
+
+        assert qc_json_fp == os.path.join(work_dir, 'sample.fastq.gz.qc.json')
+        with open(qc_json_fp, 'rt') as qc_json_file:
+            summary = json.load(qc_json_file)
+        assert summary['file'] == 'sample.fastq.gz'
+        assert summary['read_count'] == 3
+        assert os.path.exists(os.path.join(work_dir, 'sample.fastq.gz.qc.html'))
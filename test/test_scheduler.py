@@ -0,0 +1,123 @@
+import functools
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import cluster_16S.scheduler as scheduler
+
+
+MB = 1024 * 1024
+
+
+def test_get_thread_count():
+    # single-threaded tools always get one thread
+    assert scheduler.get_thread_count('usearch_cluster_otus', input_size=1000 * MB, core_count=16) == 1
+    # small inputs get few threads, large inputs more, never more than the profile allows
+    assert scheduler.get_thread_count('pear', input_size=1 * MB, core_count=16) == 1
+    assert scheduler.get_thread_count('pear', input_size=40 * MB, core_count=16) == 3
+    assert scheduler.get_thread_count('pear', input_size=10000 * MB, core_count=16) == 16
+    assert scheduler.get_thread_count('vsearch_uchime_ref', input_size=10000 * MB, core_count=16) == 4
+    # never more than the core count
+    assert scheduler.get_thread_count('pear', input_size=10000 * MB, core_count=2) == 2
+
+
+def test_plan():
+    job_scheduler = scheduler.JobScheduler(core_count=8)
+    jobs = [
+        scheduler.Job(name='small', tool='pear', cmd_line_list=['pear'], threads_option='-j',
+                      input_size=1 * MB, log_file=''),
+        scheduler.Job(name='large', tool='pear', cmd_line_list=['pear'], threads_option='-j',
+                      input_size=100 * MB, log_file=''),
+        scheduler.Job(name='otus', tool='usearch_cluster_otus', cmd_line_list=['usearch'], log_file=''),
+    ]
+    planned_jobs = job_scheduler.plan(jobs)
+
+    assert [job.name for job in planned_jobs] == ['large', 'small', 'otus']
+    assert [job.thread_count for job in planned_jobs] == [7, 2, 1]
+    assert planned_jobs[0].get_cmd_line_list() == ['pear', '-j', '7']
+    assert planned_jobs[2].get_cmd_line_list() == ['usearch']
+
+
+def run_timed_command(timing_fp, seconds):
+    # a command that writes the time it started and stopped to timing_fp
+    return [
+        sys.executable, '-c',
+        'import sys, time; start = time.time(); time.sleep(float(sys.argv[2])); '
+        'open(sys.argv[1], "w").write("{} {}".format(start, time.time()))',
+        timing_fp, str(seconds)]
+
+
+def read_timing(timing_fp):
+    with open(timing_fp) as f:
+        return tuple(float(t) for t in f.read().split())
+
+
+def test_run__core_budget():
+    core_count = 3
+    with tempfile.TemporaryDirectory() as log_dir:
+        jobs = []
+        for i in range(6):
+            jobs.append(scheduler.Job(
+                name='job_{}'.format(i), tool='pear',
+                cmd_line_list=run_timed_command(os.path.join(log_dir, 'job_{}'.format(i)), 0.05),
+                input_size=(i + 1) * 16 * MB, log_file=os.path.join(log_dir, 'log')))
+
+        scheduler.JobScheduler(core_count=core_count).run(jobs)
+        timings = [read_timing(os.path.join(log_dir, job.name)) + (job.thread_count, ) for job in jobs]
+
+    # the cores in use when each command started
+    max_active_cores = max(
+        sum(thread_count for start, stop, thread_count in timings if start <= t < stop)
+        for t, _, _ in timings)
+    assert 0 < max_active_cores <= core_count
+
+
+def test_run__prefetch():
+    # one core: the next job is staged and the previous one finished while a command runs
+    events = []
+    lock = threading.Lock()
+
+    def record(event, seconds=0.0):
+        time.sleep(seconds)
+        with lock:
+            events.append((event, time.time()))
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        jobs = []
+        for i in range(3):
+            jobs.append(scheduler.Job(
+                name='job_{}'.format(i), tool='cutadapt',
+                cmd_line_list=run_timed_command(os.path.join(log_dir, 'job_{}'.format(i)), 0.5),
+                input_size=(3 - i) * MB, log_file=os.path.join(log_dir, 'log'),
+                prepare=functools.partial(record, 'prepare_{}'.format(i)),
+                finish=functools.partial(record, 'finish_{}'.format(i), seconds=0.2)))
+
+        scheduler.JobScheduler(core_count=1, prefetch_depth=1).run(jobs)
+        timings = [read_timing(os.path.join(log_dir, job.name)) for job in jobs]
+
+    event_times = dict(events)
+    # commands do not overlap on one core
+    assert timings[0][1] <= timings[1][0] and timings[1][1] <= timings[2][0]
+    # job 1 was staged while job 0 ran, and job 0 was finished while job 1 ran
+    assert event_times['prepare_1'] < timings[0][1]
+    assert timings[1][0] < event_times['finish_0'] < timings[1][1]
+    # with a depth of one, job 2 was only staged once job 1 had taken the core
+    assert event_times['prepare_2'] >= timings[0][1]
+
+
+def test_prefetch_depth():
+    # the staging and finishing threads do not grow with the core count
+    assert scheduler.JobScheduler(core_count=64).prefetcher.depth == 2
+    assert scheduler.JobScheduler(core_count=64, prefetch_depth=4).prefetcher.depth == 4
+
+
+def test_call_after_all():
+    calls = []
+    finish = scheduler.call_after_all(3, lambda: calls.append('joined'))
+    finish()
+    finish()
+    assert calls == []
+    finish()
+    assert calls == ['joined']
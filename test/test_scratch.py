@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+import cluster_16S.scratch as scratch
+
+
+def test_sync_dir():
+    with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as dst_parent_dir:
+        dst_dir = os.path.join(dst_parent_dir, 'step')
+        os.mkdir(os.path.join(src_dir, 'read_qc'))
+        for fp in ('a.fastq.gz', 'read_qc/a.fastq.gz.qc.json', '.tmp.b/b.fastq.gz'):
+            os.makedirs(os.path.dirname(os.path.join(src_dir, fp)), exist_ok=True)
+            with open(os.path.join(src_dir, fp), 'wt') as f:
+                f.write(fp)
+
+        assert scratch.sync_dir(src_dir, dst_dir) == 2
+        assert sorted(os.listdir(dst_dir)) == ['a.fastq.gz', 'read_qc']
+        assert os.listdir(os.path.join(dst_dir, 'read_qc')) == ['a.fastq.gz.qc.json']
+
+        # unchanged files are not copied again
+        assert scratch.sync_dir(src_dir, dst_dir) == 0
+        with open(os.path.join(src_dir, 'a.fastq.gz'), 'wt') as f:
+            f.write('changed')
+        assert scratch.sync_dir(src_dir, dst_dir) == 1
+        with open(os.path.join(dst_dir, 'a.fastq.gz'), 'rt') as f:
+            assert f.read() == 'changed'
+
+
+def test_get_local_scratch_dir():
+    with tempfile.TemporaryDirectory() as local_scratch:
+        local_scratch_dir_1 = scratch.get_local_scratch_dir(local_scratch, work_dir='/work/project_1')
+        local_scratch_dir_2 = scratch.get_local_scratch_dir(local_scratch, work_dir='/work/project_2')
+        assert local_scratch_dir_1 != local_scratch_dir_2
+        assert os.path.isdir(local_scratch_dir_1)
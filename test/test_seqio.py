@@ -0,0 +1,82 @@
+import gzip
+import os
+import tempfile
+
+import pytest
+
+from cluster_16S.pipeline_util import PipelineException
+import cluster_16S.seqio as seqio
+
+
+fastq_records = b''.join(
+    seqio.format_fastq_record(b'read_%d' % i, b'ACGT' * (i + 1), b'I' * 4 * (i + 1))
+    for i in range(20))
+
+
+def test_read_fastq_batches():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fastq_fp = os.path.join(work_dir, 'reads.fastq.gz')
+        with seqio.open_sequence_file(fastq_fp, 'wb') as fastq_file:
+            fastq_file.write(fastq_records)
+
+        # small batches so records are split across reads of the file
+        batches = list(seqio.read_fastq_batches(fastq_fp, batch_size=50))
+        assert len(batches) > 1
+        assert b''.join(bytes(batch.raw()) for batch in batches) == fastq_records
+        assert [header for batch in batches for header in batch.headers()] == [b'read_%d' % i for i in range(20)]
+        assert [sequence for batch in batches for sequence in batch.sequences()][3] == b'ACGT' * 4
+        assert sum(len(batch) for batch in batches) == 20
+
+        batch, = seqio.read_fastq_batches(fastq_fp)
+        assert batch.sequence_lengths().tolist() == [4 * (i + 1) for i in range(20)]
+        assert batch.select([1]) == seqio.format_fastq_record(b'read_1', b'ACGTACGT', b'IIIIIIII')
+
+
+def test_read_fastq_batches__crlf_and_missing_newline():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fastq_fp = os.path.join(work_dir, 'reads.fastq')
+        with open(fastq_fp, 'wb') as fastq_file:
+            fastq_file.write(b'@read_1\r\nACG\r\n+\r\nIII\r\n@read_2\nTT\n+\nII')
+
+        batches = list(seqio.read_fastq_batches(fastq_fp))
+        assert [header for batch in batches for header in batch.headers()] == [b'read_1', b'read_2']
+        assert [sequence for batch in batches for sequence in batch.sequences()] == [b'ACG', b'TT']
+        assert [quality for batch in batches for quality in batch.qualities()] == [b'III', b'II']
+
+
+def test_read_fastq_batches__malformed():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fastq_fp = os.path.join(work_dir, 'reads.fastq')
+        with open(fastq_fp, 'wb') as fastq_file:
+            fastq_file.write(b'@read_1\nACGT\n+\nIII\n')
+        with pytest.raises(PipelineException):
+            list(seqio.read_fastq_batches(fastq_fp))
+
+        with open(fastq_fp, 'wb') as fastq_file:
+            fastq_file.write(b'@read_1\nACGT\n+\nIIII\n@read_2\nACGT\n')
+        with pytest.raises(PipelineException):
+            list(seqio.read_fastq_batches(fastq_fp))
+
+
+def test_read_fasta_records():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fasta_fp = os.path.join(work_dir, 'otus.fasta.gz')
+        with gzip.open(fasta_fp, 'wt') as fasta_file:
+            fasta_file.write('>OTU_1;size=3;\nacgt\nACG\n>OTU_2\nTT\n>OTU_3\n')
+        assert list(seqio.read_fasta_records(fasta_fp)) == [
+            ('OTU_1;size=3;', b'ACGTACG'), ('OTU_2', b'TT'), ('OTU_3', b'')]
+
+        # small batches so records are split across reads of the file
+        batches = list(seqio.read_fasta_batches(fasta_fp, batch_size=8))
+        assert [label for batch in batches for label in batch.labels()] == ['OTU_1;size=3;', 'OTU_2', 'OTU_3']
+        with gzip.open(fasta_fp, 'rb') as fasta_file:
+            assert b''.join(bytes(batch.raw()) for batch in batches) == fasta_file.read()
+
+
+def test_read_fasta_records__no_header():
+    with tempfile.TemporaryDirectory() as work_dir:
+        fasta_fp = os.path.join(work_dir, 'otus.fasta')
+        with open(fasta_fp, 'wb') as fasta_file:
+            fasta_file.write(b'ACGT\n>OTU_1\nACGT\n')
+        with pytest.raises(PipelineException):
+            list(seqio.read_fasta_records(fasta_fp))
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+from cluster_16S.pipeline_util import PipelineException
+from cluster_16S.sequence_index import SequenceIndex, get_sequence_digest
+
+
+def test_sequence_index():
+    sequence_index = SequenceIndex.from_fasta_records([('OTU_1;size=5;', b'ACGT'), ('OTU_2', b'TTGA')])
+    sequence_index.add(b'ACGA', 'OTU_1')
+    # the first assignment is kept
+    sequence_index.add(b'ACGA', 'OTU_2')
+
+    assert len(sequence_index) == 3
+    assert sequence_index.get(b'ACGT') == 'OTU_1'
+    assert sequence_index.get(b'ACGA') == 'OTU_1'
+    assert sequence_index.get(b'TTGA') == 'OTU_2'
+    assert sequence_index.get(b'GGGG') is None
+
+
+def test_sequence_index__save_load():
+    sequence_index = SequenceIndex.from_fasta_records([('OTU_1', b'ACGT'), ('OTU_2', b'TTGA')])
+    sequence_index.add(b'ACGA', 'OTU_2')
+    with tempfile.TemporaryDirectory() as work_dir:
+        index_fp = os.path.join(work_dir, 'otus.sequence_index.npz')
+        sequence_index.save(index_fp)
+        loaded_sequence_index = SequenceIndex.load(index_fp)
+
+    assert len(loaded_sequence_index) == 3
+    assert loaded_sequence_index.get(b'ACGA') == 'OTU_2'
+    assert loaded_sequence_index.get(b'ACGT') == 'OTU_1'
+    loaded_sequence_index.check_otu_ids(['OTU_1', 'OTU_2', 'OTU_3'])
+    with pytest.raises(PipelineException):
+        loaded_sequence_index.check_otu_ids(['OTU_1'])
+
+
+def test_sequence_index__concurrent_growth():
+    # the finish() of several mapping jobs grows one index at the same time
+    sequence_index = SequenceIndex(otu_ids=['OTU_0'])
+
+    def grow(job):
+        for i in range(200):
+            sequence_index.add_digests(
+                [(get_sequence_digest(b'%d_%d' % (job, i)), 'OTU_{}'.format(i % 50))])
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=grow, args=(job, )) for job in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    assert len(sequence_index) == 8 * 200
+    assert sorted(sequence_index.otu_ids) == sorted('OTU_{}'.format(i) for i in range(50))
+    assert sequence_index.get(b'3_120') == 'OTU_20'
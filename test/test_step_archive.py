@@ -0,0 +1,86 @@
+import gzip
+import os
+import tempfile
+
+import pytest
+
+import cluster_16S.step_archive as step_archive
+from cluster_16S.seqio import open_sequence_file
+
+
+def write_sample_dir(parent_dir, sample_name, files):
+    sample_dir = os.path.join(parent_dir, '.tmp.' + sample_name)
+    os.makedirs(sample_dir, exist_ok=True)
+    for name, data in files.items():
+        with open(os.path.join(sample_dir, name), 'wb') as f:
+            f.write(data)
+    return sample_dir
+
+
+def test_add_sample_dir():
+    with tempfile.TemporaryDirectory() as step_dir:
+        archive = step_archive.StepArchive(step_archive.get_archive_fp(step_dir))
+        sample_dir = write_sample_dir(step_dir, 's1', {'s1.fastq': b'@r1\nACGT\n+\nIIII\n', 's1.txt': b''})
+        os.mkdir(os.path.join(sample_dir, 'pair_check'))
+        assert archive.add_sample_dir('s1', sample_dir) == ['s1.fastq', 's1.txt']
+        # packed files are removed, subdirectories are left
+        assert os.listdir(sample_dir) == ['pair_check']
+        archive.add_sample_dir('s2', write_sample_dir(step_dir, 's2', {'s2.fastq': b'@r2\nA\n+\nI\n'}))
+
+        # a new reader finds the same members
+        reread_archive = step_archive.StepArchive(archive.fp)
+        assert reread_archive.get_names() == ['s1.fastq', 's1.txt', 's2.fastq']
+        assert reread_archive.get_names(sample='s2') == ['s2.fastq']
+        with reread_archive.open_member('s1.fastq') as member_file:
+            assert member_file.read() == b'@r1\nACGT\n+\nIIII\n'
+        with reread_archive.open_member('s1.txt') as member_file:
+            assert member_file.read() == b''
+        with pytest.raises(FileNotFoundError):
+            reread_archive.open_member('s3.fastq')
+
+
+def test_add_sample_dir__crash():
+    with tempfile.TemporaryDirectory() as step_dir:
+        archive = step_archive.StepArchive(step_archive.get_archive_fp(step_dir))
+        archive.add_sample_dir('s1', write_sample_dir(step_dir, 's1', {'s1.fastq': b'first'}))
+        archive_size = os.path.getsize(archive.fp)
+        archive.add_sample_dir('s2', write_sample_dir(step_dir, 's2', {'s2.fastq': b'second'}))
+        # the last member is cut short
+        with open(archive.fp, 'r+b') as f:
+            f.truncate(os.path.getsize(archive.fp) - 2)
+
+        restarted_archive = step_archive.StepArchive(archive.fp)
+        assert restarted_archive.get_names() == ['s1.fastq']
+        # the next sample is written over what was left, and a sample run again replaces its members
+        restarted_archive.add_sample_dir('s2', write_sample_dir(step_dir, 's2', {'s2.fastq': b'second'}))
+        restarted_archive.add_sample_dir('s1', write_sample_dir(step_dir, 's1', {'s1.fastq': b'third'}))
+        assert os.path.getsize(archive.fp) > archive_size
+        reread_archive = step_archive.StepArchive(archive.fp)
+        assert reread_archive.get_names() == ['s2.fastq', 's1.fastq']
+        with reread_archive.open_member('s1.fastq') as member_file:
+            assert member_file.read() == b'third'
+
+
+def test_step_outputs():
+    with tempfile.TemporaryDirectory() as step_dir, tempfile.TemporaryDirectory() as staging_dir:
+        fastq = b'@r1\nACGT\n+\nIIII\n'
+        archive = step_archive.StepArchive(step_archive.get_archive_fp(step_dir))
+        archive.add_sample_dir('s1', write_sample_dir(step_dir, 's1', {'s1.fastq.gz': gzip.compress(fastq)}))
+        with open(os.path.join(step_dir, 'log'), 'wt'):
+            pass
+        packed_fp = os.path.join(step_dir, 's1.fastq.gz')
+
+        assert step_archive.find_step_outputs(step_dir, '*') == [os.path.join(step_dir, 'log'), packed_fp]
+        assert step_archive.find_step_outputs(step_dir, '*.fastq.gz') == [packed_fp]
+        assert step_archive.is_packed(packed_fp)
+        assert not step_archive.is_packed(os.path.join(step_dir, 'log'))
+        assert step_archive.get_step_output_size(packed_fp) == len(gzip.compress(fastq))
+
+        # packed outputs are read like files
+        with open_sequence_file(packed_fp) as sequence_file:
+            assert sequence_file.read() == fastq
+
+        staged_fps = step_archive.stage_step_outputs([packed_fp, os.path.join(step_dir, 'log')], staging_dir)
+        assert staged_fps == [os.path.join(staging_dir, 's1.fastq.gz'), os.path.join(step_dir, 'log')]
+        with gzip.open(staged_fps[0], 'rb') as staged_file:
+            assert staged_file.read() == fastq
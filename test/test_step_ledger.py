@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+import cluster_16S.step_ledger as step_ledger
+
+
+def test_step_ledger():
+    with tempfile.TemporaryDirectory() as work_dir:
+        ledger_fp = step_ledger.get_step_ledger_fp(work_dir=work_dir, step_name='step_02_remove_primers')
+        ledger = step_ledger.StepLedger(ledger_fp)
+        assert not ledger.exists()
+        ledger.record_step_started()
+        assert ledger.exists()
+        assert not step_ledger.StepLedger(ledger_fp).step_complete
+
+        ledger.record_sample_complete('sample_1', outputs=['sample_1.fastq.gz'])
+        # a record cut short by a crash is ignored
+        with open(ledger_fp, 'at') as ledger_file:
+            ledger_file.write('{"status": "sample_comp')
+
+        restarted_ledger = step_ledger.StepLedger(ledger_fp)
+        assert restarted_ledger.sample_is_complete('sample_1')
+        assert not restarted_ledger.sample_is_complete('sample_2')
+        assert not restarted_ledger.step_complete
+
+        restarted_ledger.record_sample_complete('sample_2', outputs=['sample_2.fastq.gz'])
+        restarted_ledger.record_step_complete()
+        assert step_ledger.StepLedger(ledger_fp).sample_is_complete('sample_2')
+        assert step_ledger.StepLedger(ledger_fp).step_complete
+
+
+def test_create_and_commit_sample_dir():
+    with tempfile.TemporaryDirectory() as output_dir:
+        sample_dir = step_ledger.create_sample_dir(output_dir=output_dir, sample_name='sample_1')
+        with open(os.path.join(sample_dir, 'partial.fastq'), 'wt') as partial_file:
+            partial_file.write('@incomplete\n')
+
+        # a second attempt starts from an empty directory
+        sample_dir = step_ledger.create_sample_dir(output_dir=output_dir, sample_name='sample_1')
+        assert os.listdir(sample_dir) == []
+
+        with open(os.path.join(sample_dir, 'sample_1.fastq.gz'), 'wt') as output_file:
+            output_file.write('complete')
+        output_names = step_ledger.commit_sample_dir(sample_dir=sample_dir, output_dir=output_dir)
+
+        assert output_names == ['sample_1.fastq.gz']
+        assert os.listdir(output_dir) == ['sample_1.fastq.gz']
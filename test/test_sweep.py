@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+import cluster_16S.sweep as sweep
+from cluster_16S.otu_table import OtuTable, write_otu_table_npz
+from cluster_16S.pipeline import Pipeline
+
+
+required_argv = [
+    '--cutadapt-min-length', '100',
+    '--pear-min-overlap', '20', '--pear-max-assembly-length', '270', '--pear-min-assembly-length', '200',
+]
+
+
+def test_get_sweep_args():
+    grid, args, max_concurrent_branches = sweep.get_sweep_args([
+        *required_argv, '-w', '/work', '--core-count', '4',
+        '--vsearch-filter-maxee', '1', '2',
+        '--vsearch-filter-trunclen', '245',
+        '--vsearch-derep-minuniquesize', '2', '3', '8'])
+    assert grid == {
+        'vsearch_filter_maxee': [1, 2], 'vsearch_filter_trunclen': [245], 'vsearch_derep_minuniquesize': [2, 3, 8]}
+    assert args.work_dir == '/work' and args.core_count == 4 and args.pear_min_overlap == 20
+    assert args.vsearch_filter_maxee == 1
+    assert max_concurrent_branches is None
+    assert len(list(sweep.get_grid_settings(grid))) == 6
+
+    with pytest.raises(SystemExit):
+        sweep.get_sweep_args([
+            *required_argv,
+            '--vsearch-filter-maxee', '1', '1',
+            '--vsearch-filter-trunclen', '245',
+            '--vsearch-derep-minuniquesize', '2'])
+
+
+def test_get_branch_dir_name():
+    assert sweep.get_branch_dir_name(
+        {'vsearch_filter_maxee': 1, 'vsearch_filter_trunclen': 245}) == 'maxee_1.trunclen_245'
+
+
+def fake_step(step_name):
+    # writes the outputs run_sweep and get_branch_summary look for
+    def step(self, input_dir):
+        output_dir = os.path.join(self.work_dir, step_name)
+        os.makedirs(os.path.join(output_dir, 'read_qc'))
+        with open(os.path.join(output_dir, 'inputs.json'), 'wt') as inputs_file:
+            json.dump({'input_dir': input_dir, 'maxee': self.vsearch_filter_maxee}, inputs_file)
+        if step_name.startswith('step_03'):
+            with open(os.path.join(output_dir, 'read_qc', 'a.assembled.fastq.gz.qc.json'), 'wt') as qc_file:
+                json.dump({'read_count': 100}, qc_file)
+        elif step_name.startswith('step_04'):
+            with open(os.path.join(output_dir, 'read_qc', 'a.assembled.ee.fastq.gz.qc.json'), 'wt') as qc_file:
+                json.dump({'read_count': 100 - 10 * self.vsearch_filter_maxee}, qc_file)
+        elif step_name.startswith('step_09'):
+            otu_count = self.vsearch_derep_minuniquesize
+            write_otu_table_npz(
+                OtuTable.from_coo(
+                    otu_ids=['OTU_{}'.format(i) for i in range(otu_count)], sample_ids=['a'],
+                    rows=np.arange(otu_count), cols=np.zeros(otu_count, dtype=np.int64),
+                    data=np.full(otu_count, 10)),
+                os.path.join(output_dir, 'a.otutab.merged.npz'))
+        return output_dir
+    return step
+
+
+def test_run_sweep(monkeypatch):
+    for stage in sweep.SWEEP_STAGES:
+        for step_name in stage.steps:
+            monkeypatch.setattr(Pipeline, step_name, fake_step(step_name))
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        grid, args, _ = sweep.get_sweep_args([
+            *required_argv, '-i', input_dir, '-w', work_dir,
+            '--vsearch-filter-maxee', '1', '2',
+            '--vsearch-filter-trunclen', '245',
+            '--vsearch-derep-minuniquesize', '2', '3'])
+        summary_rows = sweep.run_sweep(grid, args)
+
+        # steps 01-03 ran once, steps 04-05 once per maxee
+        assert sorted(name for name in os.listdir(work_dir) if not name.startswith('.')) == [
+            'maxee_1.trunclen_245', 'maxee_2.trunclen_245',
+            'step_01_copy_and_compress', 'step_02_remove_primers', 'step_03_merge_forward_reverse_reads_with_pear',
+            'sweep_summary.tsv']
+        leaf_dir = os.path.join(work_dir, 'maxee_2.trunclen_245', 'minuniquesize_3')
+        assert os.path.islink(os.path.join(leaf_dir, 'step_01_copy_and_compress'))
+        assert os.path.islink(os.path.join(leaf_dir, 'step_05_combine_runs'))
+        assert not os.path.islink(os.path.join(leaf_dir, 'step_06_dereplicate_sort_remove_low_abundance_reads'))
+        with open(os.path.join(leaf_dir, 'step_06_dereplicate_sort_remove_low_abundance_reads', 'inputs.json')) as f:
+            assert json.load(f) == {
+                'input_dir': os.path.join(work_dir, 'maxee_2.trunclen_245', 'step_05_combine_runs'), 'maxee': 2}
+
+        with open(os.path.join(work_dir, 'sweep_summary.tsv'), 'rt') as summary_file:
+            summary_lines = summary_file.read().splitlines()
+
+    assert [(r['vsearch_filter_maxee'], r['vsearch_derep_minuniquesize'], r['otu_count']) for r in summary_rows] == [
+        (1, 2, 2), (1, 3, 3), (2, 2, 2), (2, 3, 3)]
+    assert summary_rows[2]['filtered_fraction'] == 0.8
+    assert summary_rows[3]['otu_table_reads'] == 30
+    assert summary_lines[0].split('\t') == list(sweep.SUMMARY_COLUMNS)
+    assert len(summary_lines) == 5
+
+
+def test_run_sweep__failed_branch():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as work_dir:
+        grid, args, _ = sweep.get_sweep_args([
+            *required_argv, '-i', os.path.join(input_dir, 'missing'), '-w', work_dir,
+            '--vsearch-filter-maxee', '1', '2',
+            '--vsearch-filter-trunclen', '245',
+            '--vsearch-derep-minuniquesize', '2'])
+        summary_rows = sweep.run_sweep(grid, args)
+    # steps 01-03 failed so every combination failed
+    assert len(summary_rows) == 2
+    assert all(row['error'] != '' for row in summary_rows)
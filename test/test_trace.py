@@ -0,0 +1,96 @@
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+from cluster_16S import trace
+from cluster_16S.command_runner import Command, CommandRunner
+
+
+@pytest.fixture
+def tracer():
+    tracer = trace.enable_tracing()
+    try:
+        yield tracer
+    finally:
+        trace.disable_tracing()
+
+
+def test_span__disabled():
+    assert not trace.tracing_enabled()
+    with trace.span('step', 'step', file='x') as s:
+        assert s is None
+    assert trace.now() is None
+    trace.add_span('command', 'subprocess', start=trace.now())
+
+
+def test_span(tracer):
+    @trace.traced('compression')
+    def compress():
+        with trace.span('block', 'compression', size=3):
+            pass
+
+    compress()
+    thread = threading.Thread(target=compress, name='worker')
+    thread.start()
+    thread.join()
+
+    events = [e for e in tracer.get_trace_events() if e['ph'] == 'X']
+    assert [e['name'] for e in events] == ['compress', 'block', 'compress', 'block']
+    assert events[1]['args'] == {'size': 3}
+    assert events[0]['ts'] <= events[1]['ts'] and events[1]['dur'] <= events[0]['dur']
+    # one lane per thread
+    assert events[0]['tid'] != events[2]['tid']
+    thread_names = {e['args']['name'] for e in tracer.get_trace_events() if e['name'] == 'thread_name'}
+    assert 'worker' in thread_names
+
+
+def test_span__exception(tracer):
+    with pytest.raises(ValueError):
+        with trace.span('step', 'step'):
+            raise ValueError()
+    event, = [e for e in tracer.get_trace_events() if e['ph'] == 'X']
+    assert event['args'] == {'error': 'ValueError'}
+
+
+@pytest.mark.skipif(shutil.which('true') is None, reason='no "true" command')
+def test_write_trace(tracer):
+    with tempfile.TemporaryDirectory() as work_dir:
+        command = Command(['true'], log_file=os.path.join(work_dir, 'log'))
+        CommandRunner(core_count=1).run_commands([command])
+
+        trace_fp = os.path.join(work_dir, 'trace.json')
+        trace.write_trace(trace_fp)
+        with open(trace_fp, 'rt') as trace_file:
+            trace_events = json.load(trace_file)['traceEvents']
+
+    subprocess_event, = [e for e in trace_events if e.get('cat') == 'subprocess']
+    assert subprocess_event['pid'] == command.pid
+    assert subprocess_event['args']['returncode'] == 0
+    assert {'name': 'process_name', 'ph': 'M', 'pid': command.pid, 'tid': command.pid,
+            'args': {'name': 'true {}'.format(command.pid)}} in trace_events
+
+
+def test_use_tracer():
+    command_runner = CommandRunner(core_count=2)
+
+    def run(tracer, name):
+        with trace.use_tracer(tracer), trace.span(name, 'pipeline'):
+            # functions run on the runner's threads are traced by the tracer of the run that gave them
+            command_runner.run_functions([functools.partial(trace.add_span, name + '_function', 'test', 0)])
+
+    tracers = [trace.Tracer(), trace.Tracer()]
+    threads = [threading.Thread(target=run, args=(tracer, name)) for tracer, name in zip(tracers, ('a', 'b'))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    run(None, 'untraced')
+
+    for tracer, name in zip(tracers, ('a', 'b')):
+        assert sorted(e['name'] for e in tracer.get_trace_events() if e['ph'] == 'X') == [name, name + '_function']
+    assert not trace.tracing_enabled()
@@ -0,0 +1,40 @@
+import collections
+import os
+import tempfile
+
+from cluster_16S.seqio import read_fasta_records
+import cluster_16S.uniques as uniques
+
+
+def test_unique_sequence_counter():
+    unique_sequence_counter = uniques.UniqueSequenceCounter()
+    unique_sequence_counter.add_sample('A', collections.Counter([b'ACGT', b'ACGT', b'TTTT']))
+    unique_sequence_counter.add_sample('B', collections.Counter([b'GGGG', b'ACGT']))
+    table = unique_sequence_counter.get_table()
+
+    assert table.otu_ids == ['Uniq1', 'Uniq2', 'Uniq3']
+    assert table.sample_ids == ['A', 'B']
+    assert table.get_sample_counts('A') == {'Uniq1': 2, 'Uniq2': 1}
+    assert table.get_sample_counts('B') == {'Uniq1': 1, 'Uniq3': 1}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        fasta_fp = os.path.join(work_dir, 'uniques.fasta.gz')
+        unique_sequence_counter.write_fasta(fasta_fp)
+        assert list(read_fasta_records(fasta_fp)) == [
+            ('Uniq1', b'ACGT'), ('Uniq2', b'TTTT'), ('Uniq3', b'GGGG')]
+
+
+def test_assign_unique_counts():
+    unique_sequence_counter = uniques.UniqueSequenceCounter()
+    unique_sequence_counter.add_sample('A', {b'ACGT': 2, b'TTTT': 1, b'CCCC': 4})
+    unique_sequence_counter.add_sample('B', {b'CCCC': 1, b'TTTT': 5})
+
+    # ACGT and TTTT are in OTU_2, CCCC has no OTU
+    otu_table, mapped_reads, unmapped_reads = uniques.assign_unique_counts(
+        unique_sequence_counter.get_table(), assignment=[1, 1, -1], otu_ids=['OTU_1', 'OTU_2'])
+
+    assert otu_table.get_sample_counts('A') == {'OTU_2': 3}
+    assert otu_table.get_sample_counts('B') == {'OTU_2': 5}
+    assert mapped_reads.tolist() == [3, 5]
+    assert unmapped_reads.tolist() == [4, 1]
+    assert uniques.get_unique_index('Uniq3;size=2;') == 2